@@ -11,7 +11,7 @@ setup(
     install_requires=[
         'argparse>=1.2.1',
         'MySQL-python>=1.2.4',
-        'sqlparse>=0.1.7',
+        'sqlparse==0.1.7',
         'mmh3>=2.2',
         'construct>=2.5.1',
         'pylibpcap==0.6.4',
@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+import argparse
+import codecs
+import datetime
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import sqlparse
+
+import sqlcanonclient
+
+
+FILE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+DEFAULT_SLOW_LOG = os.path.join(FILE_DIR, 'tests', 'data', 'mysql-slow.log')
+
+args = None
+
+
+class BenchmarkOptions:
+    """Stands in for the command-line options of sqlcanonclient."""
+
+    def __init__(self):
+        self.stand_alone = True
+        self.server_id = 1
+        self.no_skip_unknowns = False
+        self.encoding = 'utf_8'
+        self.encoding_errors = 'replace'
+
+
+def read_slow_log_statements(path):
+    """Returns the statements of a MySQL slow query log."""
+
+    statements = []
+    with codecs.open(path, encoding='utf_8', errors='replace') as f:
+        line = f.readline()
+        while line:
+            if line.startswith('# '):
+                log_item_parser = sqlcanonclient.SlowQueryLogItemParser()
+                line = log_item_parser.parse_header_data(line, f)
+                line = log_item_parser.parse_statement(line, f)
+                statements.append(log_item_parser.statement)
+            else:
+                line = f.readline()
+    return statements
+
+
+def rnd_literal(match):
+    """Replaces a literal found by FINGERPRINT_PATTERN with a random one."""
+
+    kind = match.lastgroup
+    if kind == 'i':
+        return str(random.randint(0, 1000000))
+    elif kind == 'f':
+        return '%d.%02d' % (random.randint(0, 1000), random.randint(0, 99))
+    elif kind == 's':
+        return "'%08x'" % (random.getrandbits(32),)
+    elif kind == 'q':
+        return '"%08x"' % (random.getrandbits(32),)
+    return match.group()
+
+
+def rnd_statements(statements, count):
+    """Returns count statements shaped like statements, with random literals."""
+
+    return [
+        sqlcanonclient.FINGERPRINT_PATTERN.sub(
+            rnd_literal, random.choice(statements))
+        for i in xrange(count)]
+
+
+def timed(f, *fargs):
+    start = time.time()
+    f(*fargs)
+    return time.time() - start
+
+
+def canonicalize_all(statements):
+    for statement in statements:
+        sqlcanonclient.canonicalize_statement(statement)
+
+
+def do_canonicalize():
+    """Canonicalization throughput with and without the fingerprint cache."""
+
+    statements = rnd_statements(
+        read_slow_log_statements(args.file), args.count)
+    cache = sqlcanonclient.FINGERPRINT_CACHE
+
+    cache.resize(0)
+    uncached = timed(canonicalize_all, statements)
+    print 'uncached: %.0f statements/s' % (len(statements) / uncached,)
+
+    cache.resize(sqlcanonclient.FINGERPRINT_CACHE_SIZE)
+    cached = timed(canonicalize_all, statements)
+    print 'cached: %.0f statements/s (%d hits, %d misses)' % (
+        len(statements) / cached, cache.hits, cache.misses)
+
+    print 'speedup: %.1fx' % (uncached / cached,)
+canonicalize = do_canonicalize
+
+
+def canonicalize_offsets_all(f, statements):
+    for statement in statements:
+        f(statement)
+
+
+def do_engines():
+    """Throughput of the canonicalization engines, without the fingerprint cache."""
+
+    statements = rnd_statements(
+        read_slow_log_statements(args.file), args.count)
+
+    elapsed = {}
+    for name in sorted(sqlcanonclient.CANONICALIZATION_ENGINES):
+        elapsed[name] = timed(canonicalize_offsets_all,
+            sqlcanonclient.CANONICALIZATION_ENGINES[name], statements)
+        print '%s: %.0f statements/s' % (name, len(statements) / elapsed[name])
+
+    print 'speedup: %.1fx' % (elapsed['sqlparse'] / elapsed['lexer'],)
+engines = do_engines
+
+
+def bulk_insert(rows):
+    """Returns a multi-row INSERT statement, about 8 tokens per row."""
+
+    return u'INSERT INTO t (a, b) VALUES ' + u', '.join(
+        u"(%d, 'x%d')" % (i, i) for i in xrange(rows))
+
+
+def do_scaling():
+    """Canonicalization time versus statement length, up to count tokens.
+
+    sqlparse parsing is left out of the sqlparse engine timings, it is not
+    linear by itself; the lexer engine timings include its own parsing.
+    """
+
+    for size in (args.count // 8, args.count // 4, args.count // 2,
+                 args.count):
+        statement = bulk_insert(max(size // 8, 1))
+        stmt = sqlparse.parse(statement)[0]
+        tokens = len(list(stmt.flatten()))
+        walk = timed(sqlcanonclient.canonicalize_parsed_statement, stmt)
+        lexer = timed(sqlcanonclient.lexer_canonicalize_statement_offsets,
+                      statement)
+        print '%d tokens: sqlparse walk %.3fs (%.2fus/token), lexer %.3fs (%.2fus/token)' % (
+            tokens, walk, walk * 1e6 / tokens, lexer, lexer * 1e6 / tokens)
+scaling = do_scaling
+
+
+def where_statement(terms):
+    """Returns a SELECT statement with a long WHERE clause, 23 tokens per term."""
+
+    return u'SELECT a FROM t WHERE ' + u' AND '.join(
+        u"(b%d = 'x%d' OR c IN (%d, %d))" % (i, i, i, i)
+        for i in xrange(terms))
+
+
+def forked(f, *fargs):
+    """
+    Runs f(*fargs) in a child process.
+
+    Returns (seconds, peak resident memory growth in KB) of the call.
+    """
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        elapsed = timed(f, *fargs)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(w, '%f %d' % (elapsed, after - before))
+        os._exit(0)
+    os.close(w)
+    result = os.read(r, 100)
+    os.close(r)
+    os.waitpid(pid, 0)
+    elapsed, peak = result.split()
+    return float(elapsed), int(peak)
+
+
+def do_memory():
+    """Peak memory and time of canonicalization versus statement length, up to count tokens.
+
+    Every canonicalization runs in its own child process, so the peak
+    resident memory growth belongs to it alone. sqlparse parsing is
+    left out of the sqlparse engine figures.
+    """
+
+    for size in (args.count // 4, args.count // 2, args.count):
+        statement = where_statement(max(size // 23, 1))
+        stmt = sqlparse.parse(statement)[0]
+        tokens = len(list(stmt.flatten()))
+        walk, walk_peak = forked(
+            sqlcanonclient.canonicalize_parsed_statement, stmt)
+        lexer, lexer_peak = forked(
+            sqlcanonclient.lexer_canonicalize_statement_offsets, statement)
+        print '%d tokens: sqlparse walk +%dKB %.2fus/token, lexer +%dKB %.2fus/token' % (
+            tokens, walk_peak, walk * 1e6 / tokens,
+            lexer_peak, lexer * 1e6 / tokens)
+memory = do_memory
+
+
+def write_slow_log(path, statements):
+    """Writes statements as the items of a MySQL slow query log."""
+
+    dt = datetime.datetime(2013, 3, 7, 16, 52, 36)
+    with codecs.open(path, 'w', encoding='utf_8') as f:
+        for statement in statements:
+            dt += datetime.timedelta(seconds=1)
+            f.write(dt.strftime(u'# Time: %y%m%d %H:%M:%S\n'))
+            f.write(u'# Query_time: 0.1234  Lock_time: 0.5678  Rows_sent: 1  Rows_examined: 2\n')
+            f.write(statement.rstrip() + u'\n')
+
+
+def process_slow_log(path, workers):
+    with codecs.open(path, encoding='utf_8', errors='replace') as f:
+        sqlcanonclient.SlowQueryLogProcessor(
+            workers=workers).process_log_contents(f)
+
+
+def process_slow_log_file(path, workers):
+    sqlcanonclient.SlowQueryLogProcessor(
+        workers=workers).process_log_file(path)
+
+
+def do_workers():
+    """Slow query log processing throughput versus number of worker processes.
+
+    The log is processed as a stream, log items read by the main process,
+    and as a file, split in shards read by the worker processes. Statement
+    data is not saved and the output of the processor is discarded, so
+    that only reading, canonicalization and hashing count.
+    """
+
+    statements = rnd_statements(
+        read_slow_log_statements(args.file), args.count)
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    write_slow_log(path, statements)
+
+    sqlcanonclient.DataManager.save_statement_data = staticmethod(
+        lambda *args: None)
+    stdout = sys.stdout
+    workers = 1
+    elapsed = {}
+    try:
+        while True:
+            for name, f in (('stream', process_slow_log),
+                            ('file', process_slow_log_file)):
+                sys.stdout = open(os.devnull, 'w')
+                try:
+                    elapsed[name, workers] = timed(f, path, workers)
+                finally:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+                print '%d worker(s), %s: %.0f statements/s, speedup %.1fx' % (
+                    workers, name, len(statements) / elapsed[name, workers],
+                    elapsed[name, 1] / elapsed[name, workers])
+            if workers >= multiprocessing.cpu_count():
+                break
+            workers = min(workers * 2, multiprocessing.cpu_count())
+    finally:
+        os.remove(path)
+workers = do_workers
+
+
+def write_general_log(path, statements):
+    """Writes statements as the Query commands of a MySQL general query log."""
+
+    with codecs.open(path, 'w', encoding='utf_8') as f:
+        f.write(u'/usr/sbin/mysqld, Version: 5.5.29-log ((Ubuntu)). started with:\n')
+        f.write(u'Tcp port: 3306  Unix socket: /var/run/mysqld/mysqld.sock\n')
+        f.write(u'Time                 Id Command    Argument\n')
+        for statement in statements:
+            f.write(u'130309  1:07:39\t 2623 Query\t')
+            f.write(statement.strip().replace(u'\n', u'\n\t\t') + u'\n')
+
+
+class GeneralLogStatementReader(sqlcanonclient.MySqlGenQueryLogReader):
+    """Parses the statements of Query commands of a general query log."""
+
+    def got_log_item(self, dt=None, cid=None, cmd=None, arg=None):
+        if cmd and cmd.strip().lower() == 'query':
+            sqlcanonclient.GeneralQueryLogItemParser().parse_statement(arg)
+
+
+def read_slow_log(f):
+    for log_item_parser in sqlcanonclient.SlowQueryLogProcessor().read_log_items(f):
+        pass
+
+
+def read_general_log(f):
+    GeneralLogStatementReader().read_lines(f)
+
+
+def do_reading():
+    """Log reading throughput, reading bytes versus decoding every line.
+
+    Log items are parsed but not canonicalized. Decoding every line with
+    a codecs reader is how logs were read before they were read as bytes.
+    """
+
+    statements = rnd_statements(
+        read_slow_log_statements(args.file), args.count)
+    for name, write, read in (('slow', write_slow_log, read_slow_log),
+                              ('general', write_general_log, read_general_log)):
+        fd, path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        try:
+            write(path, statements)
+            size = os.path.getsize(path) / 1024.0 / 1024.0
+            with codecs.open(path, encoding='utf_8', errors='replace') as f:
+                decoded = timed(read, f)
+            with open(path, 'rb', sqlcanonclient.LOG_READ_BUFFER_SIZE) as f:
+                binary = timed(read, f)
+            print '%s query log: codecs %.1f MB/s, binary %.1f MB/s, speedup %.1fx' % (
+                name, size / decoded, size / binary, decoded / binary)
+        finally:
+            os.remove(path)
+reading = do_reading
+
+
+def save_locally(data):
+    for statement, __, canonicalized, hash, hostname_hash in data:
+        sqlcanonclient.LocalData.save_statement_data(
+            None, statement, sqlcanonclient.HOSTNAME, canonicalized, hash,
+            hostname_hash, {})
+    sqlcanonclient.LocalData.flush()
+
+
+def no_explain():
+    raise Exception('EXPLAIN is not benchmarked.')
+
+
+def do_local():
+    """Statement data saved per second in the local database (stand-alone mode).
+
+    Statements are canonicalized beforehand and EXPLAIN is not run. The
+    statements ring is filled by the first STATEMENT_DATA_MAX_ROWS
+    statements, later ones replace the oldest rows. Statements are written
+    one per transaction, then in batches of LOCAL_DB_BATCH_SIZE.
+    """
+
+    data = []
+    for statement in rnd_statements(
+            read_slow_log_statements(args.file), args.count):
+        for item in sqlcanonclient.DataManager.canonicalize_data(statement):
+            if item[3] is not None:
+                data.append(item)
+    max_rows = sqlcanonclient.STATEMENT_DATA_MAX_ROWS
+    sqlcanonclient.DataManager.get_explain_connection_options = staticmethod(
+        no_explain)
+    path = tempfile.mkdtemp()
+    stdout = sys.stdout
+    try:
+        for batch_size in (1, sqlcanonclient.LOCAL_DB_BATCH_SIZE):
+            sqlcanonclient.LocalData.init_db(
+                os.path.join(path, 'data%d.db' % (batch_size,)),
+                batch_size=batch_size)
+            for name, part in (('filling ring', data[:max_rows]),
+                               ('ring full', data[max_rows:])):
+                if not part:
+                    continue
+                sys.stdout = open(os.devnull, 'w')
+                try:
+                    elapsed = timed(save_locally, part)
+                finally:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+                print (
+                    '%s, batches of %d: %d statements, %.0f statements/s, '
+                    '%.0fus/statement') % (
+                    name, batch_size, len(part), len(part) / elapsed,
+                    elapsed * 1000000 / len(part))
+        sqlcanonclient.LocalData.close_db()
+    finally:
+        shutil.rmtree(path)
+local = do_local
+
+
+# number of distinct statements of the queries benchmark
+QUERIES_SHAPES = 1000
+
+
+def write_statements(count):
+    """Writes count statements of QUERIES_SHAPES shapes, seen over a day."""
+
+    now = datetime.datetime.now()
+    shapes = []
+    for k in xrange(QUERIES_SHAPES):
+        canonicalized = u'SELECT * FROM t%d WHERE id = ?' % (k,)
+        shapes.append((
+            canonicalized, sqlcanonclient.mmh3.hash(canonicalized),
+            sqlcanonclient.mmh3.hash(
+                '{0}{1}'.format(canonicalized, sqlcanonclient.HOSTNAME))))
+
+    def rows():
+        for i in xrange(count):
+            # a few shapes make up most statements
+            canonicalized, hash, hostname_hash = shapes[min(
+                int(random.expovariate(10.0 / QUERIES_SHAPES)),
+                QUERIES_SHAPES - 1)]
+            dt = now - datetime.timedelta(seconds=(count - i) * 86400.0 / count)
+            yield (dt, canonicalized.replace('?', str(i)), 1, canonicalized,
+                hash, hostname_hash, i, dt, dt)
+
+    conn = sqlcanonclient.LocalData.get_connection()
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO statements(
+                dt, statement, server_id, canonicalized_statement,
+                canonicalized_statement_hash,
+                canonicalized_statement_hostname_hash,
+                sequence_id, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows())
+    return shapes
+
+
+def has_statements_all(hashes):
+    for hash in hashes:
+        sqlcanonclient.LocalData.has_statements(hash)
+
+
+def time_queries(name, shapes):
+    # half of them were not seen
+    hashes = [shape[2] for shape in shapes] + range(len(shapes))
+    elapsed = timed(has_statements_all, hashes)
+    print '%s: first seen %.3fms' % (name, elapsed * 1000 / len(hashes))
+    elapsed = timed(sqlcanonclient.LocalData.get_top_queries, 5)
+    print '%s: top 5 queries %.3fs' % (name, elapsed)
+    dt = datetime.datetime.now()
+    elapsed = timed(
+        sqlcanonclient.LocalData.get_last_statements,
+        dt - datetime.timedelta(minutes=5), dt)
+    print '%s: last 5 minutes statements %.3fs' % (name, elapsed)
+
+
+def do_queries():
+    """Local database queries at count statements (stand-alone mode).
+
+    The statements are queried in a database of schema version 2, without
+    secondary indexes, then once it is upgraded to the last version.
+    """
+
+    path = tempfile.mkdtemp()
+    try:
+        db = os.path.join(path, 'data.db')
+        sqlcanonclient.LocalData.DB = db
+        conn = sqlcanonclient.LocalData.get_connection()
+        sqlcanonclient.LocalData.migrate(conn, 2)
+        shapes = write_statements(args.count)
+        time_queries('version 2', shapes)
+
+        version = len(sqlcanonclient.LocalData.MIGRATIONS)
+        elapsed = timed(sqlcanonclient.LocalData.init_db, db,
+            sqlcanonclient.LOCAL_DB_SYNCHRONOUS, args.count)
+        print 'upgrade to version %d: %.1fs' % (version, elapsed)
+        time_queries('version %d' % (version,), shapes)
+        sqlcanonclient.LocalData.close_db()
+    finally:
+        shutil.rmtree(path)
+queries = do_queries
+
+
+def main():
+    global args
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        'method',
+        choices=['canonicalize', 'engines', 'scaling', 'memory', 'workers',
+                 'reading', 'local', 'queries'],
+        help='benchmark to run.')
+    parser.add_argument(
+        '-f', '--file', default=DEFAULT_SLOW_LOG,
+        help='MySQL slow query log to take statements from')
+    parser.add_argument(
+        '-n', '--count', type=int, default=10000,
+        help='number of statements to process')
+
+    args = parser.parse_args()
+
+    sqlcanonclient.OPTIONS = BenchmarkOptions()
+
+    src = globals().copy()
+    src.update(locals())
+    m = src.get(args.method)
+    if not m:
+        raise Exception('Method %s not implemented.' % (args.method, ))
+    m()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,36 @@
 #!/usr/bin/env python
 
 import argparse
-import codecs
+import collections
+import contextlib
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import fcntl
 import getpass
+import httplib
+import io
 import itertools
 import json
+import math
+import mmap
+import multiprocessing
 import pprint
 import os
+import Queue
 import re
+import select
 import socket
 import string
 import sys
 import tempfile
+import threading
 import time
 import traceback
-import urllib
-import urllib2
+import urlparse
+import uuid
+import zlib
 
 from construct.protocols.ipstack import ip_stack
 from dateutil.parser import parse as datetime_parse
@@ -25,6 +39,7 @@ import mmh3
 import MySQLdb
 import sqlite3
 import sqlparse
+from sqlparse.keywords import KEYWORDS, KEYWORDS_COMMON
 from sqlparse.tokens import Token
 import yaml
 
@@ -62,6 +77,8 @@ class Options(object):
 
     def _parse_command_line_args(self):
         default_db = '%s/sqlcanonclient.db' % tempfile.gettempdir()
+        default_checkpoint_file = (
+            '%s/sqlcanonclient-checkpoints.json' % tempfile.gettempdir())
 
         parser = argparse.ArgumentParser(
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -87,8 +104,16 @@ class Options(object):
             default='http://localhost:8000')
         parser.add_argument(
             '--save-statement-data-path',
-            help='URL to be used for saving statement data.',
+            help='URL to be used for saving statement data one at a time, when --server-batch-size is 0.',
             default='/sqlcanon/save-statement-data/',)
+        parser.add_argument(
+            '--save-statement-data-bulk-path',
+            help='URL to be used for saving statement data in batches.',
+            default='/sqlcanon/save-statement-data-bulk/',)
+        parser.add_argument(
+            '--save-statement-stats-path',
+            help='URL to be used for saving statement stats, with --aggregate.',
+            default='/sqlcanon/save-statement-stats/',)
         parser.add_argument(
             '--save-explained-statement-path',
             help='URL to be used for saving explain statement.',
@@ -142,6 +167,95 @@ class Options(object):
         parser.add_argument('--no-skip-unknowns', action='store_true',
             help='Any value other than 0 will skip processing of non DDL/DML statements.',)
 
+        parser.add_argument('--fingerprint-cache-size', type=int,
+            default=FINGERPRINT_CACHE_SIZE,
+            help='Number of statement shapes to keep canonicalized, 0 disables the cache.')
+
+        parser.add_argument('--canonicalization-engine',
+            choices=('sqlparse', 'lexer'), default='sqlparse',
+            help='Canonicalization engine, lexer is a linear time reimplementation of the sqlparse engine.')
+
+        parser.add_argument('--workers', type=int, default=1,
+            help='Number of processes canonicalizing slow query log statements, 1 canonicalizes them in the main process.')
+
+        parser.add_argument('--sqlite-synchronous',
+            choices=('OFF', 'NORMAL', 'FULL'), default=LOCAL_DB_SYNCHRONOUS,
+            help='Synchronous setting of the local database, NORMAL syncs it at WAL checkpoints only, FULL at every commit.')
+
+        parser.add_argument('--statement-data-max-rows', type=int,
+            default=STATEMENT_DATA_MAX_ROWS,
+            help='Number of statements kept in the local database, a new statement replaces the oldest one.')
+
+        parser.add_argument('--sqlite-batch-size', type=int,
+            default=LOCAL_DB_BATCH_SIZE,
+            help='Number of statements written to the local database in a single transaction.')
+
+        parser.add_argument('--sqlite-flush-interval', type=int,
+            default=LOCAL_DB_FLUSH_INTERVAL,
+            help='Milliseconds after which statements are written to the local database even if there are less than --sqlite-batch-size of them.')
+
+        parser.add_argument('--server-batch-size', type=int,
+            default=SERVER_BATCH_SIZE,
+            help='Number of statements sent to the server in a single request, 0 sends them one at a time to --save-statement-data-path.')
+
+        parser.add_argument('--server-flush-interval', type=int,
+            default=SERVER_FLUSH_INTERVAL,
+            help='Milliseconds after which statements are sent to the server even if there are less than --server-batch-size of them.')
+
+        parser.add_argument('--server-retries', type=int,
+            default=SERVER_RETRIES,
+            help='Number of times a request failing or answered with HTTP 502, 503 or 504 is sent to the server again, waiting twice as long every time.')
+
+        parser.add_argument('--no-server-compression', action='store_true',
+            help='Send requests to the server without gzip compression.')
+
+        parser.add_argument('--spool-dir',
+            help='Directory where requests to the server are kept until they are sent, sending resumes from there. Defaults to a directory of the temporary directory per log file and server base URL.')
+
+        parser.add_argument('--spool-max-size', type=int,
+            default=SPOOL_MAX_SIZE / (1024 * 1024),
+            help='Megabytes of requests kept in --spool-dir while the server is unreachable, the oldest ones are dropped first.')
+
+        parser.add_argument('--no-spool', action='store_true',
+            help='Send requests to the server as they are made, waiting for its responses.')
+
+        parser.add_argument('--aggregate', action='store_true',
+            help='Send the count, sums, minimums and maximums of the statements of every shape every --server-flush-interval milliseconds, with one sample statement, instead of the statements.')
+
+        parser.add_argument('--bloom-filter-capacity', type=int, default=0,
+            help='Number of distinct statements the Bloom filter of the statements seen in the local database is sized for, 0 keeps them in a set.')
+
+        parser.add_argument('--explain-workers', type=int,
+            default=EXPLAIN_WORKERS,
+            help='Number of threads running EXPLAIN statements, 0 runs them before reading further statements.')
+
+        parser.add_argument('--explain-queue-size', type=int,
+            default=EXPLAIN_QUEUE_SIZE,
+            help='Number of EXPLAIN statements waiting for a thread, reading waits for a free slot once it is full.')
+
+        parser.add_argument('--explain-timeout', type=float,
+            default=EXPLAIN_TIMEOUT,
+            help='Seconds after which a running EXPLAIN statement is killed.')
+
+        parser.add_argument('--follow', action='store_true',
+            help='Keep reading the log file as it is written, across rotations and truncations.')
+
+        parser.add_argument('--checkpoint-file', default=default_checkpoint_file,
+            help='File saving how far log files were processed when not in stand-alone mode, processing resumes from there.')
+
+        parser.add_argument('--checkpoint-interval', type=float,
+            default=LOG_CHECKPOINT_INTERVAL,
+            help='Minimum number of seconds between saves of how far the log file was processed, 0 saves after every log item.')
+
+        parser.add_argument('--no-checkpoints', action='store_true',
+            help='Process the log file from its start, without saving how far it was processed.')
+
+        parser.add_argument('--resume', action='store_true',
+            help='Without --follow, resume processing the log file where it stopped the last time and save how far it was processed, like --follow does.')
+
+        parser.add_argument('--stats', action='store_true',
+            help='Print fingerprint cache, EXPLAIN queue, server and spool statistics on exit.')
+
         self._args = parser.parse_args()
         #print 'options_from_args: %s' % (self._args,)
         return self._args
@@ -154,6 +268,8 @@ class Options(object):
         self.stand_alone = args.stand_alone
         self.server_base_url = args.server_base_url
         self.save_statement_data_path = args.save_statement_data_path
+        self.save_statement_data_bulk_path = args.save_statement_data_bulk_path
+        self.save_statement_stats_path = args.save_statement_stats_path
         self.save_explained_statement_path = args.save_explained_statement_path
         self.explain_options = args.explain_options
         self.sniff = args.sniff
@@ -167,6 +283,31 @@ class Options(object):
         self.server_id = args.server_id
         self.config = args.config
         self.no_skip_unknowns = args.no_skip_unknowns
+        self.fingerprint_cache_size = args.fingerprint_cache_size
+        self.canonicalization_engine = args.canonicalization_engine
+        self.workers = args.workers
+        self.sqlite_synchronous = args.sqlite_synchronous
+        self.statement_data_max_rows = args.statement_data_max_rows
+        self.sqlite_batch_size = args.sqlite_batch_size
+        self.sqlite_flush_interval = args.sqlite_flush_interval
+        self.server_batch_size = args.server_batch_size
+        self.server_flush_interval = args.server_flush_interval
+        self.server_retries = args.server_retries
+        self.no_server_compression = args.no_server_compression
+        self.spool_dir = args.spool_dir
+        self.spool_max_size = args.spool_max_size
+        self.no_spool = args.no_spool
+        self.aggregate = args.aggregate
+        self.bloom_filter_capacity = args.bloom_filter_capacity
+        self.explain_workers = args.explain_workers
+        self.explain_queue_size = args.explain_queue_size
+        self.explain_timeout = args.explain_timeout
+        self.follow = args.follow
+        self.checkpoint_file = args.checkpoint_file
+        self.checkpoint_interval = args.checkpoint_interval
+        self.no_checkpoints = args.no_checkpoints
+        self.resume = args.resume
+        self.stats = args.stats
 
     def _load_options_from_config_file(self):
         assert self._args
@@ -200,19 +341,42 @@ class Options(object):
         s = (
             '<Options file=%s, '
             'type=%s, db=%s, stand_alone=%s, server_base_url=%s, '
-            'save_statement_data_path=%s, save_explained_statement_path=%s, '
+            'save_statement_data_path=%s, save_statement_data_bulk_path=%s, '
+            'save_statement_stats_path=%s, save_explained_statement_path=%s, '
             'explain_options=%s, sniff=%s, local_run_last_statements=%s, '
             'print_top_queries=%s, sliding_window_length=%s, interface=%s, '
             'filter=%s, encoding=%s, encoding_errors=%s, server_id=%s, '
-            'config=%s, no_skip_unknowns=%s '
+            'config=%s, no_skip_unknowns=%s, fingerprint_cache_size=%s, '
+            'canonicalization_engine=%s, workers=%s, sqlite_synchronous=%s, '
+            'statement_data_max_rows=%s, sqlite_batch_size=%s, '
+            'sqlite_flush_interval=%s, server_batch_size=%s, '
+            'server_flush_interval=%s, server_retries=%s, '
+            'no_server_compression=%s, spool_dir=%s, spool_max_size=%s, '
+            'no_spool=%s, aggregate=%s, '
+            'bloom_filter_capacity=%s, '
+            'explain_workers=%s, explain_queue_size=%s, explain_timeout=%s, '
+            'follow=%s, '
+            'checkpoint_file=%s, checkpoint_interval=%s, no_checkpoints=%s, '
+            'resume=%s, stats=%s'
             '>'
             ) % (self.file,
             self.type, self.db, self.stand_alone, self.server_base_url,
-            self.save_statement_data_path, self.save_explained_statement_path,
+            self.save_statement_data_path, self.save_statement_data_bulk_path,
+            self.save_statement_stats_path, self.save_explained_statement_path,
             self.explain_options, self.sniff, self.local_run_last_statements,
             self.print_top_queries, self.sliding_window_length, self.interface,
             self.filter, self.encoding, self.encoding_errors, self.server_id,
-            self.config, self.no_skip_unknowns)
+            self.config, self.no_skip_unknowns, self.fingerprint_cache_size,
+            self.canonicalization_engine, self.workers,
+            self.sqlite_synchronous, self.statement_data_max_rows,
+            self.sqlite_batch_size, self.sqlite_flush_interval,
+            self.server_batch_size, self.server_flush_interval,
+            self.server_retries, self.no_server_compression,
+            self.spool_dir, self.spool_max_size, self.no_spool, self.aggregate,
+            self.bloom_filter_capacity, self.explain_workers,
+            self.explain_queue_size, self.explain_timeout, self.follow,
+            self.checkpoint_file, self.checkpoint_interval, self.no_checkpoints,
+            self.resume, self.stats)
         return s
 
 
@@ -256,11 +420,15 @@ class MySqlGenQueryLogReader(LineReader):
             r"(?P<id>\d+)\s"
             r"(?P<cmd>.+?)\b)?"
             r"(\t?(?P<arg>.*))?$")
+        self.skip_header = True
 
     def got_line(self, lno, ln):
         #self.print_line(lno, ln)
 
-        if lno < 3:
+        line_offset = self.offset
+        self.offset += len(ln)
+
+        if lno < 3 and self.skip_header:
             # The first three lines compose the header, ignore them.
             return
 
@@ -276,11 +444,13 @@ class MySqlGenQueryLogReader(LineReader):
                 # if we have not processed the previous cmd,
                 # now is the time to do so
                 if self.last_cmd:
+                    self.item_offsets = (self.item_start_offset, line_offset)
                     self.got_log_item(dt=self.last_dt,
                         cid=self.last_cid, cmd=self.last_cmd,
                         arg=self.last_arg)
 
                 self.last_cmd = cmd
+                self.item_start_offset = line_offset
                 if cid:
                     self.last_cid = cid
 
@@ -304,6 +474,7 @@ class MySqlGenQueryLogReader(LineReader):
     def read_lines_complete(self):
         # process unprocessed last cmd if present
         if self.last_cmd:
+            self.item_offsets = (self.item_start_offset, self.offset)
             self.got_log_item(dt=self.last_dt, cid=self.last_cid,
                 cmd=self.last_cmd, arg=self.last_arg)
 
@@ -311,35 +482,27 @@ class MySqlGenQueryLogReader(LineReader):
         print 'LOG ITEM: dt = %s, cid = %s, cmd = %s, arg = %s' % (
             dt, cid, cmd, arg)
 
-    def read_lines(self, src):
+    def read_lines(self, src, skip_header=True, offset=0):
+        """
+        Reads log items from src, skip_header is False when src does not
+        start at the beginning of the log.
+
+        offset is the byte offset of src in the log, item_offsets are the
+        (start, end) byte offsets of the log item passed to got_log_item().
+        """
+
+        self.offset = offset
+        self.item_start_offset = None
+        self.item_offsets = None
         self.first_dt = None
         self.last_dt = None
         self.last_cid = None
         self.last_cmd = None
         self.last_arg = None
+        self.skip_header = skip_header
         super(MySqlGenQueryLogReader, self).read_lines(src)
 
 
-class url_request(object):
-    """wrapper for urllib2"""
-
-    def __init__(self, url, data=None, headers={}):
-        request = urllib2.Request(url, data=data, headers=headers)
-        try:
-            self._response = urllib2.urlopen(request).read()
-            self._code = 200
-        except urllib2.URLError, e:
-            self._response = e.read()
-            self._code = e.code
-
-    @property
-    def content(self):
-        return self._response
-
-    @property
-    def code(self):
-        return self._code
-
 def int_to_hex_str(n):
     """
     Returns hex representation of a number.
@@ -450,23 +613,52 @@ class QueryLister:
 
         return result
 
-def canonicalizer_default(token):
+class CanonicalizerOutput(object):
+    """
+    Output buffers shared by the canonicalizers of a statement.
+
+    Canonicalizers append their parts of the normalized and canonicalized
+    statement to normalized and canonicalized and their values to values,
+    instead of returning strings that get concatenated at every level.
+    The parts are joined once, by join().
+    """
+
+    __slots__ = ('normalized', 'canonicalized', 'values')
+
+    def __init__(self):
+        self.normalized = []
+        self.canonicalized = []
+        self.values = []
+
+    def append(self, normalized, canonicalized):
+        """Appends parts of the normalized and canonicalized statement."""
+
+        self.normalized.append(normalized)
+        self.canonicalized.append(canonicalized)
+
+    def join(self):
+        """
+        Returns data in this format (normalized statement, canonicalized statement, values)
+        """
+
+        return (u''.join(self.normalized), u''.join(self.canonicalized),
+                self.values)
+
+def canonicalizer_default(token, out):
     """
     Default canonicalizer.
 
-    Returns data in this format (normalized statement, canonicalized statement, values)
+    Appends token as it is to out, a CanonicalizerOutput.
     """
-    return (token.normalized, token.normalized, [])
+    out.append(token.normalized, token.normalized)
 
-def canonicalizer_whitespace(token):
+def canonicalizer_whitespace(token, out):
     """
     Reduces whitespaces into a single space.
-
-    Returns data in this format (normalized statement, canonicalized statement, values)
     """
-    return (' ', ' ', [])
+    out.append(' ', ' ')
 
-def canonicalizer_name(token):
+def canonicalizer_name(token, out):
     """
     Quotes names always.
     """
@@ -475,39 +667,33 @@ def canonicalizer_name(token):
         normalized = token.normalized
     else:
         normalized = '`{0}`'.format(token.normalized.strip(' `'))
-    return (normalized, normalized, [])
+    out.append(normalized, normalized)
 
-def canonicalizer_number_integer(token):
+def canonicalizer_number_integer(token, out):
     """
     Canonicalizes integer numbers.
     """
 
-    normalized = token.normalized
-    canonicalized = '%d'
-    values = [int(token.value)]
-    return (normalized, canonicalized, values)
+    out.append(token.normalized, '%d')
+    out.values.append(int(token.value))
 
-def canonicalizer_number_float(token):
+def canonicalizer_number_float(token, out):
     """
     Canonicalizes float numbers.
     """
 
-    normalized = token.normalized
-    canonicalized = '%f'
-    values = [float(token.value)]
-    return (normalized, canonicalized, values)
+    out.append(token.normalized, '%f')
+    out.values.append(float(token.value))
 
-def canonicalizer_string_single(token):
+def canonicalizer_string_single(token, out):
     """
     Canonicalizes strings with single quotes.
     """
 
-    normalized = token.normalized
-    canonicalized = '%s'
-    values = [token.value.strip("'").replace(r"\'", "'")]
-    return (normalized, canonicalized, values)
+    out.append(token.normalized, '%s')
+    out.values.append(token.value.strip("'").replace(r"\'", "'"))
 
-def canonicalizer_string_symbol(token):
+def canonicalizer_string_symbol(token, out):
     """
     Canonicalizes strings with quotes (double).
 
@@ -516,11 +702,11 @@ def canonicalizer_string_symbol(token):
     """
 
     normalized = r"""'{0}'""".format(token.normalized.strip('"').replace(r'\"', '"'))
-    canonicalized = '%s'
-    values = [token.value.strip('"').replace(r'\"', '"')]
-    return (normalized, canonicalized, values)
+    out.append(normalized, '%s')
+    out.values.append(token.value.strip('"').replace(r'\"', '"'))
 
-# canonicalizers based on token type
+# canonicalizers based on token type, each appends a token to a
+# CanonicalizerOutput
 CANONICALIZERS = {
     Token.Text.Whitespace: canonicalizer_whitespace,
     Token.Text.Whitespace.Newline: canonicalizer_whitespace,
@@ -531,7 +717,47 @@ CANONICALIZERS = {
     Token.Literal.String.Symbol: canonicalizer_string_symbol,
     }
 
-def canonicalizer_parenthesis(token):
+def token_neighbours(tokens):
+    """
+    Pairs each token of tokens with its neighbours in linear time.
+
+    Returns a list of
+        (
+            previous token,
+            token,
+            next token,
+            previous non whitespace token,
+            next non whitespace token
+        )
+    with None for missing neighbours, the same tokens token_prev() and
+    token_next() return without looking up the index of each token.
+    """
+
+    next_nonws_tokens = []
+    next_nonws_token = None
+    for token in reversed(tokens):
+        next_nonws_tokens.append(next_nonws_token)
+        if not token.is_whitespace():
+            next_nonws_token = token
+    next_nonws_tokens.reverse()
+
+    neighbours = []
+    prev_token = None
+    prev_nonws_token = None
+    last_index = len(tokens) - 1
+    for index, token in enumerate(tokens):
+        if index < last_index:
+            next_token = tokens[index + 1]
+        else:
+            next_token = None
+        neighbours.append((prev_token, token, next_token,
+            prev_nonws_token, next_nonws_tokens[index]))
+        prev_token = token
+        if not token.is_whitespace():
+            prev_nonws_token = token
+    return neighbours
+
+def canonicalizer_parenthesis(token, out):
     """
     Canonicalizes parenthesis token.
 
@@ -540,34 +766,18 @@ def canonicalizer_parenthesis(token):
 
     assert token.is_group()
 
-    normalized = ''
-    canonicalized = ''
-    values = []
-
-    for child_token in token.tokens:
+    for prev_child_token, child_token, next_child_token, __, __ in \
+            token_neighbours(token.tokens):
         if child_token.ttype in (Token.Text.Whitespace,
                                  Token.Text.Whitespace.Newline):
-            child_token_index = token.token_index(child_token)
-            next_child_token = token.token_next(child_token_index, skip_ws=False)
-            prev_child_token = token.token_prev(child_token_index, skip_ws=False)
             if ((prev_child_token and prev_child_token.ttype in (Token.Keyword,)) or
                 (next_child_token and next_child_token.ttype in (Token.Keyword,))):
                 # maintain a single space if previous or next token is a keyword
-                c_normalized, c_canonicalized, c_values = canonicalize_token(
-                    child_token)
-            else:
-                c_normalized, c_canonicalized, c_values = ('', '', [])
+                canonicalize_token(child_token, out)
         else:
-            c_normalized, c_canonicalized, c_values = canonicalize_token(
-                child_token)
-        normalized += c_normalized
-        canonicalized += c_canonicalized
-        for c_value in c_values:
-            values.append(c_value)
-
-    return (normalized, canonicalized, values)
+            canonicalize_token(child_token, out)
 
-def canonicalizer_where(token):
+def canonicalizer_where(token, out):
     """
     Canonicalizes where clause.
 
@@ -576,50 +786,37 @@ def canonicalizer_where(token):
 
     assert token.is_group()
 
-    normalized = ''
-    canonicalized = ''
-    values = []
-
     found_in_keyword = False
     found_new_keyword_after_in_keyword = False
 
-    for child_token in token.tokens:
+    for __, child_token, next_child_token, prev_nonws_token, next_nonws_token in \
+            token_neighbours(token.tokens):
         #print 'child_token.ttype = {0}'.format(child_token.ttype)
         #print 'type(child_token) = {0}'.format(type(child_token))
         #print 'child_token.normalized = <{0}>'.format(child_token.normalized)
         #print 'child_token child tokens: {0}'.format(child_token.tokens if child_token.is_group() else None)
-        child_token_index = token.token_index(child_token)
-        next_child_token = token.token_next(child_token_index, skip_ws=False)
-        next_nonws_token = token.token_next(child_token_index)
-        prev_nonws_token = token.token_prev(child_token_index)
         if (child_token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline) and
             (
                 (next_child_token and next_child_token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline)) or
                 (next_nonws_token and next_nonws_token.ttype in (Token.Operator.Comparison,)) or
                 (prev_nonws_token and prev_nonws_token.ttype in (Token.Operator.Comparison,))
                 )):
-            c_normalized, c_canonicalized, c_values = ('', '', [])
+            pass
         elif COLLAPSE_TARGET_PARTS and child_token.ttype in (Token.Keyword,):
             if child_token.normalized == 'IN':
                 found_in_keyword = True
             else:
                 if found_in_keyword:
                     found_new_keyword_after_in_keyword = True
-            c_normalized, c_canonicalized, c_values = canonicalize_token(child_token)
+            canonicalize_token(child_token, out)
         elif COLLAPSE_TARGET_PARTS and child_token.is_group() and\
              type(child_token) is sqlparse.sql.Parenthesis and\
              found_in_keyword and not found_new_keyword_after_in_keyword:
-            c_normalized, c_canonicalized, c_values = ('(N)', '(N)', [])
+            out.append('(N)', '(N)')
         else:
-            c_normalized, c_canonicalized, c_values = canonicalize_token(child_token)
-        normalized += c_normalized
-        canonicalized += c_canonicalized
-        for c_value in c_values:
-            values.append(c_value)
-
-    return (normalized, canonicalized, values)
+            canonicalize_token(child_token, out)
 
-def canonicalizer_identifier_list(token):
+def canonicalizer_identifier_list(token, out):
     """
     Canonicalizes IdentifierList token.
 
@@ -628,23 +825,11 @@ def canonicalizer_identifier_list(token):
 
     assert token.is_group()
 
-    normalized = ''
-    canonicalized = ''
-    values = []
-
     for child_token in token.tokens:
-        if child_token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline):
-            c_normalized, c_canonicalized, c_values = ('', '', [])
-        else:
-            c_normalized, c_canonicalized, c_values = canonicalize_token(child_token)
-        normalized += c_normalized
-        canonicalized += c_canonicalized
-        for c_value in c_values:
-            values.append(c_value)
-
-    return (normalized, canonicalized, values)
+        if child_token.ttype not in (Token.Text.Whitespace, Token.Text.Whitespace.Newline):
+            canonicalize_token(child_token, out)
 
-def canonicalizer_comparison(token):
+def canonicalizer_comparison(token, out):
     """
     Canonicalizes Comparison token.
 
@@ -653,27 +838,15 @@ def canonicalizer_comparison(token):
 
     assert token.is_group()
 
-    normalized = ''
-    canonicalized = ''
-    values = []
-
     for child_token in token.tokens:
-        if child_token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline):
-            c_normalized, c_canonicalized, c_values = ('', '', [])
-        else:
-            c_normalized, c_canonicalized, c_values = canonicalize_token(child_token)
-        normalized += c_normalized
-        canonicalized += c_canonicalized
-        for c_value in c_values:
-            values.append(c_value)
-
-    return (normalized, canonicalized, values)
+        if child_token.ttype not in (Token.Text.Whitespace, Token.Text.Whitespace.Newline):
+            canonicalize_token(child_token, out)
 
 SQL_FUNCTIONS = ('AVG', 'BIT_AND', 'BIT_OR', 'BIT_XOR', 'COUNT', 'GROUP_CONCAT',
                  'MAX', 'MIN', 'STD', 'STDDEV_POP', 'STDDEV_SAMP', 'STDDEV', 'SUM',
                  'VAR_POP', 'VAR_SAMP', 'VARIANCE', )
 
-def canonicalizer_function(token):
+def canonicalizer_function(token, out):
     """
     Canonicalizes Function token.
 
@@ -684,28 +857,15 @@ def canonicalizer_function(token):
     #print 'canonicalizer_function'
     assert token.is_group()
 
-    normalized = ''
-    canonicalized = ''
-    values = []
-
     for child_token in token.tokens:
         if type(child_token) is sqlparse.sql.Identifier:
             name = child_token.normalized
             if name.upper() in SQL_FUNCTIONS:
-                c_normalized, c_canonicalized, c_values = (
-                    name.upper(), name.upper(), [])
+                out.append(name.upper(), name.upper())
             else:
-                c_normalized, c_canonicalized, c_values = (name, name, [])
-        elif child_token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline):
-            c_normalized, c_canonicalized, c_values = ('', '', [])
-        else:
-            c_normalized, c_canonicalized, c_values = canonicalize_token(child_token)
-        normalized += c_normalized
-        canonicalized += c_canonicalized
-        for c_value in c_values:
-            values.append(c_value)
-
-    return (normalized, canonicalized, values)
+                out.append(name, name)
+        elif child_token.ttype not in (Token.Text.Whitespace, Token.Text.Whitespace.Newline):
+            canonicalize_token(child_token, out)
 
 CANONICALIZERS_BY_CLASS_TYPE = {
     sqlparse.sql.Parenthesis: canonicalizer_parenthesis,
@@ -716,9 +876,11 @@ CANONICALIZERS_BY_CLASS_TYPE = {
     }
 
 
-def canonicalize_token(token):
+def canonicalize_token(token, out):
     """
     Canonicalize a sql statement token.
+
+    Appends the results to out, a CanonicalizerOutput.
     """
 
     #print 'token.ttype = {0}'.format(token.ttype)
@@ -726,26 +888,17 @@ def canonicalize_token(token):
     #print 'token.normalized = <{0}>'.format(token.normalized)
     #print 'child tokens: {0}'.format(token.tokens if token.is_group() else None)
 
-    normalized = ''
-    canonicalized = ''
-    values = []
     if token.ttype and CANONICALIZERS.has_key(token.ttype):
-        normalized, canonicalized, values = CANONICALIZERS[token.ttype](token)
+        CANONICALIZERS[token.ttype](token, out)
     elif token.is_group():
         if CANONICALIZERS_BY_CLASS_TYPE.has_key(type(token)):
-            normalized, canonicalized, values = CANONICALIZERS_BY_CLASS_TYPE[type(token)](token)
+            CANONICALIZERS_BY_CLASS_TYPE[type(token)](token, out)
         else:
             for child_token in token.tokens:
-                c_normalized, c_canonicalized, c_values = canonicalize_token(child_token)
-                normalized += c_normalized
-                canonicalized += c_canonicalized
-                for c_value in c_values:
-                    values.append(c_value)
+                canonicalize_token(child_token, out)
     else:
         # no assigned canonicalizer for token? use default
-        normalized, canonicalized, values = canonicalizer_default(token)
-
-    return (normalized, canonicalized, values)
+        canonicalizer_default(token, out)
 
 def canonicalizer_statement_insert(stmt):
     """
@@ -754,29 +907,24 @@ def canonicalizer_statement_insert(stmt):
 
     assert stmt.get_type() == 'INSERT'
 
-    normalized = u''
-    canonicalized = u''
-    values = []
+    out = CanonicalizerOutput()
 
     found_values_keyword = False
     first_parenthesis_after_values_keyword = None
     found_new_keyword_afer_values_keyword = False
 
-    for token in stmt.tokens:
+    for prev_token, token, next_token, __, __ in token_neighbours(stmt.tokens):
         #print 'token.ttype = {0}'.format(token.ttype)
         #print 'type(token) = {0}'.format(type(token))
         #print 'token.normalized = <{0}>'.format(token.normalized)
         #print 'child tokens: {0}'.format(token.tokens if token.is_group() else None)
 
-        token_index = stmt.token_index(token)
-        next_token = stmt.token_next(token_index, skip_ws=False)
-        prev_token = stmt.token_prev(token_index, skip_ws=False)
         if (token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline) and
             next_token and
             next_token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline)):
-            t_normalized, t_canonicalized, t_values = (u'', u'', [])
+            pass
         elif (type(token) is sqlparse.sql.Identifier) and prev_token.ttype in (Token.Operator,):
-            t_normalized, t_canonicalized, t_values = (token.normalized, token.normalized, [])
+            out.append(token.normalized, token.normalized)
         elif COLLAPSE_TARGET_PARTS and token.ttype in (Token.Keyword,):
             if token.normalized == u'VALUES':
                 found_values_keyword = True
@@ -784,7 +932,7 @@ def canonicalizer_statement_insert(stmt):
             else:
                 if found_values_keyword:
                     found_new_keyword_afer_values_keyword = True
-            t_normalized, t_canonicalized, t_values = canonicalize_token(token)
+            canonicalize_token(token, out)
         elif COLLAPSE_TARGET_PARTS and token.is_group() and\
              type(token) is sqlparse.sql.Parenthesis and\
              found_values_keyword and not found_new_keyword_afer_values_keyword:
@@ -792,19 +940,14 @@ def canonicalizer_statement_insert(stmt):
             if not first_parenthesis_after_values_keyword:
                 first_parenthesis_after_values_keyword = token
             if first_parenthesis_after_values_keyword == token:
-                t_normalized, t_canonicalized, t_values = (u'(N)', u'(N)', [])
-            else:
-                t_normalized, t_canonicalized, t_values = (u'', u'', [])
+                out.append(u'(N)', u'(N)')
         elif COLLAPSE_TARGET_PARTS and token.ttype in (Token.Punctuation,)\
              and found_values_keyword and not found_new_keyword_afer_values_keyword:
-            t_normalized, t_canonicalized, t_values = (u'', u'', [])
+            pass
         else:
-            t_normalized, t_canonicalized, t_values = canonicalize_token(token)
-        normalized += t_normalized
-        canonicalized += t_canonicalized
-        for t_value in t_values:
-            values.append(t_value)
+            canonicalize_token(token, out)
 
+    normalized, canonicalized, values = out.join()
     normalized = query_strip(normalized)
     canonicalized = query_strip(canonicalized)
 
@@ -818,301 +961,2610 @@ def query_strip(query):
     return unicode(query.strip(stripped_chars))
 
 
-def canonicalize_statement(statement):
+def canonicalize_parsed_statement(stmt):
     """
-    Canonicalizes statement(s).
+    Canonicalizes a single statement parsed by sqlparse.
 
-    Returns a list of
+    Returns
         (
             stripped original statement,
             normalized statement,
             canonicalized statement,
             values for canonicalized statement
         )
+    or None if the statement is skipped.
     """
 
-    statement = query_strip(statement)
+    #print 'stmt => {0} <='.format(stmt)
+    #print 'stmt.tokens => {0}'.format(stmt.tokens)
+    if stmt.get_type() == 'INSERT':
+        #print 'stmt.get_type() => {0}'.format(stmt.get_type())
+        stmt_normalized, stmt_canonicalized, stmt_values = canonicalizer_statement_insert(stmt)
+        return (u'{0}'.format(stmt), stmt_normalized, stmt_canonicalized, stmt_values)
+    elif stmt.get_type() == STATEMENT_UNKNOWN:
+        if OPTIONS.no_skip_unknowns:
+            #print 'UNKNOWN: => {0} <='.format(stmt)
+            return (u'{0}'.format(stmt), u'{0}'.format(stmt), STATEMENT_UNKNOWN, [])
+        return None
+
+    out = CanonicalizerOutput()
+    for prev_token, token, next_token, __, __ in token_neighbours(stmt.tokens):
+        if (token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline) and
+            next_token and
+            next_token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline)):
+            pass
+        elif (type(token) is sqlparse.sql.Identifier) and prev_token.ttype in (Token.Operator,):
+            out.append(token.normalized, token.normalized)
+        else:
+            canonicalize_token(token, out)
 
-    result = []
-    parsed = sqlparse.parse(statement)
-
-    for stmt in parsed:
-        #print 'stmt => {0} <='.format(stmt)
-        #print 'stmt.tokens => {0}'.format(stmt.tokens)
-        if stmt.get_type() == 'INSERT':
-            #print 'stmt.get_type() => {0}'.format(stmt.get_type())
-            stmt_normalized, stmt_canonicalized, stmt_values = canonicalizer_statement_insert(stmt)
-            result.append((u'{0}'.format(stmt), stmt_normalized, stmt_canonicalized, stmt_values))
-            continue
-        elif stmt.get_type() == STATEMENT_UNKNOWN:
-            if OPTIONS.no_skip_unknowns:
-                #print 'UNKNOWN: => {0} <='.format(stmt)
-                result.append(
-                    (u'{0}'.format(stmt), u'{0}'.format(stmt), STATEMENT_UNKNOWN, [])
-                )
-            continue
+    normalized, canonicalized, values = out.join()
+    normalized = query_strip(normalized)
+    canonicalized = query_strip(canonicalized)
 
-        normalized = u''
-        canonicalized = u''
-        values = []
-        for token in stmt.tokens:
-            token_index = stmt.token_index(token)
-            next_token = stmt.token_next(token_index, skip_ws=False)
-            prev_token = stmt.token_prev(token_index, skip_ws=False)
-            if (token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline) and
-                next_token and
-                next_token.ttype in (Token.Text.Whitespace, Token.Text.Whitespace.Newline)):
-                t_normalized, t_canonicalized, t_values = (u'', u'', [])
-            elif (type(token) is sqlparse.sql.Identifier) and prev_token.ttype in (Token.Operator,):
-                t_normalized, t_canonicalized, t_values = (token.normalized, token.normalized, [])
-            else:
-                t_normalized, t_canonicalized, t_values = canonicalize_token(token)
-            normalized += t_normalized
-            canonicalized += t_canonicalized
-            for t_value in t_values:
-                values.append(t_value)
-
-        normalized = query_strip(normalized)
-        canonicalized = query_strip(canonicalized)
-
-        result.append((
-            query_strip(u'{0}'.format(stmt)),
-            normalized,
-            canonicalized,
-            values))
-    return result
+    return (
+        query_strip(u'{0}'.format(stmt)),
+        normalized,
+        canonicalized,
+        values)
 
 
-class QueryLogItemParser(object):
-    """Query log item parser."""
+def sqlparse_canonicalize_statement_offsets(statement):
+    """
+    Canonicalizes statement(s) with the sqlparse engine.
 
-    def __init__(self):
-        super(QueryLogItemParser, self).__init__()
+    See canonicalize_statement_offsets().
+    """
 
-        self.dt = None
-        self.query_time = None
-        self.lock_time = None
-        self.rows_sent = None
-        self.rows_examined = None
-        self.statement = None
+    result = []
+    end = 0
+    for stmt in sqlparse.parse(statement):
+        # sqlparse keeps every character, so the statements are
+        # consecutive slices of the input
+        start = end
+        end += len(unicode(stmt))
+        item = canonicalize_parsed_statement(stmt)
+        if item:
+            result.append((start, end, item))
+    return result
 
-        self.line_header_data = []
-        self.header_data = {}
 
-    def parse_statement(self, lines_to_parse):
-        self.statement = lines_to_parse.strip(' ;')
-        return self.statement
+# Rules of the root state of the sqlparse lexer, in the same order.
+# A rule with a token type of None matches keywords and names.
+LEXER_RULES = (
+    (r'--.*?(?:\r\n|\r|\n)', Token.Comment.Single),
+    (r'--.*?$', Token.Comment.Single),
+    (r'(?:\r|\n|\r\n)', Token.Text.Whitespace.Newline),
+    (r'\s+', Token.Text.Whitespace),
+    (r'/\*', Token.Comment.Multiline),
+    (r':=', sqlparse.tokens.Assignment),
+    (r'::', Token.Punctuation),
+    (r'[*]', Token.Wildcard),
+    (r'CASE\b', Token.Keyword),
+    (r'`(?:``|[^`])*`', Token.Name),
+    (ur'\u00b4(?:\u00b4\u00b4|[^\u00b4])*\u00b4', Token.Name),
+    (r'\$(?:[^\W\d]\w*)?\$', Token.Name.Builtin),
+    (r'\?', Token.Name.Placeholder),
+    (r'[$:?%]\w+', Token.Name.Placeholder),
+    (r'VALUES', Token.Keyword),
+    (r'@[^\W\d_]\w+', Token.Name),
+    (r'[^\W\d_]\w*(?=[.(])', Token.Name),
+    (r'-?0x[0-9a-f]+', Token.Literal.Number.Hexadecimal),
+    (r'-?[0-9]*\.[0-9]+', Token.Literal.Number.Float),
+    (r'-?[0-9]+', Token.Literal.Number.Integer),
+    (r"''|'.*?[^\\]'", Token.Literal.String.Single),
+    (r'""|".*?[^\\]"', Token.Literal.String.Symbol),
+    (r'\[.*[^\]]\]', Token.Name),
+    (r'(?:LEFT |RIGHT )?(?:INNER |OUTER )?JOIN\b', Token.Keyword),
+    (r'END(?: IF| LOOP)?\b', Token.Keyword),
+    (r'NOT NULL\b', Token.Keyword),
+    (r'CREATE(?: OR REPLACE)?\b', Token.Keyword.DDL),
+    (r'(?<=\.)[^\W\d_]\w*', Token.Name),
+    (r'[^\W\d_]\w*', None),
+    (r'[;:()\[\],.]', Token.Punctuation),
+    (r'[<>=~!]+', Token.Operator.Comparison),
+    (r'[+/@#%^&|`?^-]+', Token.Operator),
+    )
+
+LEXER_PATTERN = re.compile(
+    u'|'.join(u'(?P<r{0}>{1})'.format(index, rule)
+        for index, (rule, __) in enumerate(LEXER_RULES)),
+    re.IGNORECASE | re.UNICODE)
+
+LEXER_RULE_TYPES = dict(
+    ('r{0}'.format(index), ttype)
+    for index, (__, ttype) in enumerate(LEXER_RULES))
+
+# rules of the multiline comment state of the sqlparse lexer
+LEXER_COMMENT_PATTERN = re.compile(
+    r'(?P<open>/\*)|(?P<close>\*/)|[^/*]+|[/*]', re.UNICODE)
+
+LEXER_WHITESPACE_TYPES = (Token.Text.Whitespace, Token.Text.Whitespace.Newline)
+
+# keywords ending a WHERE clause
+LEXER_WHERE_STOPWORDS = ('ORDER', 'GROUP', 'LIMIT', 'UNION')
+
+# token types allowed around the operator of a comparison
+LEXER_COMPARISON_TYPES = (
+    Token.Literal.String.Symbol, Token.Name, Token.Literal.Number,
+    Token.Literal.Number.Integer, Token.Literal)
+
+# token types allowed as items of an identifier list
+LEXER_LIST_ITEM_TYPES = (
+    Token.Name, Token.Wildcard, Token.Literal.Number.Integer,
+    Token.Literal.String.Single, Token.Name.Placeholder, Token.Keyword)
+
+LEXER_LIST_ITEM_KINDS = (
+    'Identifier', 'Function', 'Case', 'Comparison', 'Comment')
+
+
+class LexerToken(object):
+    """Token of the lexer engine, mirrors sqlparse.sql.Token."""
+
+    __slots__ = ('ttype', 'value', 'normalized', 'start', 'end')
+
+    kind = None
+
+    def __init__(self, ttype, value, start):
+        self.ttype = ttype
+        self.value = value
+        if ttype in Token.Keyword:
+            self.normalized = value.upper()
+        else:
+            self.normalized = value
+        self.start = start
+        self.end = start + len(value)
 
 
-def process_packet(pktlen, data, timestamp):
-    if not data:
-        return
+class LexerGroup(object):
+    """
+    Group of tokens of the lexer engine, mirrors sqlparse.sql.TokenList.
 
-    print 'pktlen:', pktlen, 'dt:', (
-        datetime.datetime.fromtimestamp(timestamp))
-    stack = ip_stack.parse(data)
-    payload = stack.next.next.next
-    print payload
-    print
+    kind is the name of the matching sqlparse.sql class. Like sqlparse,
+    value is the text the group had when it was created, it does not
+    follow tokens added to the group later.
+    """
 
-    try:
-        # MySQL queries start on the 6th char (?)
-        payload = payload[5:]
-        log_item_parser = QueryLogItemParser()
-        if log_item_parser.parse_statement(payload):
-            print log_item_parser.statement
-            if log_item_parser.statement and log_item_parser.statement.strip():
-                DataManager.save_data(log_item_parser)
+    __slots__ = ('kind', 'tokens', 'source', 'start', 'end')
 
-    except Exception, e:
-        print 'ERROR: {0}'.format(e)
+    ttype = None
 
+    def __init__(self, kind, tokens, source):
+        self.kind = kind
+        self.tokens = tokens
+        self.source = source
+        self.start = tokens[0].start
+        self.end = tokens[-1].end
 
-def run_packet_sniffer():
+    @property
+    def value(self):
+        return self.source[self.start:self.end]
 
-    p = pcap.pcapObject()
-    dev = OPTIONS.interface
-    net, mask = pcap.lookupnet(dev)
-    print 'net:', net, 'mask:', mask
+    normalized = value
 
-    # sample dev:
-    #     eth0
-    #     wlan0
-    #     lo
-    p.open_live(dev, 1600, 0, 100)
 
-    # sample filter:
-    #     dst port 3306
-    # see: http://www.manpagez.com/man/7/pcap-filter/
-    p.setfilter(OPTIONS.filter, 0, 0)
+def lexer_tokenize(statement):
+    """
+    Splits statement into LexerTokens the way the sqlparse lexer does.
 
-    print 'Press CTRL+C to end capture'
-    try:
-        while True:
-            p.dispatch(1, process_packet)
-    except KeyboardInterrupt:
-        print # Empty line where ^C from CTRL+C is displayed
-        print '%s' % sys.exc_type
-        print 'shutting down'
-        print '%d packets received, %d packets dropped, %d packets dropped by interface' % p.stats()
+    Unlike sqlparse, statement is not read in 4 KB chunks, so tokens are
+    never split at chunk boundaries.
+    """
 
+    tokens = []
+    # like sqlparse, the token type given to a keyword or name is reused
+    # for every later token with the same value
+    known_names = {}
+    comment_depth = 0
+    pos = 0
+    length = len(statement)
+    while pos < length:
+        if comment_depth:
+            match = LEXER_COMMENT_PATTERN.match(statement, pos)
+            if match.lastgroup == 'open':
+                comment_depth += 1
+            elif match.lastgroup == 'close':
+                comment_depth -= 1
+            ttype = Token.Comment.Multiline
+        else:
+            match = LEXER_PATTERN.match(statement, pos)
+            if match is None:
+                tokens.append(LexerToken(Token.Error, statement[pos], pos))
+                pos += 1
+                continue
+            ttype = LEXER_RULE_TYPES[match.lastgroup]
+            if ttype is Token.Comment.Multiline:
+                comment_depth = 1
+        value = match.group()
+        if value in known_names:
+            ttype = known_names[value]
+        elif ttype is None:
+            upper = value.upper()
+            ttype = KEYWORDS_COMMON.get(
+                upper, KEYWORDS.get(upper, Token.Name))
+            known_names[value] = ttype
+        tokens.append(LexerToken(ttype, value, pos))
+        pos = match.end()
+    return tokens
+
+
+def lexer_split_statements(tokens):
+    """
+    Splits LexerTokens into statements the way sqlparse does.
 
-class SlowQueryLogItemParser(object):
-    """Slow query log item parser."""
+    Returns a list of token lists.
+    """
 
-    def __init__(self):
-        super(SlowQueryLogItemParser, self).__init__()
+    statements = []
+    statement = None
+    consume_ws = False
+    split_level = 0
+    in_declare = in_dbldollar = is_create = False
+    begin_depth = 0
+    for token in tokens:
+        ttype = token.ttype
+        if consume_ws and ttype not in (
+                Token.Text.Whitespace, Token.Comment.Single):
+            statement = None
+        if statement is None:
+            statement = []
+            statements.append(statement)
+            consume_ws = False
+            split_level = 0
+            in_declare = in_dbldollar = is_create = False
+            begin_depth = 0
+
+        value = token.value
+        if (ttype == Token.Name.Builtin and value.startswith('$')
+                and value.endswith('$')):
+            in_dbldollar = not in_dbldollar
+            split_level += 1 if in_dbldollar else -1
+        elif not in_dbldollar and ttype in Token.Keyword:
+            unified = value.upper()
+            if unified == 'DECLARE' and is_create:
+                in_declare = True
+                split_level += 1
+            elif unified == 'BEGIN':
+                begin_depth += 1
+                if in_declare or is_create:
+                    split_level += 1
+            elif unified == 'END':
+                begin_depth = max(0, begin_depth - 1)
+                split_level -= 1
+            elif ttype is Token.Keyword.DDL and unified.startswith('CREATE'):
+                is_create = True
+            elif (unified in ('IF', 'FOR') and is_create
+                    and begin_depth > 0):
+                split_level += 1
+
+        statement.append(token)
+        if split_level <= 0 and ttype is Token.Punctuation and value == ';':
+            consume_ws = True
+    return statements
+
+
+def lexer_match(token, ttype, values):
+    """
+    Same as sqlparse.sql.Token.match() for LexerTokens and LexerGroups.
 
-        self.dt = None
-        self.query_time = None
-        self.lock_time = None
-        self.rows_sent = None
-        self.rows_examined = None
-        self.statement = None
+    Keyword values have to be given in upper case.
+    """
 
-        self.line_time_info = None
-        self.line_user_info = None
-        self.line_statement = None
-        self.line_administrator_command = None
+    if token.ttype is not ttype:
+        return False
+    if values is None:
+        return True
+    if isinstance(values, basestring):
+        values = (values,)
+    if ttype in Token.Keyword:
+        return token.normalized in values
+    return token.value in values
 
-        self.line_header_data = []
-        self.header_data = {}
 
-    def parse_time_info(self, line):
-        """Parses time info."""
+def lexer_is_whitespace(token):
+    return token.ttype in LEXER_WHITESPACE_TYPES
 
-        #__, __, date_str, time_str = line.split()
-        #self.dt = datetime.datetime.strptime(
-        #    ' '.join([date_str, time_str]), '%y%m%d %H:%M:%S')
-        dt_str = line[7:]
-        try:
-            self.dt = datetime_parse(dt_str)
-        except Exception, e:
-            print '%s' % (e,)
 
-    def parse_user_info(self, line):
-        """Parses user info."""
+def lexer_next_index(tokens, index):
+    """Returns the index of the next non whitespace token or None."""
 
-        # Just store it for now.
-        self.line_user_info = line
+    index += 1
+    while index < len(tokens):
+        if not lexer_is_whitespace(tokens[index]):
+            return index
+        index += 1
+    return None
 
-    def parse_administrator_command(self, line):
-        # Just store it for now
-        self.line_administator_command = line
 
-    def parse_header_data(self, line, source):
-        """Parses header data."""
+def lexer_prev_index(tokens, index):
+    """Returns the index of the previous non whitespace token or None."""
 
-        self.line_header_data = []
-        self.header_data = {}
-        while True:
-            # make sure it starts with #
-            if line.startswith('#'):
-                self.line_header_data.append(line)
-                if line.startswith('# Time'):
-                    self.parse_time_info(line)
-                elif line.startswith('# User@Host'):
-                    self.parse_user_info(line)
-                elif line.startswith('# administrator command'):
-                    self.parse_administrator_command(line)
-                else:
-                    line = line[1:]
-                    words = [word.lower().strip().rstrip(':')
-                        for word in line.split()]
-                    i = iter(words)
-                    self.header_data.update(dict(itertools.izip(i, i)))
-                line = source.readline()
-            else:
-                # Line does not start with #,
-                # this means that this is the end of the variables
-                # section, we exit the loop and return the last line
-                # read so that the next parser can process it.
-                break
-        # be sure to return the last line read
-        return line
+    index -= 1
+    while index >= 0:
+        if not lexer_is_whitespace(tokens[index]):
+            return index
+        index -= 1
+    return None
 
-    def parse_statement(self, line, source):
-        """Parses statement."""
 
-        statement = line
+def lexer_sublists(group, skipped_kinds=()):
+    return [token for token in group.tokens
+        if token.kind is not None and token.kind not in skipped_kinds]
 
-        # statement could span multiple lines
-        while True:
-            line = source.readline()
-            if line:
-                if line.rstrip().endswith('started with:'):
-                    break
 
-                if line.startswith('#'):
-                    # this is the start of another query header
-                    break
-                else:
-                    # add this line to statement
-                    statement += line
-            else:
-                break
+def lexer_group_matching(group, start, end, kind, include_semicolon=False):
+    """
+    Groups tokens from start to the matching end token.
 
-        self.statement = statement
+    Same as sqlparse.engine.grouping._group_matching(), start and end are
+    (token type, value) pairs.
+    """
 
-        # make sure to return the last read line from file
+    tokens = group.tokens
+    stack = [[]]
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        index += 1
+        if lexer_match(token, *start):
+            stack.append([token])
+        elif len(stack) > 1 and lexer_match(token, *end):
+            grouped = stack.pop()
+            grouped.append(token)
+            if include_semicolon:
+                next_index = lexer_next_index(tokens, index - 1)
+                if (next_index is not None and
+                        lexer_match(tokens[next_index], Token.Punctuation, ';')):
+                    grouped.extend(tokens[index:next_index + 1])
+                    index = next_index + 1
+            stack[-1].append(LexerGroup(kind, grouped, group.source))
+        else:
+            stack[-1].append(token)
+    # tokens of unmatched start tokens stay where they are
+    while len(stack) > 1:
+        grouped = stack.pop()
+        stack[-1].extend(grouped)
+    group.tokens = stack[0]
+
+
+def lexer_group_left_right(group, ttype, value, kind,
+        check_left=lambda token: True, check_right=lambda token: True,
+        include_semicolon=False):
+    """
+    Groups tokens around an operator.
+
+    Same as sqlparse.engine.grouping._group_left_right().
+    """
+
+    for sublist in lexer_sublists(group, (kind,)):
+        lexer_group_left_right(sublist, ttype, value, kind,
+            check_left, check_right, include_semicolon)
+
+    tokens = group.tokens
+    next_semicolons = None
+    result = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if lexer_match(token, ttype, value):
+            right_index = lexer_next_index(tokens, index)
+            left_index = lexer_prev_index(result, len(result))
+            if (right_index is not None and check_right(tokens[right_index])
+                    and left_index is not None
+                    and check_left(result[left_index])):
+                if include_semicolon:
+                    if next_semicolons is None:
+                        next_semicolons = [None] * len(tokens)
+                        next_semicolon = None
+                        for i in xrange(len(tokens) - 1, -1, -1):
+                            if lexer_match(tokens[i], Token.Punctuation, ';'):
+                                next_semicolon = i
+                            next_semicolons[i] = next_semicolon
+                    if next_semicolons[right_index] is not None:
+                        right_index = next_semicolons[right_index]
+                left = result[left_index]
+                grouped = result[left_index + 1:]
+                grouped.extend(tokens[index:right_index + 1])
+                if left.kind != kind:
+                    left = LexerGroup(kind, [left], group.source)
+                left.tokens.extend(grouped)
+                del result[left_index:]
+                result.append(left)
+                index = right_index + 1
+                continue
+        result.append(token)
+        index += 1
+    group.tokens = result
+
+
+def lexer_group_comments(group):
+    for sublist in lexer_sublists(group, ('Comment',)):
+        lexer_group_comments(sublist)
+
+    tokens = group.tokens
+    result = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token.ttype is not None and token.ttype in Token.Comment:
+            end = index + 1
+            while end < len(tokens) and (
+                    lexer_is_whitespace(tokens[end]) or
+                    (tokens[end].ttype is not None and
+                        tokens[end].ttype in Token.Comment)):
+                end += 1
+            if end == len(tokens):
+                # comments and whitespaces up to the end are not grouped
+                result.extend(tokens[index:])
+                break
+            result.append(LexerGroup('Comment', tokens[index:end], group.source))
+            index = end
+            continue
+        result.append(token)
+        index += 1
+    group.tokens = result
+
+
+def lexer_group_parenthesis(group):
+    lexer_group_matching(group,
+        (Token.Punctuation, '('), (Token.Punctuation, ')'), 'Parenthesis')
+
+
+def lexer_group_functions(group):
+    for sublist in lexer_sublists(group, ('Function',)):
+        lexer_group_functions(sublist)
+
+    tokens = group.tokens
+    result = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token.ttype is not None and token.ttype in Token.Name:
+            next_index = lexer_next_index(tokens, index)
+            if (next_index is not None and
+                    tokens[next_index].kind == 'Parenthesis'):
+                result.append(LexerGroup('Function',
+                    tokens[index:next_index + 1], group.source))
+                index = next_index + 1
+                continue
+        result.append(token)
+        index += 1
+    group.tokens = result
+
+
+def lexer_group_where(group):
+    for sublist in lexer_sublists(group, ('Where',)):
+        lexer_group_where(sublist)
+
+    tokens = group.tokens
+    if group.kind == 'Parenthesis':
+        last_index = len(tokens) - 2
+    else:
+        last_index = len(tokens) - 1
+    result = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if lexer_match(token, Token.Keyword, 'WHERE'):
+            end = index + 1
+            while (end < len(tokens) and not
+                    lexer_match(tokens[end], Token.Keyword,
+                        LEXER_WHERE_STOPWORDS)):
+                end += 1
+            if end == len(tokens):
+                end = last_index + 1
+            while end > index + 1 and lexer_is_whitespace(tokens[end - 1]):
+                end -= 1
+            result.append(LexerGroup('Where', tokens[index:end], group.source))
+            index = end
+            continue
+        result.append(token)
+        index += 1
+    group.tokens = result
+
+
+def lexer_group_case(group):
+    for sublist in lexer_sublists(group):
+        lexer_group_matching(sublist,
+            (Token.Keyword, 'CASE'), (Token.Keyword, 'END'), 'Case', True)
+    lexer_group_matching(group,
+        (Token.Keyword, 'CASE'), (Token.Keyword, 'END'), 'Case', True)
+
+
+def lexer_is_identifier_separator(token):
+    return (lexer_match(token, Token.Punctuation, '.')
+        or token.ttype is Token.Operator
+        or token.ttype is Token.Wildcard)
+
+
+def lexer_is_identifier_part(token):
+    return token.ttype in (
+        Token.Literal.String.Symbol, Token.Literal.String.Single, Token.Name,
+        Token.Wildcard, Token.Literal.Number.Integer)
+
+
+def lexer_group_identifier(group):
+    for sublist in lexer_sublists(group, ('Identifier',)):
+        lexer_group_identifier(sublist)
+
+    tokens = group.tokens
+    result = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token.ttype in (Token.Literal.String.Symbol,
+                Token.Literal.String.Single, Token.Name) or \
+                token.kind == 'Function':
+            end = index + 1
+            expect_separator = True
+            while end < len(tokens):
+                part = tokens[end]
+                if part.ttype is not Token.Text.Whitespace:
+                    if expect_separator:
+                        if not lexer_is_identifier_separator(part):
+                            break
+                    elif not lexer_is_identifier_part(part):
+                        break
+                    expect_separator = not expect_separator
+                end += 1
+            if end - index > 1 and tokens[end - 1].ttype is Token.Text.Whitespace:
+                end -= 1
+            if end - index > 1 or token.kind != 'Function':
+                result.append(LexerGroup(
+                    'Identifier', tokens[index:end], group.source))
+                index = end
+                continue
+        result.append(token)
+        index += 1
+    group.tokens = result
+
+
+def lexer_group_order(group):
+    result = []
+    for token in group.tokens:
+        if token.ttype is not None and token.ttype in Token.Keyword.Order:
+            prev_index = lexer_prev_index(result, len(result))
+            if prev_index is not None and result[prev_index].kind == 'Identifier':
+                grouped = result[prev_index:]
+                grouped.append(token)
+                del result[prev_index:]
+                token = LexerGroup('Identifier', grouped, group.source)
+        result.append(token)
+    group.tokens = result
+
+
+def lexer_group_typecasts(group):
+    lexer_group_left_right(group, Token.Punctuation, '::', 'Identifier')
+
+
+def lexer_group_as(group):
+    lexer_group_left_right(group, Token.Keyword, 'AS', 'Identifier',
+        check_left=lambda token: token.ttype is not Token.Keyword,
+        check_right=lambda token: token.ttype not in (
+            Token.Keyword.DML, Token.Keyword.DDL))
+
+
+def lexer_group_aliased(group):
+    kinds = ('Identifier', 'Function', 'Case')
+    for sublist in lexer_sublists(group, kinds):
+        lexer_group_aliased(sublist)
+
+    tokens = group.tokens
+    result = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        index += 1
+        if token.kind in kinds:
+            next_index = lexer_next_index(tokens, index - 1)
+            if (next_index is not None and tokens[next_index].kind in kinds
+                    and not tokens[next_index].value.upper().startswith(
+                        'VARCHAR')):
+                token.tokens.extend(tokens[index:next_index + 1])
+                index = next_index + 1
+        result.append(token)
+    group.tokens = result
+
+
+def lexer_group_assignment(group):
+    lexer_group_left_right(group, sqlparse.tokens.Assignment, ':=',
+        'Assignment', include_semicolon=True)
+
+
+def lexer_is_comparison_part(token):
+    return (token.ttype in LEXER_COMPARISON_TYPES
+        or token.kind == 'Identifier')
+
+
+def lexer_group_comparison(group):
+    lexer_group_left_right(group, Token.Operator.Comparison, None,
+        'Comparison', check_left=lexer_is_comparison_part,
+        check_right=lexer_is_comparison_part)
+
+
+def lexer_is_list_item(token):
+    return (token.kind in LEXER_LIST_ITEM_KINDS
+        or token.ttype in LEXER_LIST_ITEM_TYPES)
+
+
+def lexer_next_comma_index(tokens, index):
+    index += 1
+    while index < len(tokens):
+        if lexer_match(tokens[index], Token.Punctuation, ','):
+            return index
+        index += 1
+    return None
+
+
+def lexer_group_identifier_list(group):
+    for sublist in lexer_sublists(group, ('IdentifierList',)):
+        lexer_group_identifier_list(sublist)
+
+    tokens = group.tokens
+    lists = []
+    # end of the last identifier list found, tokens up to it are grouped
+    grouped_end = -1
+    start = None
+    comma = lexer_next_comma_index(tokens, -1)
+    while comma is not None:
+        before = lexer_prev_index(tokens, comma)
+        after = lexer_next_index(tokens, comma)
+        if (before is None or before <= grouped_end
+                or not lexer_is_list_item(tokens[before])
+                or after is None or not lexer_is_list_item(tokens[after])):
+            start = None
+            comma = lexer_next_comma_index(tokens, comma)
+            continue
+        if start is None:
+            start = before
+        next_index = lexer_next_index(tokens, after)
+        if (next_index is None or
+                not lexer_match(tokens[next_index], Token.Punctuation, ',')):
+            lists.append((start, after))
+            grouped_end = after
+            start = None
+            comma = lexer_next_comma_index(tokens, after)
+        else:
+            comma = next_index
+
+    if lists:
+        result = []
+        index = 0
+        for start, end in lists:
+            result.extend(tokens[index:start])
+            result.append(LexerGroup(
+                'IdentifierList', tokens[start:end + 1], group.source))
+            index = end + 1
+        result.extend(tokens[index:])
+        group.tokens = result
+
+
+def lexer_group_if(group):
+    lexer_group_matching(group,
+        (Token.Keyword, 'IF'), (Token.Keyword, 'END IF'), 'If', True)
+
+
+def lexer_group_for(group):
+    lexer_group_matching(group,
+        (Token.Keyword, 'FOR'), (Token.Keyword, 'END LOOP'), 'For', True)
+
+
+# grouping steps, in the order sqlparse.engine.grouping.group() runs them
+LEXER_GROUPINGS = (
+    lexer_group_comments,
+    lexer_group_parenthesis,
+    lexer_group_functions,
+    lexer_group_where,
+    lexer_group_case,
+    lexer_group_identifier,
+    lexer_group_order,
+    lexer_group_typecasts,
+    lexer_group_as,
+    lexer_group_aliased,
+    lexer_group_assignment,
+    lexer_group_comparison,
+    lexer_group_identifier_list,
+    lexer_group_if,
+    lexer_group_for,
+    )
+
+
+def lexer_canonicalize_tokens(tokens, out, skip_whitespace=False):
+    """
+    Canonicalizes tokens one after the other into out.
+
+    Whitespaces are canonicalized to empty string if skip_whitespace is True.
+    """
+
+    for token in tokens:
+        if skip_whitespace and token.ttype in LEXER_WHITESPACE_TYPES:
+            continue
+        lexer_canonicalize_token(token, out)
+
+
+def lexer_canonicalizer_parenthesis(token, out):
+    """Same as canonicalizer_parenthesis() for LexerGroups."""
+
+    tokens = token.tokens
+    for index, child_token in enumerate(tokens):
+        if child_token.ttype in LEXER_WHITESPACE_TYPES:
+            # maintain a single space if previous or next token is a keyword
+            if ((index and tokens[index - 1].ttype == Token.Keyword) or
+                    (index + 1 < len(tokens) and
+                        tokens[index + 1].ttype == Token.Keyword)):
+                out.append(u' ', u' ')
+            continue
+        lexer_canonicalize_token(child_token, out)
+
+
+def lexer_canonicalizer_where(token, out):
+    """Same as canonicalizer_where() for LexerGroups."""
+
+    tokens = token.tokens
+
+    # token types of the previous and next non whitespace tokens
+    prev_types = []
+    prev_type = None
+    for child_token in tokens:
+        prev_types.append(prev_type)
+        if not lexer_is_whitespace(child_token):
+            prev_type = child_token.ttype
+    next_types = []
+    next_type = None
+    for child_token in reversed(tokens):
+        next_types.append(next_type)
+        if not lexer_is_whitespace(child_token):
+            next_type = child_token.ttype
+    next_types.reverse()
+
+    found_in_keyword = False
+    found_new_keyword_after_in_keyword = False
+    for index, child_token in enumerate(tokens):
+        if (child_token.ttype in LEXER_WHITESPACE_TYPES and (
+                (index + 1 < len(tokens) and
+                    tokens[index + 1].ttype in LEXER_WHITESPACE_TYPES) or
+                next_types[index] == Token.Operator.Comparison or
+                prev_types[index] == Token.Operator.Comparison)):
+            continue
+        elif COLLAPSE_TARGET_PARTS and child_token.ttype == Token.Keyword:
+            if child_token.normalized == 'IN':
+                found_in_keyword = True
+            elif found_in_keyword:
+                found_new_keyword_after_in_keyword = True
+            lexer_canonicalize_token(child_token, out)
+        elif (COLLAPSE_TARGET_PARTS and child_token.kind == 'Parenthesis' and
+                found_in_keyword and not found_new_keyword_after_in_keyword):
+            out.append(u'(N)', u'(N)')
+        else:
+            lexer_canonicalize_token(child_token, out)
+
+
+def lexer_canonicalizer_whitespace_free(token, out):
+    """Same as canonicalizer_identifier_list() and canonicalizer_comparison()."""
+
+    lexer_canonicalize_tokens(token.tokens, out, skip_whitespace=True)
+
+
+def lexer_canonicalizer_function(token, out):
+    """Same as canonicalizer_function() for LexerGroups."""
+
+    for child_token in token.tokens:
+        if child_token.kind == 'Identifier':
+            name = child_token.normalized
+            if name.upper() in SQL_FUNCTIONS:
+                name = name.upper()
+            out.append(name, name)
+        elif child_token.ttype not in LEXER_WHITESPACE_TYPES:
+            lexer_canonicalize_token(child_token, out)
+
+
+LEXER_CANONICALIZERS_BY_KIND = {
+    'Parenthesis': lexer_canonicalizer_parenthesis,
+    'IdentifierList': lexer_canonicalizer_whitespace_free,
+    'Comparison': lexer_canonicalizer_whitespace_free,
+    'Function': lexer_canonicalizer_function,
+    'Where': lexer_canonicalizer_where,
+    }
+
+
+def lexer_canonicalize_token(token, out):
+    """Same as canonicalize_token() for LexerTokens and LexerGroups."""
+
+    if token.kind is None:
+        if token.ttype in CANONICALIZERS:
+            CANONICALIZERS[token.ttype](token, out)
+        else:
+            canonicalizer_default(token, out)
+    elif token.kind in LEXER_CANONICALIZERS_BY_KIND:
+        LEXER_CANONICALIZERS_BY_KIND[token.kind](token, out)
+    else:
+        lexer_canonicalize_tokens(token.tokens, out)
+
+
+def lexer_canonicalize_parsed_statement(stmt):
+    """
+    Same as canonicalize_parsed_statement() for a statement LexerGroup.
+
+    Handles insert statements like canonicalizer_statement_insert() does.
+    """
+
+    tokens = stmt.tokens
+    stmt_type = STATEMENT_UNKNOWN
+    for token in tokens:
+        if not lexer_is_whitespace(token):
+            if token.ttype in (Token.Keyword.DML, Token.Keyword.DDL):
+                stmt_type = token.normalized
+            break
+
+    if stmt_type == STATEMENT_UNKNOWN:
+        if OPTIONS.no_skip_unknowns:
+            return (stmt.value, stmt.value, STATEMENT_UNKNOWN, [])
+        return None
+    is_insert = (stmt_type == 'INSERT')
+
+    out = CanonicalizerOutput()
+
+    found_values_keyword = False
+    found_parenthesis_after_values_keyword = False
+    found_new_keyword_afer_values_keyword = False
+
+    for index, token in enumerate(tokens):
+        collapse = (COLLAPSE_TARGET_PARTS and found_values_keyword and
+            not found_new_keyword_afer_values_keyword)
+        if (token.ttype in LEXER_WHITESPACE_TYPES and
+                index + 1 < len(tokens) and
+                tokens[index + 1].ttype in LEXER_WHITESPACE_TYPES):
+            continue
+        elif (token.kind == 'Identifier' and index and
+                tokens[index - 1].ttype == Token.Operator):
+            out.append(token.normalized, token.normalized)
+        elif is_insert and COLLAPSE_TARGET_PARTS and token.ttype == Token.Keyword:
+            if token.normalized == u'VALUES':
+                found_values_keyword = True
+            elif found_values_keyword:
+                found_new_keyword_afer_values_keyword = True
+            lexer_canonicalize_token(token, out)
+        elif is_insert and collapse and token.kind == 'Parenthesis':
+            if not found_parenthesis_after_values_keyword:
+                found_parenthesis_after_values_keyword = True
+                out.append(u'(N)', u'(N)')
+        elif is_insert and collapse and token.ttype == Token.Punctuation:
+            continue
+        else:
+            lexer_canonicalize_token(token, out)
+
+    normalized, canonicalized, values = out.join()
+    original = stmt.value
+    if not is_insert:
+        original = query_strip(original)
+    return (
+        original,
+        query_strip(normalized),
+        query_strip(canonicalized),
+        values)
+
+
+def lexer_canonicalize_statement_offsets(statement):
+    """
+    Canonicalizes statement(s) with the lexer engine.
+
+    The lexer engine reproduces the tokens and groups of sqlparse the
+    canonicalizers depend on in a single pass per grouping step, instead
+    of the repeated list scans of sqlparse. Returns the same results as
+    sqlparse_canonicalize_statement_offsets().
+    """
+
+    if isinstance(statement, str):
+        # same decoding as sqlparse
+        try:
+            statement = statement.decode('utf-8')
+        except UnicodeDecodeError:
+            statement = statement.decode('unicode-escape')
+
+    result = []
+    tokens = lexer_tokenize(statement)
+    for stmt_tokens in lexer_split_statements(tokens):
+        stmt = LexerGroup('Statement', stmt_tokens, statement)
+        for grouping in LEXER_GROUPINGS:
+            grouping(stmt)
+        item = lexer_canonicalize_parsed_statement(stmt)
+        if item:
+            result.append((stmt.start, stmt.end, item))
+    return result
+
+
+# canonicalization engines, see canonicalize_statement_offsets()
+CANONICALIZATION_ENGINES = {
+    'sqlparse': sqlparse_canonicalize_statement_offsets,
+    'lexer': lexer_canonicalize_statement_offsets,
+    }
+
+# name of the canonicalization engine in use
+CANONICALIZATION_ENGINE = 'sqlparse'
+
+# version of sqlparse whose lexer and grouping the lexer engine
+# reimplements, other versions may canonicalize statements differently
+LEXER_SQLPARSE_VERSION = '0.1.7'
+
+
+def canonicalize_statement_offsets(statement):
+    """
+    Canonicalizes statement(s) and locates each of them in statement.
+
+    Uses the canonicalization engine named by CANONICALIZATION_ENGINE.
+
+    Returns a list of
+        (
+            start offset of the statement,
+            end offset of the statement,
+            canonicalize_parsed_statement() result
+        )
+    for every statement that is not skipped.
+    """
+
+    return CANONICALIZATION_ENGINES[CANONICALIZATION_ENGINE](statement)
+
+
+def canonicalize_statement(statement):
+    """
+    Canonicalizes statement(s).
+
+    Returns a list of
+        (
+            stripped original statement,
+            normalized statement,
+            canonicalized statement,
+            values for canonicalized statement
+        )
+    """
+
+    statement = query_strip(statement)
+    return FINGERPRINT_CACHE.canonicalize(statement)
+
+
+# Rules of the root state of the sqlparse lexer, in the same order, so that
+# number and string literals are found exactly where sqlparse finds them.
+# Only the literals are captured, everything else is part of the shape of
+# the statement.
+FINGERPRINT_PATTERN = re.compile(u'|'.join((
+    r'--.*?(?:\r\n|\r|\n)',
+    r'--.*?$',
+    r'\s+',
+    r'/\*[\s\S]*?\*/',
+    r':=',
+    r'::',
+    r'[*]',
+    ur'`(?:``|[^`])*`',
+    ur'\u00b4(?:\u00b4\u00b4|[^\u00b4])*\u00b4',
+    r'\$(?:[^\W\d]\w*)?\$',
+    r'\?',
+    r'[$:?%]\w+',
+    r'@[^\W\d_]\w+',
+    r'-?0x[0-9a-f]+',
+    r'(?P<f>-?[0-9]*\.[0-9]+)',
+    r'(?P<i>-?[0-9]+)',
+    r"(?P<s>''|'.*?[^\\]')",
+    r'(?P<q>""|".*?[^\\]")',
+    r'\[.*[^\]]\]',
+    r'[^\W\d_]\w*',
+    r'[;:()\[\],.]',
+    r'[<>=~!]+',
+    r'[+/@#%^&|`?^-]+',
+    )), re.IGNORECASE | re.UNICODE)
+
+# token types of the literals captured by FINGERPRINT_PATTERN
+FINGERPRINT_LITERAL_TYPES = {
+    'i': Token.Literal.Number.Integer,
+    'f': Token.Literal.Number.Float,
+    's': Token.Literal.String.Single,
+    'q': Token.Literal.String.Symbol,
+    }
+
+# literals used when probing a new statement shape, formatted with the
+# position of the literal so that every probe literal is unique
+FINGERPRINT_PROBE_LITERALS = {
+    'i': u'9%06d7',
+    'f': u'9%06d7.25',
+    's': u"'sqlcanonprobe%06d'",
+    'q': u'"sqlcanonprobe%06d"',
+    }
+
+# maximum number of statement shapes kept by the fingerprint cache,
+# 0 disables the cache
+FINGERPRINT_CACHE_SIZE = 4096
+
+
+def fingerprint_statement(statement):
+    """
+    Splits statement into its shape and its literals.
+
+    Returns (key, literals), key identifies the shape of the statement
+    (the statement with its number and string literals masked) and
+    literals is a list of (start offset, end offset, kind) of each literal.
+    """
+
+    literals = []
+    fixed = []
+    kinds = []
+    pos = 0
+    for match in FINGERPRINT_PATTERN.finditer(statement):
+        kind = match.lastgroup
+        if kind:
+            start, end = match.span()
+            fixed.append(statement[pos:start])
+            kinds.append(kind)
+            literals.append((start, end, kind))
+            pos = end
+    fixed.append(statement[pos:])
+    return (tuple(fixed), ''.join(kinds)), literals
+
+
+def canonicalize_literal(kind, raw):
+    """
+    Canonicalizes a literal found by fingerprint_statement().
+
+    Returns data in this format (normalized literal, canonicalized literal, values)
+    """
+
+    token = sqlparse.sql.Token(FINGERPRINT_LITERAL_TYPES[kind], raw)
+    out = CanonicalizerOutput()
+    CANONICALIZERS[token.ttype](token, out)
+    return out.join()
+
+
+class FingerprintCache(object):
+    """
+    Bounded LRU cache of canonicalized statement shapes.
+
+    Statements that differ only in their number and string literals share
+    a shape. The first statement of a shape is canonicalized as usual and
+    a template of the result is kept, later statements of the same shape
+    are canonicalized from the template without being parsed.
+    """
+
+    def __init__(self, max_size=FINGERPRINT_CACHE_SIZE):
+        super(FingerprintCache, self).__init__()
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self):
+        """Removes all shapes and resets the counters."""
+
+        # Maps shape keys to the links of a circular doubly linked list
+        # ordered from least to most recently used.
+        # A link is a [previous link, next link, key, templates] list,
+        # templates is None for shapes that could not be templated.
+        self._links = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+        self.hits = 0
+        self.misses = 0
+
+    def resize(self, max_size):
+        """Sets the maximum number of shapes kept, clears the cache."""
+
+        self.max_size = max_size
+        self.clear()
+
+    def __len__(self):
+        return len(self._links)
+
+    def _get(self, key):
+        link = self._links.get(key)
+        if link is not None:
+            # move link to the most recently used end
+            link_prev, link_next = link[0], link[1]
+            link_prev[1] = link_next
+            link_next[0] = link_prev
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+        return link
+
+    def _put(self, key, templates):
+        root = self._root
+        if len(self._links) >= self.max_size:
+            # evict least recently used shape
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self._links[oldest[2]]
+        last = root[0]
+        link = [last, root, key, templates]
+        last[1] = root[0] = link
+        self._links[key] = link
+
+    def canonicalize(self, statement):
+        """Canonicalizes stripped statement(s), see canonicalize_statement()."""
+
+        if self.max_size <= 0:
+            return [item for __, __, item in
+                canonicalize_statement_offsets(statement)]
+
+        key, literals = fingerprint_statement(statement)
+        link = self._get(key)
+        if link is not None and link[3] is not None:
+            self.hits += 1
+            return self._apply_templates(statement, literals, link[3])
+
+        self.misses += 1
+        offsets = canonicalize_statement_offsets(statement)
+        if link is None:
+            # shapes that could not be templated are kept too,
+            # so that they are not probed again
+            self._put(key, self._build_templates(statement, literals, offsets))
+        return [item for __, __, item in offsets]
+
+    @staticmethod
+    def _offset(literals, position):
+        """Converts a (fixed part index, offset in part) position to an offset."""
+
+        index, offset = position
+        if index:
+            return literals[index - 1][1] + offset
+        return offset
+
+    @staticmethod
+    def _position(literals, offset):
+        """
+        Converts an offset to a (fixed part index, offset in part) position.
+
+        Returns None if offset is inside a literal.
+        """
+
+        index = 0
+        part_start = 0
+        for start, end, __ in literals:
+            if offset <= start:
+                break
+            if offset < end:
+                return None
+            index += 1
+            part_start = end
+        return (index, offset - part_start)
+
+    def _apply_templates(self, statement, literals, templates):
+        canonicalized_literals = {}
+        result = []
+        for (start, end, strip_original, normalized_parts, normalized_slots,
+             canonicalized, value_slots) in templates:
+            original = statement[
+                self._offset(literals, start):self._offset(literals, end)]
+            if strip_original:
+                original = query_strip(original)
+
+            for index in normalized_slots + value_slots:
+                if index not in canonicalized_literals:
+                    literal_start, literal_end, kind = literals[index]
+                    canonicalized_literals[index] = canonicalize_literal(
+                        kind, statement[literal_start:literal_end])
+
+            normalized = [normalized_parts[0]]
+            for index, part in itertools.izip(
+                    normalized_slots, normalized_parts[1:]):
+                normalized.append(canonicalized_literals[index][0])
+                normalized.append(part)
+
+            values = []
+            for index in value_slots:
+                values.extend(canonicalized_literals[index][2])
+
+            result.append((original, u''.join(normalized), canonicalized, values))
+        return result
+
+    def _build_templates(self, statement, literals, offsets):
+        """
+        Builds the templates of the shape of statement.
+
+        The statement is canonicalized once more with every literal replaced
+        by a unique probe literal, following the probe literals through the
+        result tells where each literal ends up. Returns None if the shape
+        can not be templated.
+        """
+
+        probe_parts = []
+        probe_literals = []
+        pos = 0
+        length = 0
+        for index, (start, end, kind) in enumerate(literals):
+            fixed = statement[pos:start]
+            raw = FINGERPRINT_PROBE_LITERALS[kind] % (index,)
+            if statement[start] == '-':
+                raw = '-' + raw
+            probe_parts.append(fixed)
+            probe_parts.append(raw)
+            length += len(fixed)
+            probe_literals.append((length, length + len(raw), kind))
+            length += len(raw)
+            pos = end
+        probe_parts.append(statement[pos:])
+        probe = u''.join(probe_parts)
+        if literals:
+            probe_offsets = canonicalize_statement_offsets(probe)
+        else:
+            probe_offsets = offsets
+
+        canonicalized_probe_literals = [
+            canonicalize_literal(kind, probe[start:end])
+            for start, end, kind in probe_literals]
+        value_indexes = {}
+        for index, (__, __, values) in enumerate(canonicalized_probe_literals):
+            for value in values:
+                value_indexes[value] = index
+
+        templates = []
+        for start, end, item in probe_offsets:
+            original, normalized, canonicalized, values = item
+
+            start = self._position(probe_literals, start)
+            end = self._position(probe_literals, end)
+            if start is None or end is None:
+                return None
+            text = probe[
+                self._offset(probe_literals, start):
+                self._offset(probe_literals, end)]
+            if original == text:
+                strip_original = False
+            elif original == query_strip(text):
+                strip_original = True
+            else:
+                return None
+
+            found = []
+            for index, (literal_normalized, __, __) in enumerate(
+                    canonicalized_probe_literals):
+                if literal_normalized in canonicalized:
+                    # literal is kept as is in the canonicalized statement
+                    return None
+                count = normalized.count(literal_normalized)
+                if count > 1:
+                    return None
+                if count:
+                    found.append((normalized.index(literal_normalized), index))
+            found.sort()
+
+            normalized_parts = []
+            normalized_slots = []
+            pos = 0
+            for at, index in found:
+                if at < pos:
+                    return None
+                normalized_parts.append(normalized[pos:at])
+                normalized_slots.append(index)
+                pos = at + len(canonicalized_probe_literals[index][0])
+            normalized_parts.append(normalized[pos:])
+
+            value_slots = []
+            for value in values:
+                if value not in value_indexes:
+                    return None
+                value_slots.append(value_indexes[value])
+
+            templates.append((
+                start, end, strip_original, normalized_parts, normalized_slots,
+                canonicalized, value_slots))
+
+        # the templates have to reproduce the statement they were built for
+        expected = [item for __, __, item in offsets]
+        if self._apply_templates(statement, literals, templates) != expected:
+            return None
+        return templates
+
+
+FINGERPRINT_CACHE = FingerprintCache()
+
+
+class QueryLogItemParser(object):
+    """Query log item parser."""
+
+    def __init__(self):
+        super(QueryLogItemParser, self).__init__()
+
+        self.dt = None
+        self.query_time = None
+        self.lock_time = None
+        self.rows_sent = None
+        self.rows_examined = None
+        self.statement = None
+
+        self.line_header_data = []
+        self.header_data = {}
+
+    def parse_statement(self, lines_to_parse):
+        self.statement = lines_to_parse.strip(' ;')
+        return self.statement
+
+
+def process_packet(pktlen, data, timestamp):
+    if not data:
+        return
+
+    print 'pktlen:', pktlen, 'dt:', (
+        datetime.datetime.fromtimestamp(timestamp))
+    stack = ip_stack.parse(data)
+    payload = stack.next.next.next
+    print payload
+    print
+
+    try:
+        # MySQL queries start on the 6th char (?)
+        payload = payload[5:]
+        log_item_parser = QueryLogItemParser()
+        if log_item_parser.parse_statement(payload):
+            print log_item_parser.statement
+            if log_item_parser.statement and log_item_parser.statement.strip():
+                DataManager.save_data(log_item_parser)
+
+    except Exception, e:
+        print 'ERROR: {0}'.format(e)
+
+
+def run_packet_sniffer():
+
+    p = pcap.pcapObject()
+    dev = OPTIONS.interface
+    net, mask = pcap.lookupnet(dev)
+    print 'net:', net, 'mask:', mask
+
+    # sample dev:
+    #     eth0
+    #     wlan0
+    #     lo
+    p.open_live(dev, 1600, 0, 100)
+
+    # sample filter:
+    #     dst port 3306
+    # see: http://www.manpagez.com/man/7/pcap-filter/
+    p.setfilter(OPTIONS.filter, 0, 0)
+
+    print 'Press CTRL+C to end capture'
+    try:
+        while True:
+            p.dispatch(1, process_packet)
+    except KeyboardInterrupt:
+        print # Empty line where ^C from CTRL+C is displayed
+        print '%s' % sys.exc_type
+        print 'shutting down'
+        print '%d packets received, %d packets dropped, %d packets dropped by interface' % p.stats()
+
+
+# last (datetime string, datetime) parsed by parse_slow_log_datetime()
+_last_slow_log_datetime = (None, None)
+
+def parse_slow_log_datetime(dt_str):
+    """
+    Parses the datetime of a '# Time:' line of MySQL slow query log.
+
+    The yymmdd hh:mm:ss format of MySQL 5.5 and older is parsed with
+    strptime, other formats with dateutil. Consecutive log items often
+    share their datetime, the last one parsed is reused then.
+    """
+
+    global _last_slow_log_datetime
+    if dt_str == _last_slow_log_datetime[0]:
+        return _last_slow_log_datetime[1]
+    try:
+        dt = datetime.datetime.strptime(dt_str.strip(), '%y%m%d %H:%M:%S')
+    except ValueError:
+        dt = datetime_parse(dt_str)
+    _last_slow_log_datetime = (dt_str, dt)
+    return dt
+
+
+class SlowQueryLogItemParser(object):
+    """Slow query log item parser."""
+
+    def __init__(self):
+        super(SlowQueryLogItemParser, self).__init__()
+
+        self.dt = None
+        self.query_time = None
+        self.lock_time = None
+        self.rows_sent = None
+        self.rows_examined = None
+        self.statement = None
+
+        self.line_time_info = None
+        self.line_user_info = None
+        self.line_statement = None
+        self.line_administrator_command = None
+
+        self.line_header_data = []
+        self.header_data = {}
+
+        # byte offsets of the log item in the log, if known
+        self.start_offset = None
+        self.end_offset = None
+
+    def parse_time_info(self, line):
+        """Parses time info."""
+
+        dt_str = line[7:]
+        try:
+            self.dt = parse_slow_log_datetime(dt_str)
+        except Exception, e:
+            print '%s' % (e,)
+
+    def parse_user_info(self, line):
+        """Parses user info."""
+
+        # Just store it for now.
+        self.line_user_info = line
+
+    def parse_administrator_command(self, line):
+        # Just store it for now
+        self.line_administator_command = line
+
+    def parse_header_data(self, line, source):
+        """Parses header data."""
+
+        self.line_header_data = []
+        self.header_data = {}
+        while True:
+            # make sure it starts with #
+            if line.startswith('#'):
+                self.line_header_data.append(line)
+                if line.startswith('# Time'):
+                    self.parse_time_info(line)
+                elif line.startswith('# User@Host'):
+                    self.parse_user_info(line)
+                elif line.startswith('# administrator command'):
+                    self.parse_administrator_command(line)
+                else:
+                    line = line[1:]
+                    words = [word.lower().strip().rstrip(':')
+                        for word in line.split()]
+                    i = iter(words)
+                    self.header_data.update(dict(itertools.izip(i, i)))
+                line = source.readline()
+            else:
+                # Line does not start with #,
+                # this means that this is the end of the variables
+                # section, we exit the loop and return the last line
+                # read so that the next parser can process it.
+                break
+        # be sure to return the last line read
+        return line
+
+    def parse_statement(self, line, source):
+        """
+        Parses statement.
+
+        Lines read as bytes are decoded once the whole statement is read,
+        header lines are left as they are.
+        """
+
+        statement = [line]
+
+        # statement could span multiple lines
+        while True:
+            line = source.readline()
+            if line:
+                if line.rstrip().endswith('started with:'):
+                    break
+
+                if line.startswith('#'):
+                    # this is the start of another query header
+                    break
+                else:
+                    # add this line to statement
+                    statement.append(line)
+            else:
+                break
+
+        statement = ''.join(statement)
+        if isinstance(statement, str):
+            statement = get_unicode_string(statement)
+        self.statement = statement
+
+        # make sure to return the last read line from file
+        return line
+
+
+def get_unicode_string(s):
+    try:
+        return s.decode(OPTIONS.encoding, OPTIONS.encoding_errors)
+    except Exception, e:
+        print 'Exception type: {0}, text: {1}'.format(type(e), e)
+        return s
+
+
+def iter_chunks(iterable, size):
+    """Yields lists of up to size consecutive items of iterable."""
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def canonicalize_log_statement(statement):
+    """
+    Canonicalizes and hashes the statement of a log item.
+
+    Returns (DataManager.canonicalize_data() items, error message or None).
+    """
+
+    data = []
+    error = None
+    try:
+        for item in DataManager.canonicalize_data(statement):
+            data.append(item)
+    except Exception, e:
+        error = str(e)
+    return (data, error)
+
+
+def canonicalize_log_statements(statements):
+    """
+    Canonicalizes and hashes the statements of log items, in a worker process.
+
+    Returns (results, fingerprint cache hits, fingerprint cache misses),
+    results has a canonicalize_log_statement() result for every statement.
+    """
+
+    hits = FINGERPRINT_CACHE.hits
+    misses = FINGERPRINT_CACHE.misses
+    results = [canonicalize_log_statement(statement)
+        for statement in statements]
+    return (results, FINGERPRINT_CACHE.hits - hits,
+            FINGERPRINT_CACHE.misses - misses)
+
+
+def canonicalize_log_shard(path, start, end):
+    """
+    Parses and canonicalizes the slow query log items between byte offsets
+    start and end of file path, in a worker process.
+
+    Returns (results, fingerprint cache hits, fingerprint cache misses),
+    results has a (SlowQueryLogItemParser, canonicalize_log_statement()
+    result) pair for every log item.
+    """
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        source = io.BytesIO(f.read(end - start))
+
+    hits = FINGERPRINT_CACHE.hits
+    misses = FINGERPRINT_CACHE.misses
+    results = []
+    for log_item_parser in SlowQueryLogProcessor().read_log_items(
+            source, offsets=True):
+        log_item_parser.start_offset += start
+        log_item_parser.end_offset += start
+        results.append(
+            (log_item_parser,
+             canonicalize_log_statement(log_item_parser.statement)))
+    return (results, FINGERPRINT_CACHE.hits - hits,
+            FINGERPRINT_CACHE.misses - misses)
+
+
+def find_log_item_start(data, offset):
+    """
+    Returns the offset of the first slow query log item starting at or
+    after offset in data, a str or mmap of the log, len(data) if there is
+    none.
+
+    A log item starts with a '# Time:' or '# User@Host:' line that does not
+    follow another header line.
+    """
+
+    size = len(data)
+    if offset <= 0:
+        return 0
+    pos = offset - 1
+    while True:
+        pos = data.find('\n#', pos)
+        if pos < 0:
+            return size
+        pos += 1
+        if (data[pos:pos + 7] == '# Time:' or
+                data[pos:pos + 12] == '# User@Host:'):
+            prev_line_start = data.rfind('\n', 0, pos - 1) + 1
+            if data[prev_line_start:prev_line_start + 1] != '#':
+                return pos
+
+
+# size in bytes of the read buffer of log files
+LOG_READ_BUFFER_SIZE = 1024 * 1024
+
+# seconds between checks for rotation of a followed log file, and for new
+# data when inotify is not available
+LOG_FOLLOW_POLL_INTERVAL = 1.0
+
+# minimum number of seconds between saves of the checkpoint of a log file
+LOG_CHECKPOINT_INTERVAL = 1.0
+
+
+class InotifyFileWatcher(object):
+    """Waits for changes of a file with Linux inotify."""
+
+    # IN_MODIFY | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENTS = 0x00000002 | 0x00000004 | 0x00000400 | 0x00000800
+
+    def __init__(self, path):
+        super(InotifyFileWatcher, self).__init__()
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        if libc.inotify_add_watch(self.fd, path, self.EVENTS) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        if select.select([self.fd], [], [], timeout)[0]:
+            # the file changed, the events themselves do not matter
+            os.read(self.fd, 4096)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingFileWatcher(object):
+    """Waits for changes of a file by sleeping."""
+
+    def __init__(self, path):
+        super(PollingFileWatcher, self).__init__()
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+
+def create_file_watcher(path):
+    """Returns an inotify watcher of path if available, a polling one otherwise."""
+
+    try:
+        return InotifyFileWatcher(path)
+    except (AttributeError, OSError, TypeError):
+        return PollingFileWatcher(path)
+
+
+# how far a log file was processed: inode of the file, offset and length of
+# the last log item processed and mmh3 hash of its bytes
+LogCheckpoint = collections.namedtuple(
+    'LogCheckpoint', 'inode offset length hash')
+
+
+class LogCheckpointFile(object):
+    """Saves log checkpoints in a JSON file."""
+
+    def __init__(self, path):
+        super(LogCheckpointFile, self).__init__()
+        self.path = path
+        self._checkpoints = None
+
+    def _load(self):
+        if self._checkpoints is None:
+            try:
+                with open(self.path) as f:
+                    self._checkpoints = json.load(f)
+            except (IOError, ValueError):
+                self._checkpoints = {}
+        return self._checkpoints
+
+    def load_log_checkpoint(self, log_path):
+        """Returns the LogCheckpoint of log_path, None if there is none."""
+
+        checkpoint = self._load().get(log_path)
+        if checkpoint:
+            return LogCheckpoint(**checkpoint)
+        return None
+
+    def save_log_checkpoint(self, log_path, checkpoint):
+        # the statements before the checkpoint are sent before it
+        ServerData.flush()
+        checkpoints = self._load()
+        checkpoints[log_path] = checkpoint._asdict()
+        # replace the file at once, a crash leaves either version
+        tmp_path = '{0}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoints, f)
+        os.rename(tmp_path, self.path)
+
+
+class LogCheckpointer(object):
+    """
+    Keeps track of how far a log file was processed, to resume from there.
+
+    resume() gives the offset following the last log item processed, if the
+    log file still has that log item there. The log processor calls
+    processed() for every log item, a LogCheckpoint of the last one is then
+    saved to checkpoints every interval seconds, and by save(). An interval
+    of 0 saves a checkpoint for every log item.
+    """
+
+    def __init__(self, path, checkpoints, interval=LOG_CHECKPOINT_INTERVAL):
+        super(LogCheckpointer, self).__init__()
+        self.path = os.path.abspath(path)
+        self.checkpoints = checkpoints
+        self.interval = interval
+        self.file = None
+        # (start offset, end offset) of the last log item processed, and
+        # of the last one saved
+        self.item = None
+        self.saved_item = None
+        self.saved_time = 0
+
+    def resume(self, f):
+        """Tracks log file f, returns the offset to read it from."""
+
+        self.track(f)
+        checkpoint = self.checkpoints.load_log_checkpoint(self.path)
+        if checkpoint is None:
+            return 0
+        st = os.fstat(f.fileno())
+        end = checkpoint.offset + checkpoint.length
+        if checkpoint.inode != st.st_ino or end > st.st_size:
+            return 0
+        f.seek(checkpoint.offset)
+        if mmh3.hash(f.read(checkpoint.length)) != checkpoint.hash:
+            # the log file was rewritten
+            return 0
+        self.item = self.saved_item = (checkpoint.offset, end)
+        print (
+            'Resuming {0} from offset {1}, where it was processed up to the '
+            'last time.'.format(self.path, end))
+        return end
+
+    def track(self, f):
+        """
+        Tracks log file f, read from its start. The checkpoint of the log
+        file tracked before is saved before closing it.
+        """
+
+        self.file = f
+        self.item = self.saved_item = None
+
+    def processed(self, start, end):
+        """Marks the log item between offsets start and end as processed."""
+
+        self.item = (start, end)
+        if time.time() - self.saved_time >= self.interval:
+            self.save()
+
+    def save(self):
+        if self.item is None or self.item == self.saved_item:
+            return
+        start, end = self.item
+        st = os.fstat(self.file.fileno())
+        if st.st_size < end:
+            # truncated, the log item is gone
+            return
+        if end > start:
+            data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                item_hash = mmh3.hash(data[start:end])
+            finally:
+                data.close()
+        else:
+            item_hash = mmh3.hash('')
+        self.checkpoints.save_log_checkpoint(
+            self.path, LogCheckpoint(st.st_ino, start, end - start, item_hash))
+        self.saved_item = self.item
+        self.saved_time = time.time()
+
+
+class FollowedLogFile(object):
+    """
+    A log file read by LogFollower, until it is rotated or truncated.
+
+    readline() returns complete lines, waiting for the rest of a line being
+    written. It returns '' once the file was rotated or truncated and read
+    to its end, or the follower was stopped. It also returns '' when
+    nothing was written for a while, paused is True then and the file is
+    read again: MySQL writes whole log items, the last one read is complete.
+    """
+
+    def __init__(self, follower, f, offset):
+        super(FollowedLogFile, self).__init__()
+        self.follower = follower
+        self.file = f
+        self.inode = os.fstat(f.fileno()).st_ino
+        # offset of the end of the last line read
+        self.offset = offset
+        self.ended = False
+        self.paused = False
+        # number of waits since the last data read
+        self.waits = 0
+        self.watcher = create_file_watcher(follower.path)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def readline(self):
+        parts = []
+        self.paused = False
+        while True:
+            if self.follower.stopped:
+                # an incomplete line is read again when following resumes
+                parts = []
+                break
+            part = self.file.readline()
+            if part:
+                parts.append(part)
+                self.waits = 0
+                if part.endswith('\n'):
+                    break
+            elif self.ended:
+                break
+            elif self.follower.is_replaced(self):
+                # read what was written before the file was replaced
+                self.ended = True
+            elif not parts and self.waits == 1:
+                self.waits += 1
+                self.paused = True
+                break
+            else:
+                self.follower.wait(self)
+                self.waits += 1
+        line = ''.join(parts)
+        self.offset += len(line)
         return line
 
+    def tell(self):
+        return self.offset
+
+    def is_truncated(self):
+        return os.fstat(self.file.fileno()).st_size < self.file.tell()
+
+    def close(self):
+        self.watcher.close()
+        self.file.close()
+
+
+class LogFollower(object):
+    """
+    Follows a MySQL log file as it is written, like tail -F.
+
+    sources() yields a FollowedLogFile for the log file, again every time
+    reading it pauses, and a new one every time the log file is rotated
+    (replaced by a new file, by FLUSH LOGS after the log file was moved
+    away for instance) or truncated.
+
+    Following resumes from the last checkpoint of checkpointer, a
+    LogCheckpointer, which is saved when there is nothing left to read,
+    when the log file is replaced and on close().
+    """
+
+    def __init__(self, path, checkpointer=None,
+            poll_interval=LOG_FOLLOW_POLL_INTERVAL):
+        super(LogFollower, self).__init__()
+        self.path = path
+        self.checkpointer = checkpointer
+        self.poll_interval = poll_interval
+        self.stopped = False
+        self.source = None
+
+    def sources(self):
+        resume = True
+        while not self.stopped:
+            f = self.open()
+            if f is None:
+                break
+            offset = 0
+            if self.checkpointer is None:
+                pass
+            elif resume:
+                offset = self.checkpointer.resume(f)
+            else:
+                self.checkpointer.track(f)
+            resume = False
+            f.seek(offset)
+            self.source = FollowedLogFile(self, f, offset)
+            try:
+                yield self.source
+                while self.source.paused:
+                    yield self.source
+            finally:
+                self.close_source()
+
+    def open(self):
+        """Opens the log file once it exists, returns None if stopped before."""
+
+        while not self.stopped:
+            try:
+                return io.open(self.path, 'rb', LOG_READ_BUFFER_SIZE)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self.wait(None)
+        return None
+
+    def is_replaced(self, source):
+        """Returns True if the log file of source was rotated or truncated."""
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # moved away, MySQL writes to it until the logs are flushed
+            return False
+        return st.st_ino != source.inode or source.is_truncated()
+
+    def wait(self, source):
+        """Waits for source to change, or for the log file to be created."""
+
+        DataManager.flush_statement_data()
+        if self.checkpointer is not None:
+            self.checkpointer.save()
+        if source is None:
+            time.sleep(self.poll_interval)
+        else:
+            source.watcher.wait(self.poll_interval)
+
+    def stop(self):
+        self.stopped = True
+
+    def close_source(self):
+        if self.source is None:
+            return
+        if self.checkpointer is not None:
+            self.checkpointer.save()
+        self.source.close()
+        self.source = None
+
+    def close(self):
+        self.stop()
+        self.close_source()
+
+
+def create_log_checkpointer():
+    """
+    Returns the LogCheckpointer of OPTIONS.file, None if log checkpoints are
+    not used.
+
+    Checkpoints are used when following the log file, or with
+    OPTIONS.resume. They are saved in the local database in stand-alone
+    mode, in OPTIONS.checkpoint_file otherwise. They are not used with
+    OPTIONS.no_spool: a request that fails without the spool is not sent
+    again, the checkpoint saved after it would skip its statements.
+    """
+
+    if not OPTIONS.file or OPTIONS.no_checkpoints:
+        return None
+    if not OPTIONS.follow and not OPTIONS.resume:
+        # a one-shot run processes the whole log file
+        return None
+    if not OPTIONS.follow and not os.path.isfile(OPTIONS.file):
+        # a named pipe for instance, it can not be resumed
+        return None
+    if not OPTIONS.stand_alone and OPTIONS.no_spool:
+        print 'Log checkpoints are not saved with --no-spool.'
+        return None
+    if OPTIONS.stand_alone:
+        checkpoints = LocalData
+    else:
+        checkpoints = LogCheckpointFile(OPTIONS.checkpoint_file)
+    return LogCheckpointer(
+        OPTIONS.file, checkpoints, float(OPTIONS.checkpoint_interval))
+
+
+def follow_log_file(process, checkpointer):
+    """Calls process(LogFollower of OPTIONS.file) until interrupted."""
+
+    follower = LogFollower(OPTIONS.file, checkpointer)
+    try:
+        process(follower)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        follower.close()
+
+
+# number of slow query log items sent to a worker process at a time
+SLOW_LOG_WORKER_CHUNK_SIZE = 64
+
+# size in bytes of the parts of a slow query log file read by a worker
+# process at a time
+SLOW_LOG_WORKER_SHARD_SIZE = 4 * 1024 * 1024
+
+
+class SlowQueryLogProcessor(object):
+    """Encapsulates operations on MySQL slow query log."""
+
+    def __init__(self, workers=1, chunk_size=SLOW_LOG_WORKER_CHUNK_SIZE,
+            shard_size=SLOW_LOG_WORKER_SHARD_SIZE, checkpointer=None):
+        super(SlowQueryLogProcessor, self).__init__()
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.shard_size = shard_size
+        self.checkpointer = checkpointer
+
+    def process_log_file(self, path):
+        """
+        Process MySQL slow query log file, from the last checkpoint of
+        self.checkpointer if any.
+        """
+
+        if self.workers > 1 and os.path.isfile(path):
+            self.process_log_file_in_workers(path)
+            return
+
+        with open(path, 'rb', LOG_READ_BUFFER_SIZE) as f:
+            if self.checkpointer is None:
+                self.process_log_contents(f)
+                return
+            f.seek(self.checkpointer.resume(f))
+            for log_item_parser in self.read_log_items(f, offsets=True):
+                self.process_log_item(log_item_parser)
+            self.checkpointer.save()
+
+    def process_log_contents(self, source):
+        """Process contents of MySQL slow query log."""
+
+        if self.workers > 1:
+            self.process_log_contents_in_workers(source)
+            return
+
+        for log_item_parser in self.read_log_items(source):
+            self.process_log_item(log_item_parser)
+
+    def follow_log_file(self, follower):
+        """
+        Process MySQL slow query log file as it is written, see LogFollower.
+
+        Log items are canonicalized by this process whatever self.workers
+        is, a log item is processed once the next one starts or nothing was
+        written for a while.
+        """
+
+        for source in follower.sources():
+            for log_item_parser in self.read_log_items(source, offsets=True):
+                self.process_log_item(log_item_parser)
+
+    def process_log_file_in_workers(self, path):
+        """
+        Process MySQL slow query log file with worker processes.
+
+        The file is split in shards of about self.shard_size bytes, at
+        least one per worker, each starting at a log item. Every worker
+        parses, canonicalizes and hashes the log items of a shard at a
+        time, the log items are saved by this process in log order.
+        """
+
+        with open(path, 'rb') as f:
+            start = 0
+            if self.checkpointer is not None:
+                start = self.checkpointer.resume(f)
+            size = os.fstat(f.fileno()).st_size
+            if size <= start:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                shards = max(self.workers, -(-(size - start) // self.shard_size))
+                offsets = [start]
+                for i in xrange(1, shards):
+                    offset = find_log_item_start(
+                        data, start + (size - start) * i // shards)
+                    if offsets[-1] < offset < size:
+                        offsets.append(offset)
+                offsets.append(size)
+            finally:
+                data.close()
+
+            tasks = (
+                (canonicalize_log_shard, (path, start, end), None)
+                for start, end in itertools.izip(offsets, offsets[1:]))
+            for __, (results, hits, misses) in self.run_in_workers(tasks):
+                FINGERPRINT_CACHE.hits += hits
+                FINGERPRINT_CACHE.misses += misses
+                for log_item_parser, (data, error) in results:
+                    self.save_log_item(log_item_parser, data, error)
+            if self.checkpointer is not None:
+                self.checkpointer.save()
+
+    def process_log_contents_in_workers(self, source):
+        """
+        Process contents of MySQL slow query log with worker processes.
+
+        Log items are read and saved by this process, in log order. Their
+        statements are canonicalized and hashed by the workers,
+        self.chunk_size log items at a time.
+        """
+
+        tasks = (
+            (canonicalize_log_statements,
+             ([log_item_parser.statement for log_item_parser in chunk],),
+             chunk)
+            for chunk in iter_chunks(self.read_log_items(source), self.chunk_size))
+        for chunk, (results, hits, misses) in self.run_in_workers(tasks):
+            FINGERPRINT_CACHE.hits += hits
+            FINGERPRINT_CACHE.misses += misses
+            for log_item_parser, (data, error) in itertools.izip(chunk, results):
+                self.save_log_item(log_item_parser, data, error)
+
+    def run_in_workers(self, tasks):
+        """
+        Runs (function, args, context) tasks in a pool of self.workers processes.
+
+        Yields (context, function result) in task order, with up to two
+        tasks per worker pending. The pool is forked once the options are
+        set, the workers inherit them.
+        """
+
+        pool = multiprocessing.Pool(self.workers)
+        pending = collections.deque()
+        try:
+            for f, args, context in tasks:
+                pending.append((context, pool.apply_async(f, args)))
+                if len(pending) >= 2 * self.workers:
+                    context, async_result = pending.popleft()
+                    yield (context, async_result.get())
+            while pending:
+                context, async_result = pending.popleft()
+                yield (context, async_result.get())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def process_log_item(self, log_item_parser):
+        self.print_log_item(log_item_parser)
+        try:
+            DataManager.save_data(log_item_parser)
+        except Exception, e:
+            print 'ERROR: {0}'.format(e)
+            #traceback.print_exc()
+        self.checkpoint(log_item_parser)
+
+    def save_log_item(self, log_item_parser, data, error):
+        """Saves the canonicalize_log_statement() result of a log item."""
+
+        self.print_log_item(log_item_parser)
+        try:
+            DataManager.save_canonicalized_data(log_item_parser, data)
+            if error is not None:
+                raise Exception(error)
+        except Exception, e:
+            print 'ERROR: {0}'.format(e)
+        self.checkpoint(log_item_parser)
+
+    def checkpoint(self, log_item_parser):
+        if (self.checkpointer is not None and
+                log_item_parser.end_offset is not None):
+            self.checkpointer.processed(
+                log_item_parser.start_offset, log_item_parser.end_offset)
+
+    def print_log_item(self, log_item_parser):
+        for k,v in log_item_parser.header_data.iteritems():
+            print '{0}: {1}'.format(k, v),
+        print
+
+        print log_item_parser.statement
+
+    def read_log_items(self, source, offsets=False):
+        """
+        Yields a parsed SlowQueryLogItemParser for every MySQL slow query log item.
+
+        If offsets is True, the start_offset and end_offset of log items are
+        set, from source.tell().
+        """
+
+        line = source.readline()
+        while True:
+            if not line:
+                break
+
+            if line.rstrip().endswith('started with:'):
+                # ignore current and the next two lines
+                line = source.readline()
+                line = source.readline()
+
+                # this next line is the one that needs processing
+                line = source.readline()
+
+                # loop again so we could recheck lines to ignore
+                continue
+
+            if line.startswith('# '):
+                log_item_parser = SlowQueryLogItemParser()
+                if offsets:
+                    log_item_parser.start_offset = source.tell() - len(line)
+                line = log_item_parser.parse_header_data(line, source)
+
+                # read statement
+                line = log_item_parser.parse_statement(line, source)
+                if offsets:
+                    log_item_parser.end_offset = source.tell() - len(line)
+
+                yield log_item_parser
+
+            else:
+                line = source.readline()
+
+
+# seconds after which an idle pooled MySQL connection is closed
+EXPLAIN_CONNECTION_IDLE_TIMEOUT = 300
+
+# seconds after which an idle pooled MySQL connection is pinged before it
+# is reused
+EXPLAIN_CONNECTION_CHECK_INTERVAL = 10
+
+
+class MySqlConnectionPool(object):
+    """
+    Pool of MySQL connections, shared by the EXPLAIN of statements of every
+    schema of a server.
+
+    Connections are told apart by (host, port, user), a connection using
+    another schema is switched to the schema asked for with select_db().
+    Idle connections are closed after idle_timeout seconds and pinged
+    before they are reused once idle for check_interval seconds.
+    """
+
+    def __init__(self, idle_timeout=EXPLAIN_CONNECTION_IDLE_TIMEOUT,
+            check_interval=EXPLAIN_CONNECTION_CHECK_INTERVAL):
+        super(MySqlConnectionPool, self).__init__()
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # maps (host, port, user) to [connection, db, idle since] lists
+        self._idle = {}
+        self.connects = 0
+        self.reuses = 0
+
+    @staticmethod
+    def _key(options):
+        return (options.get('host'), options.get('port'), options.get('user'))
+
+    def _get_idle(self, key, db):
+        with self._lock:
+            idle = self._idle.get(key, [])
+            for i, item in enumerate(idle):
+                if item[1] == db:
+                    return idle.pop(i)
+            # a connection using a schema can not go back to none
+            if db is not None and idle:
+                return idle.pop()
+        return None
+
+    def acquire(self, options):
+        """
+        Returns a connection with MySQLdb.connect() options, using
+        options['db'] if any, and the schema it uses.
+        """
+
+        self.close_idle()
+        key = self._key(options)
+        db = options.get('db')
+        item = self._get_idle(key, db)
+        while item is not None:
+            conn, conn_db, idle_since = item
+            try:
+                if time.time() - idle_since >= self.check_interval:
+                    conn.ping()
+                if db != conn_db:
+                    conn.select_db(db)
+                self.reuses += 1
+                return conn
+            except MySQLdb.Error:
+                self._close(conn)
+            item = self._get_idle(key, db)
+
+        conn = MySQLdb.connect(**options)
+        conn.autocommit(True)
+        self.connects += 1
+        return conn
+
+    def release(self, conn, options):
+        """Gives back a connection returned by acquire(options)."""
+
+        with self._lock:
+            self._idle.setdefault(self._key(options), []).append(
+                [conn, options.get('db'), time.time()])
+
+    @contextlib.contextmanager
+    def connection(self, options):
+        """
+        Yields a connection of acquire(options), released afterwards or
+        closed if an exception was raised.
+        """
+
+        conn = self.acquire(options)
+        try:
+            yield conn
+        except:
+            # the connection may be unusable
+            self._close(conn)
+            raise
+        self.release(conn, options)
+
+    def close_idle(self, idle_timeout=None):
+        """Closes the connections idle for idle_timeout seconds or more."""
+
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        now = time.time()
+        closed = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                kept = []
+                for item in idle:
+                    if now - item[2] >= idle_timeout:
+                        closed.append(item[0])
+                    else:
+                        kept.append(item)
+                if kept:
+                    self._idle[key] = kept
+                else:
+                    del self._idle[key]
+        for conn in closed:
+            self._close(conn)
 
-def get_unicode_string(s):
-    try:
-        return s.decode(OPTIONS.encoding, OPTIONS.encoding_errors)
-    except Exception, e:
-        print 'Exception type: {0}, text: {1}'.format(type(e), e)
-        return s
+    def close(self):
+        """Closes all idle connections."""
 
+        self.close_idle(0)
 
-class SlowQueryLogProcessor(object):
-    """Encapsulates operations on MySQL slow query log."""
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
 
-    def __init__(self):
-        super(SlowQueryLogProcessor, self).__init__()
 
-    def process_log_contents(self, source):
-        """Process contents of MySQL slow query log."""
+EXPLAIN_CONNECTIONS = MySqlConnectionPool()
 
-        last_dt = None
-        line = source.readline()
+
+# number of threads running EXPLAIN statements, 0 runs them when the
+# statements are saved
+EXPLAIN_WORKERS = 1
+
+# number of EXPLAIN statements waiting for a thread, more wait for a free
+# slot
+EXPLAIN_QUEUE_SIZE = 100
+
+# seconds after which a running EXPLAIN statement is killed
+EXPLAIN_TIMEOUT = 10.0
+
+
+class ExplainQueue(object):
+    """
+    Bounded queue of EXPLAIN jobs run by worker threads, so that saving
+    statements does not wait for EXPLAIN statements.
+
+    A job is a function run without arguments, keyed by the canonicalized
+    statement hostname hash of the statement it explains. A job is not
+    queued if a job of the same key is queued or running. Jobs are the
+    EXPLAIN statements of statements seen for the first time, which are not
+    asked for again, so a job is never dropped: when the queue is full,
+    submit() waits for a free slot. The threads are started by the first
+    job queued.
+    """
+
+    def __init__(self, workers=EXPLAIN_WORKERS, size=EXPLAIN_QUEUE_SIZE,
+            timeout=EXPLAIN_TIMEOUT):
+        super(ExplainQueue, self).__init__()
+        self.workers = workers
+        self.size = size
+        self.timeout = timeout
+        self._queue = Queue.Queue(size)
+        self._lock = threading.Lock()
+        self._keys = set()
+        self._threads = []
+
+        self.queued = 0
+        self.duplicates = 0
+        self.waits = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    def submit(self, key, job):
+        """
+        Queues job, waiting for a free slot if the queue is full. Returns
+        False if a job of the same key is queued or running already.
+        """
+
+        if self.workers <= 0:
+            with self._lock:
+                self.queued += 1
+            self._run_job(job)
+            return True
+
+        with self._lock:
+            if key in self._keys:
+                self.duplicates += 1
+                return False
+            self._keys.add(key)
+            self.queued += 1
+            if not self._threads:
+                for i in xrange(self.workers):
+                    thread = threading.Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+        try:
+            self._queue.put_nowait((key, job))
+        except Queue.Full:
+            # the threads take the lock to finish jobs, wait without it
+            with self._lock:
+                self.waits += 1
+            self._queue.put((key, job))
+        return True
+
+    def _run_job(self, job):
+        try:
+            job()
+        except Exception, e:
+            print 'ERROR: {0}'.format(e)
+            with self._lock:
+                self.failed += 1
+
+    def _work(self):
         while True:
-            if not line:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                key, job = item
+                self._run_job(job)
+                with self._lock:
+                    self._keys.discard(key)
+            finally:
+                self._queue.task_done()
+
+    def count_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def join(self):
+        """Waits for the queued jobs to be run."""
+
+        self._queue.join()
+
+    def close(self):
+        """Runs the queued jobs and stops the threads."""
+
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def __str__(self):
+        return (
+            '{0} queued, {1} duplicate(s), {2} waited for a free slot, '
+            '{3} failed, {4} timed out').format(
+            self.queued, self.duplicates, self.waits, self.failed,
+            self.timeouts)
+
+
+EXPLAIN_QUEUE = ExplainQueue()
+
+
+class ExplainTimer(object):
+    """Kills the statement running on conn once it ran for timeout seconds."""
+
+    def __init__(self, conn, connection_options, timeout):
+        super(ExplainTimer, self).__init__()
+        self.killed = False
+        self._thread_id = conn.thread_id()
+        self._connection_options = dict(connection_options)
+        self._connection_options.pop('db', None)
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._timer = threading.Timer(timeout, self._kill)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _kill(self):
+        # the connection may run another statement once stopped
+        with self._lock:
+            if self._stopped:
+                return
+            try:
+                with EXPLAIN_CONNECTIONS.connection(
+                        self._connection_options) as conn:
+                    cur = conn.cursor()
+                    cur.execute('KILL QUERY {0}'.format(self._thread_id))
+                    cur.close()
+                self.killed = True
+            except Exception, e:
+                print 'ERROR: {0}'.format(e)
+
+    def stop(self):
+        self._timer.cancel()
+        with self._lock:
+            self._stopped = True
+
+
+class Flusher(object):
+    """
+    Thread calling flush() every quarter of interval seconds until stopped,
+    so that the statements of an idle log source are written or sent once
+    they waited interval seconds, not when the next statement is read.
+    """
+
+    def __init__(self, flush, interval):
+        self.flush = flush
+        self.period = max(interval / 4.0, 0.01)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='flusher')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._stop.wait(self.period)
+            if self._stop.is_set():
                 break
+            try:
+                self.flush()
+            except Exception, e:
+                print 'ERROR: {0}'.format(e)
 
-            if line.rstrip().endswith(u'started with:'):
-                # ignore current and the next two lines
-                line = source.readline()
-                line = source.readline()
+    def stop(self):
+        """Stops the thread and waits for it."""
 
-                # this next line is the one that needs processing
-                line = source.readline()
+        self._stop.set()
+        self._thread.join()
 
-                # loop again so we could recheck lines to ignore
-                continue
 
-            if line.startswith('# '):
-                log_item_parser = SlowQueryLogItemParser()
-                line = log_item_parser.parse_header_data(line, source)
+# synchronous setting of the local sqlite database, in WAL journal mode
+# NORMAL syncs the WAL at checkpoints only, a power failure can lose the
+# last transactions but does not corrupt the database
+LOCAL_DB_SYNCHRONOUS = 'NORMAL'
 
-                for k,v in log_item_parser.header_data.iteritems():
-                    print '{0}: {1}'.format(k, v),
-                print
+# statements saved in the local database are written in a single
+# transaction once there are LOCAL_DB_BATCH_SIZE of them or the oldest one
+# waited LOCAL_DB_FLUSH_INTERVAL milliseconds
+LOCAL_DB_BATCH_SIZE = 100
+LOCAL_DB_FLUSH_INTERVAL = 1000
 
-                # read statement
-                line = log_item_parser.parse_statement(line, source)
+# rate of the statements wrongly taken as seen by a Bloom filter holding as
+# many statements as it was sized for
+BLOOM_FILTER_ERROR_RATE = 0.001
 
-                print log_item_parser.statement
 
-                try:
-                    DataManager.save_data(log_item_parser)
-                except Exception, e:
-                    print 'ERROR: {0}'.format(e)
-                    #traceback.print_exc()
+class BloomFilter(object):
+    """
+    Compact set of ints, that may wrongly report ints it does not hold.
 
-            else:
-                line = source.readline()
+    Sized for capacity ints, it reports error_rate of the ints it does not
+    hold once it holds as many. Ints can not be removed.
+    """
+
+    def __init__(self, capacity, error_rate=BLOOM_FILTER_ERROR_RATE):
+        super(BloomFilter, self).__init__()
+        self.bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.bits * math.log(2) / capacity)))
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _offsets(self, value):
+        # double hashing, the ints are hashes already
+        h1 = value & 0xffffffff
+        h2 = mmh3.hash(str(value)) | 1
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def add(self, value):
+        array = self._array
+        for offset in self._offsets(value):
+            array[offset >> 3] |= 1 << (offset & 7)
+
+    def __contains__(self, value):
+        array = self._array
+        for offset in self._offsets(value):
+            if not array[offset >> 3] & (1 << (offset & 7)):
+                return False
+        return True
 
 
 class LocalData:
@@ -1120,73 +3572,448 @@ class LocalData:
 
     DB = None
 
+    # connection to DB, kept open so that sqlite3 reuses its prepared
+    # statements
+    CONNECTION = None
+
+    # statements are stored in a ring of MAX_ROWS slots, RING_HEAD is the
+    # sequence_id of the last slot written
+    MAX_ROWS = STATEMENT_DATA_MAX_ROWS
+    RING_HEAD = 0
+
+    # statements not written yet
+    BATCH = []
+
+    # serializes the use of CONNECTION by the thread saving statements and
+    # FLUSHER, the Flusher writing them once they waited FLUSH_INTERVAL
+    LOCK = threading.RLock()
+    FLUSHER = None
+
+    # (explained statement row, explain rows) of the EXPLAIN statements run
+    # by EXPLAIN_QUEUE threads, not written yet
+    EXPLAINED = collections.deque()
+    BATCH_SIZE = LOCAL_DB_BATCH_SIZE
+    FLUSH_INTERVAL = LOCAL_DB_FLUSH_INTERVAL
+    BATCH_STARTED_AT = None
+
+    # canonicalized statement hostname hashes of the statements saved in DB
+    # since it was created, a set or a BloomFilter
+    SEEN_STATEMENTS = set()
+
+    # statements upgrading the schema of DB, MIGRATIONS[N] upgrades it from
+    # version N (PRAGMA user_version) to N + 1; they can be run again if an
+    # upgrade was interrupted
+    MIGRATIONS = [
+        # tables, created by earlier versions without user_version
+        [
+            """
+            CREATE TABLE IF NOT EXISTS statements(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dt TEXT,
+                statement TEXT,
+                server_id INT,
+                canonicalized_statement TEXT,
+                canonicalized_statement_hash INT,
+                canonicalized_statement_hostname_hash INT,
+                query_time REAL,
+                lock_time REAL,
+                rows_sent INT,
+                rows_examined INT,
+                rows_affected INT,
+                rows_read INT,
+                bytes_sent INT,
+                tmp_tables INT,
+                tmp_disk_tables INT,
+                tmp_table_sizes INT,
+                sequence_id INT,
+                created_at TEXT,
+                updated_at TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS explained_statements(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dt TEXT,
+                statement TEXT,
+                server_id INT,
+                canonicalized_statement TEXT,
+                canonicalized_statement_hash INT,
+                canonicalized_statement_hostname_hash INT,
+                db TEXT,
+                created_at TEXT,
+                updated_at TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS explain_results(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                explained_statement_id INT,
+                select_id INT,
+                select_type TEXT,
+                `table` TEXT,
+                type TEXT,
+                possible_keys TEXT,
+                `key` TEXT,
+                key_len INT,
+                ref TEXT,
+                rows INT,
+                extra TEXT,
+                created_at TEXT,
+                updated_at TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS log_checkpoints(
+                path TEXT PRIMARY KEY,
+                inode INT,
+                offset INT,
+                length INT,
+                hash INT,
+                updated_at TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS metadata(
+                name TEXT PRIMARY KEY,
+                value INT
+            )
+            """,
+        ],
+        # constant time statements ring (see init_statements_ring)
+        [
+            # keep the last row written to a slot by earlier versions
+            """
+            DELETE FROM statements WHERE id NOT IN (
+                SELECT MAX(id) FROM statements GROUP BY sequence_id)
+            """,
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS statements_sequence_id
+            ON statements(sequence_id)
+            """,
+        ],
+        # secondary indexes
+        [
+            # top queries
+            """
+            CREATE INDEX IF NOT EXISTS statements_hostname_hash
+            ON statements(canonicalized_statement_hostname_hash)
+            """,
+            # last statements
+            """
+            CREATE INDEX IF NOT EXISTS statements_dt ON statements(dt)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS explained_statements_hostname_hash
+            ON explained_statements(canonicalized_statement_hostname_hash)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS explain_results_explained_statement_id
+            ON explain_results(explained_statement_id)
+            """,
+        ],
+    ]
+
     @staticmethod
-    def init_db(db):
-        LocalData.DB = db
+    def init_db(db, synchronous=LOCAL_DB_SYNCHRONOUS,
+            max_rows=STATEMENT_DATA_MAX_ROWS, batch_size=LOCAL_DB_BATCH_SIZE,
+            flush_interval=LOCAL_DB_FLUSH_INTERVAL, bloom_filter_capacity=0):
+        """
+        Opens db, creating or upgrading it.
+
+        The statements seen are kept in a BloomFilter sized for
+        bloom_filter_capacity statements if it is not 0, in a set otherwise.
+        """
 
-        conn = sqlite3.connect(db)
+        LocalData.close_db()
+        LocalData.DB = db
+        LocalData.MAX_ROWS = max_rows
+        LocalData.BATCH_SIZE = batch_size
+        LocalData.FLUSH_INTERVAL = flush_interval
+
+        conn = LocalData.get_connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous={0}'.format(synchronous))
+        LocalData.migrate(conn)
         with conn:
             cur = conn.cursor()
+            LocalData.init_statements_ring(cur)
+
+            if bloom_filter_capacity:
+                LocalData.SEEN_STATEMENTS = BloomFilter(bloom_filter_capacity)
+            else:
+                LocalData.SEEN_STATEMENTS = set()
+            # explained statements are kept after their statements are
+            # replaced
             cur.execute(
                 """
-                CREATE TABLE IF NOT EXISTS statements(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    dt TEXT,
-                    statement TEXT,
-                    server_id INT,
-                    canonicalized_statement TEXT,
-                    canonicalized_statement_hash INT,
-                    canonicalized_statement_hostname_hash INT,
-                    query_time REAL,
-                    lock_time REAL,
-                    rows_sent INT,
-                    rows_examined INT,
-                    rows_affected INT,
-                    rows_read INT,
-                    bytes_sent INT,
-                    tmp_tables INT,
-                    tmp_disk_tables INT,
-                    tmp_table_sizes INT,
-                    sequence_id INT,
-                    created_at TEXT,
-                    updated_at TEXT
-                )
+                SELECT DISTINCT canonicalized_statement_hostname_hash
+                FROM statements
+                UNION
+                SELECT canonicalized_statement_hostname_hash
+                FROM explained_statements
                 """)
+            for row in cur:
+                LocalData.SEEN_STATEMENTS.add(row[0])
+            cur.close()
+
+        # statements are written once they waited FLUSH_INTERVAL even if no
+        # other statement is saved, as when reading an idle pipe
+        if flush_interval > 0:
+            LocalData.FLUSHER = Flusher(
+                LocalData.flush_if_due, flush_interval / 1000.0)
+            LocalData.FLUSHER.start()
+
+    @staticmethod
+    def migrate(conn, version=None):
+        """Upgrades the schema of DB to version, the last one by default."""
+
+        if version is None:
+            version = len(LocalData.MIGRATIONS)
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        for i in xrange(current, version):
+            with conn:
+                for sql in LocalData.MIGRATIONS[i]:
+                    conn.execute(sql)
+                conn.execute('PRAGMA user_version={0}'.format(i + 1))
+
+    @staticmethod
+    def init_statements_ring(cur):
+        """
+        Loads RING_HEAD. sequence_id of statements is unique, a slot of the
+        ring is replaced by an INSERT OR REPLACE.
+        """
+
+        # the ring may have been larger
+        cur.execute(
+            """
+            DELETE FROM statements WHERE sequence_id >= ?
+            """, (LocalData.MAX_ROWS,))
+
+        cur.execute(
+            """
+            SELECT value FROM metadata WHERE name = 'statements_ring_head'
+            """)
+        row = cur.fetchone()
+        if row is None:
+            # written by an earlier version, find the last slot written
             cur.execute(
                 """
-                CREATE TABLE IF NOT EXISTS explained_statements(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    dt TEXT,
-                    statement TEXT,
-                    server_id INT,
-                    canonicalized_statement TEXT,
-                    canonicalized_statement_hash INT,
-                    canonicalized_statement_hostname_hash INT,
-                    db TEXT,
-                    created_at TEXT,
-                    updated_at TEXT
-                )
+                SELECT sequence_id FROM statements
+                ORDER BY updated_at DESC, sequence_id DESC
+                LIMIT 1
                 """)
+            row = cur.fetchone()
+        LocalData.RING_HEAD = row[0] if row else 0
+
+    @staticmethod
+    def get_connection():
+        """Returns the connection to DB, opened on first use."""
+
+        if LocalData.CONNECTION is None:
+            # used by FLUSHER too, under LOCK
+            LocalData.CONNECTION = sqlite3.connect(
+                LocalData.DB, check_same_thread=False)
+        return LocalData.CONNECTION
+
+    @staticmethod
+    def close_db():
+        """Writes the statements not written yet and closes DB."""
+
+        # FLUSHER takes LOCK, it is stopped without it
+        if LocalData.FLUSHER is not None:
+            LocalData.FLUSHER.stop()
+            LocalData.FLUSHER = None
+        with LocalData.LOCK:
+            if LocalData.CONNECTION is not None:
+                LocalData.flush()
+                LocalData.CONNECTION.close()
+                LocalData.CONNECTION = None
+
+    @staticmethod
+    def flush():
+        """Writes the statements not written yet in a single transaction."""
+
+        with LocalData.LOCK:
+            if not LocalData.BATCH and not LocalData.EXPLAINED:
+                return
+            conn = LocalData.get_connection()
+            with conn:
+                cur = conn.cursor()
+                LocalData.write_batch(cur)
+                cur.close()
+
+    @staticmethod
+    def flush_if_due():
+        """
+        Writes the statements not written yet if they are due, and the
+        EXPLAIN results not written yet, in the FLUSHER thread.
+        """
+
+        with LocalData.LOCK:
+            if LocalData.is_batch_due() or LocalData.EXPLAINED:
+                LocalData.flush()
+
+    @staticmethod
+    def write_batch(cur):
+        LocalData.write_explained(cur)
+        if not LocalData.BATCH:
+            return
+        cur.executemany(
+            """
+            INSERT OR REPLACE INTO statements(
+                dt, statement, server_id,
+                canonicalized_statement,
+                canonicalized_statement_hash,
+                canonicalized_statement_hostname_hash,
+                query_time, lock_time, rows_sent, rows_examined,
+                rows_affected, rows_read, bytes_sent,
+                tmp_tables, tmp_disk_tables, tmp_table_sizes,
+                sequence_id, created_at, updated_at)
+            VALUES (
+                ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, LocalData.BATCH)
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO metadata(name, value)
+            VALUES ('statements_ring_head', ?)
+            """, (LocalData.RING_HEAD,))
+        LocalData.BATCH = []
+        LocalData.BATCH_STARTED_AT = None
+
+    @staticmethod
+    def is_batch_due():
+        if len(LocalData.BATCH) >= LocalData.BATCH_SIZE:
+            return True
+        return (LocalData.BATCH_STARTED_AT is not None and
+            (time.time() - LocalData.BATCH_STARTED_AT) * 1000 >=
+                LocalData.FLUSH_INTERVAL)
+
+    @staticmethod
+    def load_log_checkpoint(log_path):
+        """Returns the LogCheckpoint of log_path, None if there is none."""
+
+        with LocalData.LOCK:
+            conn = LocalData.get_connection()
+            with conn:
+                cur = conn.cursor()
+                cur.execute(
+                    """
+                    SELECT inode, offset, length, hash FROM log_checkpoints
+                    WHERE path = ?
+                    """, (log_path,))
+                row = cur.fetchone()
+                cur.close()
+            if row:
+                return LogCheckpoint(*row)
+            return None
+
+    @staticmethod
+    def save_log_checkpoint(log_path, checkpoint):
+        with LocalData.LOCK:
+            conn = LocalData.get_connection()
+            with conn:
+                cur = conn.cursor()
+                # the statements before the checkpoint are written with it
+                LocalData.write_batch(cur)
+                cur.execute(
+                    """
+                    INSERT OR REPLACE INTO log_checkpoints(
+                        path, inode, offset, length, hash, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """, (log_path,) + tuple(checkpoint) + (
+                        datetime.datetime.now(),))
+                cur.close()
+
+    @staticmethod
+    def has_statements(canonicalized_statement_hostname_hash):
+        """Returns True if statements with the hash were written."""
+
+        with LocalData.LOCK:
+            conn = LocalData.get_connection()
+            cur = conn.cursor()
             cur.execute(
                 """
-                CREATE TABLE IF NOT EXISTS explain_results(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    explained_statement_id INT,
-                    select_id INT,
-                    select_type TEXT,
-                    `table` TEXT,
-                    type TEXT,
-                    possible_keys TEXT,
-                    `key` TEXT,
-                    key_len INT,
-                    ref TEXT,
-                    rows INT,
-                    extra TEXT,
-                    created_at TEXT,
-                    updated_at TEXT
-                )
-                """)
+                SELECT EXISTS(
+                    SELECT 1 FROM statements
+                    WHERE canonicalized_statement_hostname_hash=?)
+                """, (canonicalized_statement_hostname_hash,))
+            row = cur.fetchone()
             cur.close()
+            return bool(row[0])
+
+    @staticmethod
+    def get_top_queries(n):
+        """
+        Returns the N most frequent statements, as (canonicalized_statement,
+        server_id, canonicalized_statement_hostname_hash, count) rows.
+        """
+
+        with LocalData.LOCK:
+            conn = LocalData.get_connection()
+            with conn:
+                cur = conn.cursor()
+                # the hashes are counted on their index alone
+                cur.execute(
+                    """
+                    SELECT
+                        canonicalized_statement,
+                        server_id,
+                        canonicalized_statement_hostname_hash,
+                        COUNT(id)
+                    FROM statements
+                    WHERE canonicalized_statement_hostname_hash IN (
+                        SELECT canonicalized_statement_hostname_hash
+                        FROM statements
+                        GROUP BY canonicalized_statement_hostname_hash
+                        ORDER BY COUNT(*) DESC
+                        LIMIT ?)
+                    GROUP BY
+                        canonicalized_statement,
+                        server_id,
+                        canonicalized_statement_hostname_hash
+                    ORDER BY COUNT(id) DESC
+                    LIMIT ?
+                    """, (n, n))
+                rows = cur.fetchall()
+                cur.close()
+            return rows
+
+    @staticmethod
+    def get_last_statements(dt_start, dt_end):
+        """
+        Returns the statements seen between dt_start and dt_end, as
+        (canonicalized_statement, server_id,
+        canonicalized_statement_hostname_hash, canonicalized_statement_hash,
+        statement, last dt, count) rows.
+        """
+
+        with LocalData.LOCK:
+            conn = LocalData.get_connection()
+            with conn:
+                cur = conn.cursor()
+                cur.execute(
+                    """
+                    SELECT
+                        canonicalized_statement,
+                        server_id,
+                        canonicalized_statement_hostname_hash,
+                        canonicalized_statement_hash,
+                        statement,
+                        MAX(dt),
+                        COUNT(dt)
+                    FROM statements
+                    WHERE (dt>=?) AND (dt<=?)
+                    GROUP BY
+                        canonicalized_statement,
+                        server_id,
+                        canonicalized_statement_hostname_hash,
+                        canonicalized_statement_hash,
+                        statement
+                    ORDER BY MAX(dt)
+                    """, (dt_start, dt_end))
+                rows = cur.fetchall()
+                cur.close()
+            return rows
 
     @staticmethod
     def save_statement_data(
@@ -1196,7 +4023,7 @@ class LocalData:
             header_data):
         """Saves statement data.
 
-        Statement data are stored as RRD.
+        Statement data are stored as RRD, written in batches by flush().
         """
 
         server_id = OPTIONS.server_id
@@ -1204,200 +4031,656 @@ class LocalData:
         if 'schema' in header_data and header_data['schema'].strip():
             schema = header_data['schema'].strip()
 
-        if dt is None:
-            dt = datetime.datetime.now()
+        if dt is None:
+            dt = datetime.datetime.now()
+
+        is_select_statement = canonicalized_statement.startswith('SELECT ')
+        first_seen = False
+
+        conn = LocalData.get_connection()
+        if is_select_statement:
+            first_seen = (
+                canonicalized_statement_hostname_hash not in
+                    LocalData.SEEN_STATEMENTS)
+
+        # replace the slot following the last one written
+        sequence_id = (LocalData.RING_HEAD + 1) % LocalData.MAX_ROWS
+        created_at = datetime.datetime.now()
+        updated_at = datetime.datetime.now()
+        header_data_keys = (
+            'query_time', 'lock_time', 'rows_sent',
+            'rows_examined', 'rows_affected', 'rows_read',
+            'bytes_sent', 'tmp_tables', 'tmp_disk_tables',
+            'tmp_table_sizes')
+        data = [
+            dt, statement, server_id,
+            canonicalized_statement,
+            canonicalized_statement_hash,
+            canonicalized_statement_hostname_hash]
+        data.extend(
+            [header_data.get(k) for k in header_data_keys])
+        data.extend((sequence_id, created_at, updated_at))
+        with LocalData.LOCK:
+            if not LocalData.BATCH:
+                LocalData.BATCH_STARTED_AT = time.time()
+            LocalData.BATCH.append(data)
+            if not first_seen:
+                LocalData.SEEN_STATEMENTS.add(
+                    canonicalized_statement_hostname_hash)
+            LocalData.RING_HEAD = sequence_id
+
+            if LocalData.is_batch_due():
+                LocalData.flush()
+
+        # run an explain if first seen
+        if first_seen:
+            if not schema:
+                schema = DataManager.get_last_db_used()
+            statement_data_row = data[:6]
+            statement_data_row.extend((schema, created_at, updated_at))
+            try:
+                connection_options = DataManager.get_explain_connection_options()
+                if schema:
+                    connection_options['db'] = schema
+                #print 'explain connection:'
+                #pp(connection_options)
+                EXPLAIN_QUEUE.submit(
+                    canonicalized_statement_hostname_hash,
+                    lambda: LocalData.explain_statement(
+                        statement, statement_data_row, connection_options))
+                # seen once its EXPLAIN is queued, it is asked for again
+                # otherwise
+                LocalData.SEEN_STATEMENTS.add(
+                    canonicalized_statement_hostname_hash)
+            except Exception, e:
+                print 'ERROR: {0}'.format(e)
+
+    @staticmethod
+    def explain_statement(statement, statement_data_row, connection_options):
+        """Runs the EXPLAIN of statement, written by the next flush()."""
+
+        with EXPLAIN_CONNECTIONS.connection(
+                connection_options) as mysql_conn:
+            try:
+                explain_rows = DataManager.explain(
+                    statement, mysql_conn, connection_options)
+            except Exception, e:
+                print 'ERROR: {0}'.format(e)
+                explain_rows = []
+        LocalData.EXPLAINED.append((statement_data_row, explain_rows))
+
+    @staticmethod
+    def write_explained(cur):
+        while LocalData.EXPLAINED:
+            statement_data_row, explain_rows = LocalData.EXPLAINED.popleft()
+            cur.execute(
+                """
+                INSERT INTO explained_statements(
+                    dt, statement, server_id,
+                    canonicalized_statement,
+                    canonicalized_statement_hash,
+                    canonicalized_statement_hostname_hash,
+                    db, created_at, updated_at)
+                VALUES (?,?,?,?,?,?,?,?,?)
+                """, statement_data_row)
+            explained_statement_id = cur.lastrowid
+            created_at, updated_at = statement_data_row[-2:]
+            for explain_row in explain_rows:
+                values = [
+                    explained_statement_id,
+                    explain_row['select_id'],
+                    explain_row['select_type'],
+                    explain_row['table'],
+                    explain_row['type'],
+                    explain_row['possible_keys'],
+                    explain_row['key'],
+                    explain_row['key_len'],
+                    explain_row['ref'],
+                    explain_row['rows'],
+                    explain_row['extra']]
+                values.append(created_at)
+                values.append(updated_at)
+                cur.execute(
+                    """
+                    INSERT INTO explain_results(
+                        explained_statement_id,
+                        select_id,
+                        select_type,
+                        `table`,
+                        type,
+                        possible_keys,
+                        key,
+                        key_len,
+                        ref,
+                        rows,
+                        extra,
+                        created_at, updated_at)
+                    VALUES
+                        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?)
+                    """, values)
+
+
+# statements sent to the server are posted in a single request once there
+# are SERVER_BATCH_SIZE of them or the oldest one waited
+# SERVER_FLUSH_INTERVAL milliseconds
+SERVER_BATCH_SIZE = 100
+SERVER_FLUSH_INTERVAL = 1000
+
+# seconds after which a request to the server is abandoned
+SERVER_TIMEOUT = 30.0
+
+# a request to the server failing, answered with a SERVER_RETRY_STATUSES
+# status or with an error is sent again up to SERVER_RETRIES times, after
+# SERVER_RETRY_DELAY seconds then twice as long every time
+SERVER_RETRIES = 3
+SERVER_RETRY_DELAY = 0.5
+SERVER_RETRY_STATUSES = (502, 503, 504)
+
+# request bodies of at least SERVER_COMPRESS_MIN_SIZE bytes are gzip
+# compressed, smaller ones barely shrink
+SERVER_COMPRESS_MIN_SIZE = 512
+
+
+class ServerResponse(
+        collections.namedtuple('ServerResponse', 'code content')):
+    """Response to a ServerConnection request."""
+
+    __slots__ = ()
+
+    @property
+    def error(self):
+        """
+        Error message of an HTTP 200 response, None if there is none. The
+        server rolls back a request that fails and answers it with HTTP 200
+        and an error message, nothing of it is saved.
+        """
+
+        if self.code != 200:
+            return None
+        try:
+            content = json.loads(self.content)
+        except ValueError:
+            return None
+        if isinstance(content, dict):
+            return content.get('error')
+        return None
+
+
+class ServerConnection(object):
+    """
+    Keep-alive HTTP connection to the server at base_url.
+
+    Data are posted as JSON bodies, gzip compressed if compress is True.
+    Requests are sent over a single connection, opened again once the
+    server closes it. A request failing on a connection that was already
+    used is sent again at once on a new one, the server may have closed it
+    while it was idle. Otherwise a request, or one answered with an error,
+    is retried retries times, with exponential backoff from retry_delay
+    seconds.
+
+    A request failing or timing out may have been processed by the server
+    all the same. Requests posted with a key are sent with it as their
+    Idempotency-Key header, the server answers a request whose key it
+    processed already with its first response, without processing it
+    again.
+    """
+
+    def __init__(self, base_url, timeout=SERVER_TIMEOUT, compress=True,
+            retries=SERVER_RETRIES, retry_delay=SERVER_RETRY_DELAY):
+        super(ServerConnection, self).__init__()
+        url = urlparse.urlsplit(base_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.path = url.path.rstrip('/')
+        self.timeout = timeout
+        self.compress = compress
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._conn = None
+        self.connects = 0
+        self.requests = 0
+        self.retried = 0
+        # request body bytes, as sent and before compression
+        self.bytes_sent = 0
+        self.bytes_posted = 0
+
+    def __str__(self):
+        return (
+            '{0} request(s), {1} byte(s) sent for {2} byte(s) of JSON, '
+            '{3} retried, {4} connection(s)'.format(
+                self.requests, self.bytes_sent, self.bytes_posted,
+                self.retried, self.connects))
+
+    def _connect(self):
+        if self.scheme == 'https':
+            self._conn = httplib.HTTPSConnection(
+                self.netloc, timeout=self.timeout)
+        else:
+            self._conn = httplib.HTTPConnection(
+                self.netloc, timeout=self.timeout)
+        self.connects += 1
+
+    def _request(self, path, body, headers):
+        while True:
+            reused = self._conn is not None
+            if not reused:
+                self._connect()
+            try:
+                self._conn.request('POST', self.path + path, body, headers)
+                response = self._conn.getresponse()
+                content = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if reused:
+                    continue
+                raise
+            self.requests += 1
+            self.bytes_sent += len(body)
+            if response.will_close:
+                self.close()
+            return ServerResponse(response.status, content)
+
+    def post(self, path, data, key=None):
+        """
+        Posts data as JSON to path, with the Idempotency-Key key if given,
+        returns a ServerResponse.
+        """
+
+        body = json.dumps(data)
+        self.bytes_posted += len(body)
+        headers = {'Content-Type': 'application/json'}
+        if key:
+            headers['Idempotency-Key'] = key
+        if self.compress and len(body) >= SERVER_COMPRESS_MIN_SIZE:
+            compressor = zlib.compressobj(
+                6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        delay = self.retry_delay
+        for attempt in xrange(self.retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+                self.retried += 1
+            try:
+                response = self._request(path, body, headers)
+            except (httplib.HTTPException, socket.error):
+                if attempt == self.retries:
+                    raise
+                continue
+            if (response.code not in SERVER_RETRY_STATUSES and
+                    not response.error):
+                break
+        return response
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+# requests to the server are appended to spool segments of about
+# SPOOL_SEGMENT_SIZE bytes, the oldest segments are dropped once the spool
+# holds more than SPOOL_MAX_SIZE bytes
+SPOOL_SEGMENT_SIZE = 4 * 1024 * 1024
+SPOOL_MAX_SIZE = 100 * 1024 * 1024
+
+# seconds the spool sender waits before sending a request again once the
+# server is unreachable, doubled every time up to SPOOL_MAX_RETRY_DELAY
+SPOOL_RETRY_DELAY = 1.0
+SPOOL_MAX_RETRY_DELAY = 60.0
 
-        is_select_statement = canonicalized_statement.startswith('SELECT ')
-        first_seen = False
+# seconds sqlcanonclient waits on exit for the spool to be sent, what is
+# left is sent the next time it runs
+SPOOL_DRAIN_TIMEOUT = 10.0
 
-        conn = sqlite3.connect(LocalData.DB)
-        with conn:
-            cur = conn.cursor()
 
-            if is_select_statement:
-                cur.execute(
-                    """
-                    SELECT COUNT(*) FROM statements
-                    WHERE canonicalized_statement_hostname_hash=?
-                    """, (canonicalized_statement_hostname_hash,))
-                row = cur.fetchone()
-                count = 0
-                if row:
-                    count = row[0]
-                first_seen = not count
+class SpoolInUseError(Exception):
+    pass
 
-            insert_sql = (
-                """
-                INSERT INTO statements(
-                    dt, statement, server_id,
-                    canonicalized_statement,
-                    canonicalized_statement_hash,
-                    canonicalized_statement_hostname_hash,
-                    query_time, lock_time, rows_sent, rows_examined,
-                    rows_affected, rows_read, bytes_sent,
-                    tmp_tables, tmp_disk_tables, tmp_table_sizes,
-                    sequence_id, created_at, updated_at)
-                VALUES (
-                    ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """)
-            update_sql = (
-                """
-                UPDATE statements
-                SET
-                    dt = ?,
-                    statement = ?,
-                    server_id = ?,
-                    canonicalized_statement = ?,
-                    canonicalized_statement_hash = ?,
-                    canonicalized_statement_hostname_hash = ?,
-                    query_time = ?,
-                    lock_time = ?,
-                    rows_sent = ?,
-                    rows_examined = ?,
-                    rows_affected = ?,
-                    rows_read = ?,
-                    bytes_sent = ?,
-                    tmp_tables = ?,
-                    tmp_disk_tables = ?,
-                    tmp_table_sizes = ?,
-                    updated_at = ?
-                WHERE sequence_id = ?
-                """)
 
-            # calculate the next sequence id to use
-            cur.execute(
-                """
-                SELECT sequence_id FROM statements
-                ORDER BY updated_at DESC, sequence_id DESC
-                """)
-            row = cur.fetchone()
-            if row:
-                sequence_id = (
-                    (row[0] + 1) % STATEMENT_DATA_MAX_ROWS)
-            else:
-                sequence_id = 1
+def get_default_spool_dir(file, server_base_url):
+    """
+    Returns the spool directory of the requests of log file file, stdin if
+    None, to server_base_url, so that clients reading different logs or
+    sending to different servers use different spools.
+    """
 
-            cur.execute(
-                """
-                SELECT COUNT(*) FROM statements WHERE sequence_id = ?
-                """, (sequence_id, ))
-            row = cur.fetchone()
-            created_at = datetime.datetime.now()
-            updated_at = datetime.datetime.now()
-            header_data_keys = (
-                'query_time', 'lock_time', 'rows_sent',
-                'rows_examined', 'rows_affected', 'rows_read',
-                'bytes_sent', 'tmp_tables', 'tmp_disk_tables',
-                'tmp_table_sizes')
-            data = [
-                dt, statement, server_id,
-                canonicalized_statement,
-                canonicalized_statement_hash,
-                canonicalized_statement_hostname_hash]
-            data.extend(
-                [header_data.get(k) for k in header_data_keys])
-            if row and int(row[0]):
-                data.extend((updated_at, sequence_id))
-                cur.execute(update_sql, data)
-            else:
-                data.extend((sequence_id, created_at, updated_at))
-                cur.execute(insert_sql, data)
+    source = os.path.abspath(file) if file else 'stdin'
+    h = mmh3.hash('{0}\n{1}'.format(source, server_base_url)) & 0xffffffff
+    return '{0}/sqlcanonclient-spool-{1:08x}'.format(
+        tempfile.gettempdir(), h)
 
-            # run an explain if first seen
-            if first_seen:
-                cur.execute(
-                    """
-                    SELECT dt, statement, server_id, canonicalized_statement,
-                        canonicalized_statement_hash,
-                        canonicalized_statement_hostname_hash
-                    FROM statements
-                    WHERE sequence_id=?
-                    """, (sequence_id, ))
-                statement_data_row = list(cur.fetchone())
-                if not schema:
-                    schema = DataManager.get_last_db_used()
-                statement_data_row.append(schema)
-                statement_data_row.append(created_at)
-                statement_data_row.append(updated_at)
 
+class Spool(object):
+    """
+    Durable FIFO of JSON records, kept in a directory.
+
+    Records are appended as lines of segment files, named after their
+    sequence number. A new segment is started once the last one holds
+    segment_size bytes, the oldest segments are deleted once the spool
+    holds more than max_size bytes, records not sent yet included. read()
+    returns the oldest record not committed yet, commit() marks it as sent;
+    the position of the next record is kept in the position file, so that
+    records are read again after a crash but not after they were committed.
+
+    A spool is used by a single process at a time, it is safe to use from
+    several threads.
+    """
+
+    def __init__(self, path, segment_size=SPOOL_SEGMENT_SIZE,
+            max_size=SPOOL_MAX_SIZE):
+        super(Spool, self).__init__()
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self._cond = threading.Condition()
+
+        self.appended = 0
+        self.committed = 0
+        # bytes of the segments deleted before being read
+        self.evicted = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock_file = open(os.path.join(path, 'lock'), 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._lock_file.close()
+            raise SpoolInUseError('Spool {0} is in use.'.format(path))
+
+        # sizes of the segments by sequence number
+        self._segments = {}
+        for name in os.listdir(path):
+            if name.endswith('.segment'):
+                self._segments[int(name[:-len('.segment')])] = (
+                    os.path.getsize(os.path.join(path, name)))
+        # the position of the next record to read, a segment is written
+        # by a single run, the last one may end with a partial record
+        self._position = self._load_position()
+        self._segment = max(
+            [self._position[0]] + self._segments.keys()) + 1
+        self._segments[self._segment] = 0
+        self._file = open(self._segment_path(self._segment), 'ab')
+        self._read_file = None
+        self._evict()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '{0:020d}.segment'.format(segment))
+
+    def _load_position(self):
+        try:
+            with open(os.path.join(self.path, 'position')) as f:
+                position = json.load(f)
+            return (int(position[0]), int(position[1]))
+        except (IOError, ValueError, TypeError, IndexError):
+            if self._segments:
+                return (min(self._segments), 0)
+            return (0, 0)
+
+    def _save_position(self):
+        # replace the file at once, a crash leaves either version
+        path = os.path.join(self.path, 'position')
+        tmp_path = '{0}.tmp'.format(path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self._position, f)
+        os.rename(tmp_path, path)
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        with self._cond:
+            if self._segments[self._segment] >= self.segment_size:
+                self._file.close()
+                self._segment += 1
+                self._segments[self._segment] = 0
+                self._file = open(self._segment_path(self._segment), 'ab')
+            self._file.write(line)
+            self._file.flush()
+            self._segments[self._segment] += len(line)
+            self.appended += 1
+            self._evict()
+            self._cond.notify_all()
+
+    def _evict(self):
+        # the segment written is never deleted
+        while (sum(self._segments.itervalues()) > self.max_size and
+                len(self._segments) > 1):
+            segment = min(self._segments)
+            size = self._segments[segment]
+            if segment == self._position[0]:
+                size -= self._position[1]
+            if segment >= self._position[0]:
+                self.evicted += size
+            self._delete_segment(segment)
+
+    def _delete_segment(self, segment):
+        if self._read_file is not None and self._read_file[0] == segment:
+            self._read_file[1].close()
+            self._read_file = None
+        size = self._segments.pop(segment)
+        try:
+            os.remove(self._segment_path(segment))
+        except OSError:
+            pass
+        if segment >= self._position[0]:
+            self._position = (min(self._segments), 0)
+            self._save_position()
+        return size
+
+    def _read(self):
+        """Returns (record, position after it), None if there is none."""
+
+        while True:
+            segment, offset = self._position
+            if segment not in self._segments:
+                later = [s for s in self._segments if s > segment]
+                if not later:
+                    return None
+                self._position = (min(later), 0)
+                continue
+            if self._read_file is None or self._read_file[0] != segment:
+                if self._read_file is not None:
+                    self._read_file[1].close()
+                self._read_file = (
+                    segment, open(self._segment_path(segment), 'rb'))
+            f = self._read_file[1]
+            f.seek(offset)
+            line = f.readline()
+            if line.endswith('\n'):
                 try:
-                    connection_options = DataManager.get_explain_connection_options()
-                    if schema:
-                        connection_options['db'] = schema
-                    #print 'explain connection:'
-                    #pp(connection_options)
-                    mysql_conn = MySQLdb.connect(**connection_options)
-                    with mysql_conn:
-                        mysql_cur = mysql_conn.cursor()
-
-                        cur.execute(
-                            """
-                            INSERT INTO explained_statements(
-                                dt, statement, server_id,
-                                canonicalized_statement,
-                                canonicalized_statement_hash,
-                                canonicalized_statement_hostname_hash,
-                                db, created_at, updated_at)
-                            VALUES (?,?,?,?,?,?,?,?,?)
-                            """, statement_data_row)
-                        explained_statement_id = cur.lastrowid
-
-                        try:
-                            explain_rows = DataManager.run_explain(
-                                statement, mysql_cur)
-                            for explain_row in explain_rows:
-                                values = [
-                                    explained_statement_id,
-                                    explain_row['select_id'],
-                                    explain_row['select_type'],
-                                    explain_row['table'],
-                                    explain_row['type'],
-                                    explain_row['possible_keys'],
-                                    explain_row['key'],
-                                    explain_row['key_len'],
-                                    explain_row['ref'],
-                                    explain_row['rows'],
-                                    explain_row['extra']]
-                                values.append(created_at)
-                                values.append(updated_at)
-                                cur.execute(
-                                    """
-                                    INSERT INTO explain_results(
-                                        explained_statement_id,
-                                        select_id,
-                                        select_type,
-                                        `table`,
-                                        type,
-                                        possible_keys,
-                                        key,
-                                        key_len,
-                                        ref,
-                                        rows,
-                                        extra,
-                                        created_at, updated_at)
-                                    VALUES
-                                        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?)
-                                    """, values)
-
-                        except Exception, e:
-                            print 'ERROR: {0}'.format(e)
-
-                        mysql_cur.close()
-                except Exception, e:
-                    print 'ERROR: {0}'.format(e)
+                    return (json.loads(line), (segment, offset + len(line)))
+                except ValueError:
+                    print 'ERROR: skipping spool record {0}'.format(
+                        self._position)
+                    self._position = (segment, offset + len(line))
+                    continue
+            if segment == self._segment:
+                return None
+            # the end of a segment, a partial record was never committed
+            self._delete_segment(segment)
 
-            cur.close()
+    def read(self, timeout=None):
+        """
+        Returns (record, position) of the oldest record not committed yet,
+        None if no record was appended within timeout seconds.
+        """
+
+        with self._cond:
+            item = self._read()
+            if item is None and timeout:
+                self._cond.wait(timeout)
+                item = self._read()
+            return item
+
+    def commit(self, position):
+        """Marks the records before position as sent."""
+
+        with self._cond:
+            if self._position[0] <= position[0] and position[0] in (
+                    self._segments):
+                for segment in [s for s in self._segments
+                        if s < position[0]]:
+                    self._delete_segment(segment)
+                self._position = position
+                self._save_position()
+                self.committed += 1
+            self._cond.notify_all()
+
+    def is_empty(self):
+        with self._cond:
+            return self._read() is None
+
+    def join(self, timeout):
+        """
+        Waits up to timeout seconds for the records to be committed, returns
+        True if they were.
+        """
+
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._read() is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self):
+        with self._cond:
+            self._file.close()
+            if self._read_file is not None:
+                self._read_file[1].close()
+                self._read_file = None
+            if not self._segments[self._segment]:
+                self._delete_segment(self._segment)
+            self._lock_file.close()
+
+    def __str__(self):
+        return (
+            '{0} record(s) appended, {1} sent, {2} byte(s) evicted'.format(
+                self.appended, self.committed, self.evicted))
 
 
 class ServerData:
     """Encapsulates server submissions."""
 
+    # connection to the server, opened by init(); EXPLAIN_QUEUE threads
+    # open one of their own in LOCAL
+    CONNECTION = None
+    CONNECTION_OPTIONS = {}
+    LOCAL = threading.local()
+
+    # requests are appended to SPOOL and sent by the SENDER thread, over
+    # CONNECTION; without a spool they are sent at once
+    SPOOL = None
+    SENDER = None
+    STOP = threading.Event()
+
+    # (statement data, last db used) of the statements not sent yet
+    BATCH = []
+    BATCH_SIZE = SERVER_BATCH_SIZE
+    FLUSH_INTERVAL = SERVER_FLUSH_INTERVAL
+    BATCH_STARTED_AT = None
+
+    # in aggregation mode, (statement stats, last db used) of the statements
+    # not sent yet by canonicalized statement hostname hash; statement stats
+    # are the statement data of the first statement along with the count,
+    # sums, minimums and maximums of STATS_KEYS of the statements
+    AGGREGATE = False
+    STATS = {}
+    STATS_KEYS = ('query_time', 'lock_time', 'rows_examined', 'rows_sent')
+
+    # guards BATCH and STATS, flushed by FLUSHER too once they waited
+    # FLUSH_INTERVAL; FLUSHER posts over a connection of its own in LOCAL
+    LOCK = threading.RLock()
+    FLUSHER = None
+
+    @staticmethod
+    def init(base_url, batch_size=SERVER_BATCH_SIZE,
+            flush_interval=SERVER_FLUSH_INTERVAL, aggregate=False,
+            compress=True, retries=SERVER_RETRIES, spool_dir=None,
+            spool_max_size=SPOOL_MAX_SIZE):
+        """
+        Opens CONNECTION and, if spool_dir is given, the spool along with
+        its sender thread; raises SpoolInUseError if another client uses
+        spool_dir.
+        """
+
+        ServerData.close()
+        ServerData.CONNECTION_OPTIONS = dict(
+            base_url=base_url, compress=compress, retries=retries)
+        ServerData.CONNECTION = ServerConnection(
+            **ServerData.CONNECTION_OPTIONS)
+        ServerData.LOCAL.connection = ServerData.CONNECTION
+        ServerData.BATCH_SIZE = batch_size
+        ServerData.FLUSH_INTERVAL = flush_interval
+        ServerData.AGGREGATE = aggregate
+        if spool_dir:
+            ServerData.SPOOL = Spool(
+                spool_dir,
+                segment_size=min(SPOOL_SEGMENT_SIZE, spool_max_size / 4),
+                max_size=spool_max_size)
+            ServerData.STOP.clear()
+            ServerData.SENDER = threading.Thread(
+                target=ServerData.send_spooled, name='spool-sender')
+            ServerData.SENDER.daemon = True
+            ServerData.SENDER.start()
+        # statements, and statement stats in particular, are sent once they
+        # waited FLUSH_INTERVAL even if no other statement is saved
+        if flush_interval > 0:
+            ServerData.FLUSHER = Flusher(
+                ServerData.flush_if_due, flush_interval / 1000.0)
+            ServerData.FLUSHER.start()
+
+    @staticmethod
+    def close(drain_timeout=0):
+        """
+        Sends the statements not sent yet, waits up to drain_timeout seconds
+        for the spool to be sent, stops the sender thread and closes
+        CONNECTION. What is left in the spool is sent the next time it is
+        opened.
+        """
+
+        if ServerData.FLUSHER is not None:
+            ServerData.FLUSHER.stop()
+            ServerData.FLUSHER = None
+        if ServerData.CONNECTION is not None:
+            ServerData.flush()
+            if ServerData.SPOOL is not None:
+                ServerData.drain(drain_timeout)
+                ServerData.STOP.set()
+                ServerData.SENDER.join()
+                ServerData.SENDER = None
+                ServerData.SPOOL.close()
+                ServerData.SPOOL = None
+            ServerData.CONNECTION.close()
+            ServerData.CONNECTION = None
+            ServerData.LOCAL.connection = None
+
+    @staticmethod
+    def drain(timeout):
+        """
+        Waits up to timeout seconds for the spool to be sent, returns True
+        if it was.
+        """
+
+        if ServerData.SPOOL is None:
+            return True
+        return ServerData.SPOOL.join(timeout)
+
     @staticmethod
     def save_statement_data(
             statement, hostname,
             canonicalized_statement, canonicalized_statement_hash,
             canonicalized_statement_hostname_hash,
             header_data):
+        """Saves statement data.
+
+        Statement data are sent in batches by flush(), or one at a time if
+        BATCH_SIZE is 0. In aggregation mode, they are added to the statement
+        stats sent by flush().
+        """
 
         data = dict(
             statement=statement,
@@ -1418,26 +4701,225 @@ class ServerData:
         # extra data
         data['server_id'] = OPTIONS.server_id
 
-        # urllib doesnt like unicode objects so we pack our data
-        # in a json string
-        data_json = json.dumps(data)
-        params = dict(data=data_json)
+        if ServerData.AGGREGATE:
+            ServerData.aggregate_statement_data(data, header_data)
+            return
+
+        if ServerData.BATCH_SIZE <= 0:
+            # servers without the bulk path
+            ServerData.submit(
+                OPTIONS.save_statement_data_path, data,
+                [DataManager.get_last_db_used()])
+            return
+
+        with ServerData.LOCK:
+            if not ServerData.BATCH:
+                ServerData.BATCH_STARTED_AT = time.time()
+            ServerData.BATCH.append((data, DataManager.get_last_db_used()))
+            due = ServerData.is_batch_due()
+        if due:
+            ServerData.flush()
+
+    @staticmethod
+    def aggregate_statement_data(data, header_data):
+        """Adds statement data to STATS."""
+
+        with ServerData.LOCK:
+            now = time.time()
+            if not ServerData.STATS:
+                ServerData.BATCH_STARTED_AT = now
+            key = data['canonicalized_statement_hostname_hash']
+            if key in ServerData.STATS:
+                stats = ServerData.STATS[key][0]
+            else:
+                stats = dict(data, count=0, dt_start=now)
+                ServerData.STATS[key] = (stats, DataManager.get_last_db_used())
+            stats['count'] += 1
+            stats['dt_end'] = now
+            for k in ServerData.STATS_KEYS:
+                try:
+                    value = float(header_data[k])
+                except (KeyError, ValueError):
+                    continue
+                if stats.get(k + '_sum') is None:
+                    stats[k + '_sum'] = value
+                    stats[k + '_min'] = value
+                    stats[k + '_max'] = value
+                else:
+                    stats[k + '_sum'] += value
+                    stats[k + '_min'] = min(stats[k + '_min'], value)
+                    stats[k + '_max'] = max(stats[k + '_max'], value)
+            due = ServerData.is_batch_due()
+        if due:
+            ServerData.flush()
+
+    @staticmethod
+    def submit(path, data, last_dbs_used=None):
+        """
+        Sends data to path, through the spool if there is one.
+
+        last_dbs_used are the last dbs used when the statements of data
+        were read, in order, the EXPLAIN statements the server asks for are
+        run there. Every request gets its own idempotency key, kept along
+        with it in the spool, so the server saves data sent again once.
+        """
+
+        record = dict(
+            path=path, data=data, last_dbs_used=last_dbs_used or [],
+            key=uuid.uuid4().hex,
+            server_base_url=ServerData.CONNECTION_OPTIONS['base_url'])
+        if ServerData.SPOOL is not None:
+            ServerData.SPOOL.append(record)
+            return
+        response = ServerData.post(path, data, record['key'])
+        if response:
+            try:
+                ServerData.process_explain_requests(record, response.content)
+            except Exception, e:
+                print 'ERROR: {0}'.format(e)
+
+    @staticmethod
+    def send_spooled():
+        """
+        Sends the spool to the server until STOP is set, in the SENDER
+        thread.
+
+        A request failing, answered with a SERVER_RETRY_STATUSES status or
+        with an error, the server rolled it back, stays in the spool and is
+        sent again after SPOOL_RETRY_DELAY seconds, then twice as long every
+        time; a request answered with any other error status is dropped, as
+        is a request spooled for another server.
+        """
+
+        ServerData.LOCAL.connection = ServerData.CONNECTION
+        base_url = ServerData.CONNECTION_OPTIONS['base_url']
+        delay = SPOOL_RETRY_DELAY
+        while not ServerData.STOP.is_set():
+            item = ServerData.SPOOL.read(0.1)
+            if item is None:
+                continue
+            record, position = item
+            # records spooled by earlier versions have no server base URL
+            if record.get('server_base_url', base_url) != base_url:
+                print 'ERROR: request spooled for {0}, dropped'.format(
+                    record['server_base_url'])
+                ServerData.SPOOL.commit(position)
+                continue
+            # paths are read back as unicode, httplib wants them as str;
+            # records spooled by earlier versions have no key
+            path = str(record['path'])
+            key = record.get('key') and str(record['key'])
+            try:
+                response = ServerData.CONNECTION.post(
+                    path, record['data'], key)
+            except (httplib.HTTPException, socket.error), e:
+                print 'ERROR: {0}'.format(e)
+                response = None
+            except Exception, e:
+                print 'ERROR: {0}, request dropped'.format(e)
+                ServerData.SPOOL.commit(position)
+                continue
+            if response is not None and response.error:
+                print 'ERROR: {0} from {1}'.format(response.error, path)
+                response = None
+            if response is None or response.code in SERVER_RETRY_STATUSES:
+                if response is not None:
+                    print 'ERROR: HTTP {0} from {1}'.format(
+                        response.code, path)
+                ServerData.STOP.wait(delay)
+                delay = min(delay * 2, SPOOL_MAX_RETRY_DELAY)
+                continue
+            delay = SPOOL_RETRY_DELAY
+            if response.code == 200:
+                try:
+                    ServerData.process_explain_requests(
+                        record, response.content)
+                except Exception, e:
+                    print 'ERROR: {0}'.format(e)
+            else:
+                print 'ERROR: HTTP {0} from {1}, request dropped'.format(
+                    response.code, path)
+            ServerData.SPOOL.commit(position)
+
+    @staticmethod
+    def post(path, data, key=None):
+        """
+        Posts data to path over the connection of the calling thread, with
+        the idempotency key key, returns the response, None if the request
+        failed or was answered with an error.
+        """
 
         try:
-            urlencoded_params = urllib.urlencode(params)
-            response = url_request(
-                OPTIONS.server_base_url + OPTIONS.save_statement_data_path,
-                data=urlencoded_params)
-            return response
+            response = ServerData.get_connection().post(path, data, key)
         except Exception, e:
+            print 'ERROR: {0}'.format(e)
+            return None
+        if response.code != 200:
+            print 'ERROR: HTTP {0} from {1}'.format(response.code, path)
+            return None
+        if response.error:
+            print 'ERROR: {0} from {1}'.format(response.error, path)
             return None
+        return response
+
+    @staticmethod
+    def get_connection():
+        connection = getattr(ServerData.LOCAL, 'connection', None)
+        if connection is None:
+            options = dict(base_url=OPTIONS.server_base_url)
+            options.update(ServerData.CONNECTION_OPTIONS)
+            connection = ServerConnection(**options)
+            ServerData.LOCAL.connection = connection
+        return connection
+
+    @staticmethod
+    def flush():
+        """
+        Sends the statements, or the statement stats, not sent yet in a
+        single request.
+        """
+
+        with ServerData.LOCK:
+            if ServerData.STATS:
+                batch = ServerData.STATS.values()
+                ServerData.STATS = {}
+                path = OPTIONS.save_statement_stats_path
+            elif ServerData.BATCH:
+                batch = ServerData.BATCH
+                ServerData.BATCH = []
+                path = OPTIONS.save_statement_data_bulk_path
+            else:
+                return
+            ServerData.BATCH_STARTED_AT = None
+        ServerData.submit(
+            path,
+            [data for data, __ in batch],
+            [last_db_used for __, last_db_used in batch])
+
+    @staticmethod
+    def flush_if_due():
+        """Sends the statements not sent yet if they are due, in FLUSHER."""
+
+        with ServerData.LOCK:
+            due = ServerData.is_batch_due()
+        if due:
+            ServerData.flush()
+
+    @staticmethod
+    def is_batch_due():
+        if not ServerData.AGGREGATE and (
+                len(ServerData.BATCH) >= ServerData.BATCH_SIZE):
+            return True
+        return (ServerData.BATCH_STARTED_AT is not None and
+            (time.time() - ServerData.BATCH_STARTED_AT) * 1000 >=
+                ServerData.FLUSH_INTERVAL)
 
     @staticmethod
     def save_explained_statement(
             statement_data_id, explain_rows, db=''):
         data = dict(
             statement_data_id=statement_data_id,
-            explain_rows=json.dumps(explain_rows),
+            explain_rows=explain_rows,
         )
 
         if db is None:
@@ -1446,60 +4928,76 @@ class ServerData:
 
         data['server_id'] = OPTIONS.server_id
 
-        # urllib doesn't like unicode objects so we pack our data
-        # inside a json string
-        data_json = json.dumps(data)
-        params = dict(data=data_json)
-        try:
-            urlencoded_params = urllib.urlencode(params)
-            response = url_request(
-                OPTIONS.server_base_url + OPTIONS.save_explained_statement_path,
-                data=urlencoded_params)
-            return response
-        except Exception, e:
-            return None
+        ServerData.submit(OPTIONS.save_explained_statement_path, data)
 
     @staticmethod
-    def process_explain_requests(save_statement_data_response_content):
-        #print 'process_explain_requests():'
-        response = json.loads(save_statement_data_response_content)
-        explain_items = response.get('explain', [])
-        #print 'explain_items:'
-        #pp(explain_items)
-        schema = response.get('schema')
-        #print 'schema: %s' % (schema,)
-        if explain_items:
-            explain_connection_options = DataManager.get_explain_connection_options()
-            if schema:
-                explain_connection_options['db'] = schema
-            #print 'explain_connection_options:'
-            #pp(explain_connection_options)
-            try:
-                conn = MySQLdb.connect(**explain_connection_options)
-                with conn:
-                    cur = conn.cursor()
-                    for explain_item in explain_items:
-                        statement = explain_item['statement']
-                        statement_data_id = explain_item['statement_data_id']
-
-                        try:
-                            explain_rows = DataManager.run_explain(
-                                statement, cur)
-                            for row in explain_rows:
-                                pp(row )
-
-                            ServerData.save_explained_statement(
-                                statement_data_id,
-                                explain_rows,
-                                explain_connection_options.get('db', ''))
-
-                        except Exception, e:
-                            print ((
-                                'ServerData.process_explain_requests() > '
-                                'error while running EXPLAIN: {0}')
-                                .format(e))
-            except Exception, e:
-                print '%s: %s' % (type(e), e)
+    def process_explain_requests(record, response_content):
+        """
+        Queues the EXPLAIN statements asked for by the server in response
+        to record, a submit() record.
+
+        Responses to batches give the index of the statement to explain in
+        the batch, responses to single statements give no index.
+        """
+
+        response = json.loads(response_content)
+        statements = record['data']
+        if isinstance(statements, dict):
+            statements = [statements]
+        for explain_item in response.get('explain', []):
+            index = explain_item.get('index', 0)
+            if response.get('schema') and not explain_item.get('schema'):
+                explain_item['schema'] = response['schema']
+            last_dbs_used = record['last_dbs_used']
+            ServerData.queue_explain(
+                explain_item,
+                statements[index]['canonicalized_statement_hostname_hash'],
+                last_dbs_used[index] if index < len(last_dbs_used) else None)
+
+    @staticmethod
+    def queue_explain(explain_item, canonicalized_statement_hostname_hash,
+            last_db_used):
+        explain_connection_options = (
+            DataManager.get_explain_connection_options())
+        if explain_item.get('schema'):
+            explain_connection_options['db'] = explain_item['schema']
+        elif 'd' not in EXPLAIN_OPTIONS:
+            # the last db used when the statement was read
+            explain_connection_options.pop('db', None)
+            if last_db_used:
+                explain_connection_options['db'] = last_db_used
+        EXPLAIN_QUEUE.submit(
+            canonicalized_statement_hostname_hash,
+            lambda: ServerData.explain_statements(
+                [explain_item], explain_connection_options))
+
+    @staticmethod
+    def explain_statements(explain_items, explain_connection_options):
+        try:
+            with EXPLAIN_CONNECTIONS.connection(
+                    explain_connection_options) as conn:
+                for explain_item in explain_items:
+                    statement = explain_item['statement']
+                    statement_data_id = explain_item['statement_data_id']
+
+                    try:
+                        explain_rows = DataManager.explain(
+                            statement, conn, explain_connection_options)
+                        for row in explain_rows:
+                            pp(row )
+
+                        ServerData.save_explained_statement(
+                            statement_data_id,
+                            explain_rows,
+                            explain_connection_options.get('db', ''))
+
+                    except Exception, e:
+                        print ((
+                            'ServerData.process_explain_requests() > '
+                            'error while running EXPLAIN: {0}')
+                            .format(e))
+        except Exception, e:
+            print '%s: %s' % (type(e), e)
 
 
 class DataManager:
@@ -1515,26 +5013,61 @@ class DataManager:
 
     @staticmethod
     def save_data(log_item_parser):
-        results = canonicalize_statement(log_item_parser.statement)
+        DataManager.save_canonicalized_data(
+            log_item_parser,
+            DataManager.canonicalize_data(log_item_parser.statement))
+
+    @staticmethod
+    def canonicalize_data(statement):
+        """
+        Canonicalizes and hashes statement(s) of a log item.
+
+        Yields
+            (
+                statement,
+                normalized statement,
+                canonicalized statement,
+                canonicalized statement hash,
+                canonicalized statement hostname hash
+            )
+        for every statement, hashes are None for statements that are not saved.
+        """
+
+        results = canonicalize_statement(statement)
         for (statement, normalized_statement, canonicalized_statement,
              __) in results:
-            if normalized_statement.lower().startswith('use '):
-                DataManager.set_last_db_used(
-                    normalized_statement[4:].strip('; '))
-
             # skip processing of blank statements and
             # those that start with SET timestamp=
             skip = (not normalized_statement.strip() or
                 normalized_statement.strip().startswith(u'SET timestamp='))
-            if not skip:
+            if skip:
+                yield (statement, normalized_statement, canonicalized_statement,
+                    None, None)
+            else:
+                yield (statement, normalized_statement, canonicalized_statement,
+                    mmh3.hash(canonicalized_statement),
+                    mmh3.hash(
+                        '{0}{1}'.format(canonicalized_statement, HOSTNAME)))
+
+    @staticmethod
+    def save_canonicalized_data(log_item_parser, canonicalized_data):
+        """Saves canonicalize_data() results of a log item."""
+
+        for (statement, normalized_statement, canonicalized_statement,
+             canonicalized_statement_hash,
+             canonicalized_statement_hostname_hash) in canonicalized_data:
+            if normalized_statement.lower().startswith('use '):
+                DataManager.set_last_db_used(
+                    normalized_statement[4:].strip('; '))
+
+            if canonicalized_statement_hash is not None:
                 DataManager.save_statement_data(
                     log_item_parser.dt,
                     statement,
                     HOSTNAME,
                     canonicalized_statement,
-                    mmh3.hash(canonicalized_statement),
-                    mmh3.hash(
-                        '{0}{1}'.format(canonicalized_statement, HOSTNAME)),
+                    canonicalized_statement_hash,
+                    canonicalized_statement_hostname_hash,
                     log_item_parser.header_data)
 
 
@@ -1552,16 +5085,20 @@ class DataManager:
                 canonicalized_statement_hostname_hash,
                 header_data)
         else:
-            response = ServerData.save_statement_data(
+            ServerData.save_statement_data(
                 statement, hostname,
                 canonicalized_statement, canonicalized_statement_hash,
                 canonicalized_statement_hostname_hash,
                 header_data)
-            if response:
-                try:
-                    ServerData.process_explain_requests(response.content)
-                except Exception, e:
-                    print 'ERROR: {0}'.format(e)
+
+    @staticmethod
+    def flush_statement_data():
+        """Saves the statement data not saved yet."""
+
+        if OPTIONS.stand_alone:
+            LocalData.flush()
+        else:
+            ServerData.flush()
 
     @staticmethod
     def get_explain_connection_options():
@@ -1586,6 +5123,26 @@ class DataManager:
 
         return connection_options
 
+    @staticmethod
+    def explain(statement, conn, connection_options):
+        """
+        Returns the run_explain() rows of statement on conn, connected with
+        connection_options. The EXPLAIN is killed if it runs for longer than
+        EXPLAIN_QUEUE.timeout seconds.
+        """
+
+        cursor = conn.cursor()
+        timer = ExplainTimer(conn, connection_options, EXPLAIN_QUEUE.timeout)
+        try:
+            return DataManager.run_explain(statement, cursor)
+        except Exception:
+            if timer.killed:
+                EXPLAIN_QUEUE.count_timeout()
+            raise
+        finally:
+            timer.stop()
+            cursor.close()
+
     @staticmethod
     def run_explain(statement, cursor):
         sql = 'EXPLAIN {0}'.format(statement)
@@ -1639,6 +5196,9 @@ class GeneralQueryLogItemParser(object):
         #    self.statement = match.group('query')
         #else:
         #    self.statement = None
+        if isinstance(lines_to_parse, str):
+            # only the statement is decoded, log lines are read as bytes
+            lines_to_parse = get_unicode_string(lines_to_parse)
         self.statement = lines_to_parse
         return self.statement
 
@@ -1646,8 +5206,9 @@ class GeneralQueryLogItemParser(object):
 class MySqlGenQueryLogQueryReader(MySqlGenQueryLogReader):
     """Parses MySQL general query log for Query commands."""
 
-    def __init__(self):
+    def __init__(self, checkpointer=None):
         super(MySqlGenQueryLogQueryReader, self).__init__()
+        self.checkpointer = checkpointer
 
     def got_log_item(self, dt=None, cid=None, cmd=None, arg=None):
         if cmd and cmd.strip().lower() == 'query':
@@ -1657,6 +5218,35 @@ class MySqlGenQueryLogQueryReader(MySqlGenQueryLogReader):
             if log_item_parser.parse_statement(arg):
                 print log_item_parser.statement
                 DataManager.save_data(log_item_parser)
+        if self.checkpointer is not None:
+            self.checkpointer.processed(*self.item_offsets)
+
+    def read_file(self, path):
+        """
+        Reads MySQL general query log file, from the last checkpoint of
+        self.checkpointer if any.
+        """
+
+        with open(path, 'rb', LOG_READ_BUFFER_SIZE) as f:
+            offset = 0
+            if self.checkpointer is not None:
+                offset = self.checkpointer.resume(f)
+                f.seek(offset)
+            self.read_lines(f, skip_header=(offset == 0), offset=offset)
+            if self.checkpointer is not None:
+                self.checkpointer.save()
+
+    def follow_lines(self, follower):
+        """
+        Reads MySQL general query log file as it is written, see LogFollower.
+
+        A log item is processed once the next one starts or nothing was
+        written for a while.
+        """
+
+        for source in follower.sources():
+            self.read_lines(
+                source, skip_header=(source.offset == 0), offset=source.offset)
 
 
 # TODO: remove this class, this is superseded by MySqlGenQueryLogQueryReader.
@@ -1734,98 +5324,55 @@ class GeneralQueryLogProcessor(object):
 
 def print_top_queries(n):
     """Prints top N queries."""
-    conn = sqlite3.connect(LocalData.DB)
-    with conn:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT
-                canonicalized_statement,
-                server_id,
-                canonicalized_statement_hostname_hash,
-                COUNT(id)
-            FROM statements
-            GROUP BY
-                canonicalized_statement,
-                server_id,
-                canonicalized_statement_hostname_hash
-            ORDER BY COUNT(id) DESC
-            LIMIT ?
-            """, (n,))
-        rows = cur.fetchall()
+    rows = LocalData.get_top_queries(n)
 
-        print 'Top {0} Queries:'.format(n)
-        print 'Columns: canonicalized_statement_hostname_hash, COUNT(id), canonicalized_statement'
-        for row in rows:
-            print '{0} | {1} | {2}'.format(
-                int_to_hex_str(row[2]), str(row[3]).rjust(4), row[0])
+    print 'Top {0} Queries:'.format(n)
+    print 'Columns: canonicalized_statement_hostname_hash, COUNT(id), canonicalized_statement'
+    for row in rows:
+        print '{0} | {1} | {2}'.format(
+            int_to_hex_str(row[2]), str(row[3]).rjust(4), row[0])
 
 
 def local_run_last_statements(window_length):
     """Shows a sliding window of last statements seen."""
 
-    conn = sqlite3.connect(LocalData.DB)
-    with conn:
-        cur = conn.cursor()
-        while True:
-            try:
-                dt = datetime.datetime.now()
-                dt_start = dt - datetime.timedelta(minutes=window_length)
-                cur.execute(
-                    """
-                    SELECT
-                        canonicalized_statement,
-                        server_id,
-                        canonicalized_statement_hostname_hash,
-                        canonicalized_statement_hash,
-                        statement,
-                        MAX(dt),
-                        COUNT(dt)
-                    FROM statements
-                    WHERE (dt>=?) AND (dt<=?)
-                    GROUP BY
-                        canonicalized_statement,
-                        server_id,
-                        canonicalized_statement_hostname_hash,
-                        canonicalized_statement_hash,
-                        statement
-                    ORDER BY MAX(dt)
-                    """, (dt_start, dt))
+    while True:
+        try:
+            dt = datetime.datetime.now()
+            dt_start = dt - datetime.timedelta(minutes=window_length)
+            rows = LocalData.get_last_statements(dt_start, dt)
+            row_count = len(rows)
+
+            # calculate counts
+            counts = {}
+            for row in rows:
+                canonicalized_statement_hostname_hash = row[2]
+                if canonicalized_statement_hostname_hash in counts:
+                    counts[canonicalized_statement_hostname_hash] += (
+                        row[6])
+                else:
+                    counts[canonicalized_statement_hostname_hash] = (
+                        row[6])
 
-                rows = cur.fetchall()
-                row_count = len(rows)
-
-                # calculate counts
-                counts = {}
-                for row in rows:
-                    canonicalized_statement_hostname_hash = row[2]
-                    if canonicalized_statement_hostname_hash in counts:
-                        counts[canonicalized_statement_hostname_hash] += (
-                            row[6])
-                    else:
-                        counts[canonicalized_statement_hostname_hash] = (
-                            row[6])
-
-                statements = []
-                print (
-                    'Statements found in the last {0} minute(s): '
-                    '{1} statement(s)').format(
-                    window_length, row_count)
-                print 'Columns: datetime, canonicalized_statement_hostname_hash, count, statement'
-                for row in rows:
-                    canonicalized_statement_hostname_hash = row[2]
-                    count = counts[canonicalized_statement_hostname_hash]
-                    print u'{0} | {1} | {2} | {3} '.format(
-                        row[5], int_to_hex_str(row[2]), str(count).rjust(4),
-                        row[4])
-                print
-                print
-
-                time.sleep(1)
+            statements = []
+            print (
+                'Statements found in the last {0} minute(s): '
+                '{1} statement(s)').format(
+                window_length, row_count)
+            print 'Columns: datetime, canonicalized_statement_hostname_hash, count, statement'
+            for row in rows:
+                canonicalized_statement_hostname_hash = row[2]
+                count = counts[canonicalized_statement_hostname_hash]
+                print u'{0} | {1} | {2} | {3} '.format(
+                    row[5], int_to_hex_str(row[2]), str(count).rjust(4),
+                    row[4])
+            print
+            print
 
-            except (KeyboardInterrupt, SystemExit):
-                break
-        cur.close()
+            time.sleep(1)
+
+        except (KeyboardInterrupt, SystemExit):
+            break
 
 
 def main():
@@ -1841,11 +5388,58 @@ def main():
         print 'Stand alone required.'
         sys.exit()
 
+    if OPTIONS.aggregate and OPTIONS.stand_alone:
+        print 'Client-server mode required.'
+        sys.exit()
+
+    if OPTIONS.follow and not OPTIONS.file:
+        print 'Log file required to follow.'
+        sys.exit()
+
     if OPTIONS.stand_alone:
-        LocalData.init_db(OPTIONS.db)
+        LocalData.init_db(
+            OPTIONS.db, OPTIONS.sqlite_synchronous,
+            int(OPTIONS.statement_data_max_rows),
+            int(OPTIONS.sqlite_batch_size),
+            int(OPTIONS.sqlite_flush_interval),
+            int(OPTIONS.bloom_filter_capacity))
+    else:
+        spool_dir = None
+        if not OPTIONS.no_spool:
+            spool_dir = OPTIONS.spool_dir or get_default_spool_dir(
+                OPTIONS.file, OPTIONS.server_base_url)
+        try:
+            ServerData.init(
+                OPTIONS.server_base_url,
+                int(OPTIONS.server_batch_size),
+                int(OPTIONS.server_flush_interval),
+                OPTIONS.aggregate,
+                not OPTIONS.no_server_compression,
+                int(OPTIONS.server_retries),
+                spool_dir,
+                int(OPTIONS.spool_max_size) * 1024 * 1024)
+        except SpoolInUseError, e:
+            print '{0} Use --spool-dir to give another one.'.format(e)
+            sys.exit()
 
     DataManager.set_last_db_used(None)
 
+    global CANONICALIZATION_ENGINE
+    CANONICALIZATION_ENGINE = OPTIONS.canonicalization_engine
+    if (CANONICALIZATION_ENGINE == 'lexer' and
+            sqlparse.__version__ != LEXER_SQLPARSE_VERSION):
+        print (
+            'The lexer engine requires sqlparse {0}, found {1}, '
+            'using the sqlparse engine.'.format(
+                LEXER_SQLPARSE_VERSION, sqlparse.__version__))
+        CANONICALIZATION_ENGINE = 'sqlparse'
+    FINGERPRINT_CACHE.resize(int(OPTIONS.fingerprint_cache_size))
+
+    global EXPLAIN_QUEUE
+    EXPLAIN_QUEUE = ExplainQueue(
+        int(OPTIONS.explain_workers), int(OPTIONS.explain_queue_size),
+        float(OPTIONS.explain_timeout))
+
     # parse explain options
     global EXPLAIN_OPTIONS
     if OPTIONS.explain_options:
@@ -1867,6 +5461,8 @@ def main():
         # make sure that port is integer
         EXPLAIN_OPTIONS['P'] = int(EXPLAIN_OPTIONS['P'])
 
+    checkpointer = create_log_checkpointer()
+
     is_file_slow_query_log = (OPTIONS.type == 's')
     is_file_general_query_log = (OPTIONS.type == 'g')
 
@@ -1883,46 +5479,78 @@ def main():
             print_top_queries(OPTIONS.print_top_queries)
             sys.exit()
 
-        if is_file_slow_query_log and OPTIONS.file:
+        if is_file_slow_query_log and OPTIONS.file and OPTIONS.follow:
+            print (
+                'Following MySQL slow query log file = {0}'
+                .format(OPTIONS.file))
+            slow_query_log_processor = SlowQueryLogProcessor(
+                checkpointer=checkpointer)
+            follow_log_file(
+                slow_query_log_processor.follow_log_file, checkpointer)
+
+        elif is_file_slow_query_log and OPTIONS.file:
             print (
                 'MySQL slow query log file = {0}'
                 .format(OPTIONS.file))
-            slow_query_log_processor = SlowQueryLogProcessor()
-            with codecs.open(OPTIONS.file, encoding=OPTIONS.encoding,
-                    errors=OPTIONS.encoding_errors) as f:
-                slow_query_log_processor.process_log_contents(f)
+            slow_query_log_processor = SlowQueryLogProcessor(
+                workers=int(OPTIONS.workers), checkpointer=checkpointer)
+            slow_query_log_processor.process_log_file(OPTIONS.file)
 
         elif is_file_slow_query_log and not OPTIONS.file:
             print 'Reading MySQL slow query log from stdin...'
-            query_log_processor = SlowQueryLogProcessor()
-            f = codecs.getreader(OPTIONS.encoding)(
-                sys.stdin, errors=OPTIONS.encoding_errors)
-            query_log_processor.process_log_contents(f)
+            query_log_processor = SlowQueryLogProcessor(
+                workers=int(OPTIONS.workers))
+            query_log_processor.process_log_contents(sys.stdin)
+
+        elif is_file_general_query_log and OPTIONS.file and OPTIONS.follow:
+            print (
+                'Following MySQL general query log file = {0}'
+                .format(OPTIONS.file))
+            query_log_processor = MySqlGenQueryLogQueryReader(checkpointer)
+            follow_log_file(query_log_processor.follow_lines, checkpointer)
 
         elif is_file_general_query_log and OPTIONS.file:
             print (
                 'MySQL general query log file = {0}'
                 .format(OPTIONS.file))
             #query_log_processor = GeneralQueryLogProcessor()
-            query_log_processor = MySqlGenQueryLogQueryReader()
-            with codecs.open(OPTIONS.file, encoding=OPTIONS.encoding,
-                    errors=OPTIONS.encoding_errors) as f:
-                #query_log_processor.process_log_contents(f)
-                query_log_processor.read_lines(f)
+            query_log_processor = MySqlGenQueryLogQueryReader(checkpointer)
+            #query_log_processor.process_log_contents(f)
+            query_log_processor.read_file(OPTIONS.file)
 
         elif is_file_general_query_log and not OPTIONS.file :
             print 'Reading MySQL general query log from stdin...'
             #query_log_processor = GeneralQueryLogProcessor()
             query_log_processor = MySqlGenQueryLogQueryReader()
-            f = codecs.getreader(OPTIONS.encoding)(
-                sys.stdin, errors=OPTIONS.encoding_errors)
-            #query_log_processor.process_log_contents(f)
-            query_log_processor.read_lines(f)
+            #query_log_processor.process_log_contents(sys.stdin)
+            query_log_processor.read_lines(sys.stdin)
 
     except Exception, e:
         print 'An error has occurred: {0}'.format(e)
         #traceback.print_exc()
 
+    finally:
+        # the last statements sent may ask for EXPLAIN statements, the
+        # queue is closed once the spool is sent and no more can be asked
+        # for; their results are then sent without the spool
+        if not OPTIONS.stand_alone:
+            server_connection = ServerData.CONNECTION
+            server_spool = ServerData.SPOOL
+            ServerData.close(SPOOL_DRAIN_TIMEOUT)
+        EXPLAIN_QUEUE.close()
+        if OPTIONS.stand_alone:
+            LocalData.close_db()
+        EXPLAIN_CONNECTIONS.close()
+
+    if OPTIONS.stats:
+        print 'Fingerprint cache: {0} hit(s), {1} miss(es)'.format(
+            FINGERPRINT_CACHE.hits, FINGERPRINT_CACHE.misses)
+        print 'EXPLAIN queue: {0}'.format(EXPLAIN_QUEUE)
+        if not OPTIONS.stand_alone:
+            print 'Server: {0}'.format(server_connection)
+            if server_spool is not None:
+                print 'Spool: {0}'.format(server_spool)
+
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,17 @@
 from tests.sqlcanonclient_test import (
     QueryCanonicalizationTest,
+    FingerprintCacheTest,
+    CanonicalizationEngineTest,
+    SlowQueryLogWorkersTest,
+    LogDecodingTest,
+    LogFollowTest,
+    LogCheckpointTest,
+    LocalDataTest,
+    BloomFilterTest,
+    MySqlConnectionPoolTest,
+    ExplainQueueTest,
+    SpoolTest,
+    ServerDataTest,
     MysqlSlowQueryLogParsingTest,
     MySqlGenQueryLogParsingTest)
 from tests.old_tests import CanonicalizeSqlTests, QueryListerTests
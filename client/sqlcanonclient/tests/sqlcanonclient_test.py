@@ -1,14 +1,26 @@
 #!/usr/bin/env python
 
 import argparse
+import BaseHTTPServer
 import codecs
+import datetime
+import json
 import os
 import pprint
+import shutil
+import socket
 import sqlite3
+import StringIO
+import sys
 import tempfile
+import threading
+import time
 import unittest
+import zlib
 
+import mmh3
 import MySQLdb
+import sqlparse
 import yaml
 
 import sqlcanonclient
@@ -55,6 +67,1586 @@ class QueryCanonicalizationTest(unittest.TestCase):
         self._test_canonicalize_statement(original_queries, parameterized_queries)
 
 
+class FingerprintCacheTest(unittest.TestCase):
+    """Tests for the fingerprint cache in front of canonicalize_statement."""
+
+    def setUp(self):
+        class FakeOptions:
+            def __init__(self):
+                self.no_skip_unknowns = False
+        sqlcanonclient.OPTIONS = FakeOptions()
+        self.cache = sqlcanonclient.FingerprintCache(max_size=2)
+        self.uncached = sqlcanonclient.FingerprintCache(max_size=0)
+
+    def _test_same_as_uncached(self, statements):
+        for statement in statements:
+            self.assertEqual(
+                self.uncached.canonicalize(statement),
+                self.cache.canonicalize(statement))
+
+    def test_same_shape(self):
+        self._test_same_as_uncached((
+            u"SET timestamp=2345515  ;\nselect * from t where name in ('a', 'b') and id = 1  ;",
+            u"SET timestamp=123  ;\nselect * from t where name in ('cc', 'd') and id = -20  ;",
+            u"SET timestamp=4  ;\nselect * from t where name in ('it\\'s', 'e') and id = 300  ;"))
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_values(self):
+        self._test_same_as_uncached((
+            ur"""insert into foo.bar ( a, b ) values ( 'ab\'c' ,  "d\"ef" )""",
+            ur"""update foo set a = 'x', b = "y", c = 1.5 where d = 2""",
+            ur"""update foo set a = 'z', b = "w", c = .25 where d = 30""",
+            ur"""select a-1, b+-2 from t where c = 'd' -- e = 'f'""",
+            ur"""select a-3, b+-4 from t where c = 'g' -- e = 'f'"""))
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_eviction(self):
+        self._test_same_as_uncached((
+            u'select a from t where id = 1',
+            u'select b from t where id = 1',
+            u'select c from t where id = 1',
+            u'select a from t where id = 2'))
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_disabled(self):
+        self._test_same_as_uncached((
+            u'select a from t where id = 1',
+            u'select a from t where id = 2'))
+        self.assertEqual(len(self.uncached), 0)
+        self.assertEqual(self.uncached.hits, 0)
+
+
+class CanonicalizationEngineTest(unittest.TestCase):
+    """Tests that the lexer engine gives the same results as the sqlparse engine."""
+
+    # statements used by the other canonicalization tests
+    statements = (
+        ur'select * from foo where id = 1',
+        ur'select * from foo where id in ( 1, 2, 3 )',
+        ur"""
+            SELECT count(order_id) as cnt
+            FROM orders
+            WHERE user_id = 24142085
+            AND order_type_ IN (3, 1)
+        """,
+        ur"insert into people(name, phone, email) values ('Jay', '123', 'jay@jay.com'),('Elmer', '234', 'elmer@elmer.com')",
+        ur"insert into bar values ( \'string\', 25, 50.00 )",
+        ur"insert into bar values ( 'string', 25, 50.00 )",
+        ur'insert into foo ( col1, col2, col3 ) values ( 50.00, \'string\', 25 )',
+        ur"""insert into foo.bar ( a, b , c) values ( 'ab\'c' ,  "d\"ef"  , 'ghi'  )""",
+        ur"""
+            select t1.c1, t2.c1
+            from t1, t2
+            where t1.id = t2.id and (t1.id = 1 or t1.id = 2)
+            """,
+        ur"""
+            select
+                t1.c1 ,
+                t2.c1
+            from
+                t1 ,
+                t2
+            where
+                t1.id  =  t2.id
+                and
+                (
+                    t1.id   =   1
+                    or
+                    t1.id   =   2
+                )
+                and
+                t1.c1   >   5
+
+            """,
+        ur'select @@version_comment  limit  1',
+        ur"""insert into people(name, phone, email) values ('Jay', '123', 'jay@jay.com'),
+                ('Elmer', '234', 'elmer@elmer.com')""",
+        ur"select * from  people where name in ('Jay', 'Elmer', 'Bob')",
+        u"SET timestamp=2345515  ;\nselect * from t where name in ('a', 'b') and id = 1  ;",
+        ur"""update foo set a = 'x', b = "y", c = 1.5 where d = 2""",
+        ur"""select a-1, b+-2 from t where c = 'd' -- e = 'f'""",
+        )
+
+    def setUp(self):
+        class FakeOptions:
+            def __init__(self):
+                self.no_skip_unknowns = True
+        sqlcanonclient.OPTIONS = FakeOptions()
+
+    def _test_same_results(self, statements):
+        if sqlparse.__version__ != sqlcanonclient.LEXER_SQLPARSE_VERSION:
+            # main() falls back to the sqlparse engine
+            return
+        for statement in statements:
+            self.assertEqual(
+                sqlcanonclient.sqlparse_canonicalize_statement_offsets(statement),
+                sqlcanonclient.lexer_canonicalize_statement_offsets(statement))
+
+    def test_statements(self):
+        self._test_same_results(self.statements)
+
+    def test_general_query_log(self):
+        statements = []
+
+        class StatementReader(sqlcanonclient.MySqlGenQueryLogReader):
+            def got_log_item(self, dt=None, cid=None, cmd=None, arg=None):
+                if cmd and cmd.strip().lower() == 'query':
+                    statements.append(arg)
+
+        test_log_file = os.path.join(FILE_DIR, 'data', 'mysql.log')
+        with codecs.open(test_log_file, encoding='utf_8', errors='replace') as f:
+            StatementReader().read_lines(f)
+        self.assertEqual(len(statements), 17)
+        self._test_same_results(statements)
+
+    def test_slow_query_log(self):
+        statements = []
+        test_log_file = os.path.join(FILE_DIR, 'data', 'mysql-slow.log')
+        with codecs.open(test_log_file, encoding='utf_8', errors='replace') as f:
+            line = f.readline()
+            while line:
+                if line.startswith('# '):
+                    log_item_parser = sqlcanonclient.SlowQueryLogItemParser()
+                    line = log_item_parser.parse_header_data(line, f)
+                    line = log_item_parser.parse_statement(line, f)
+                    statements.append(log_item_parser.statement)
+                else:
+                    line = f.readline()
+        self.assertEqual(len(statements), 2)
+        self._test_same_results(statements)
+
+    def test_engine_selection(self):
+        statement = u'select * from foo where id in ( 1, 2, 3 )'
+        engine = sqlcanonclient.CANONICALIZATION_ENGINE
+        try:
+            sqlcanonclient.CANONICALIZATION_ENGINE = 'lexer'
+            self.assertEqual(
+                sqlcanonclient.lexer_canonicalize_statement_offsets(statement),
+                sqlcanonclient.canonicalize_statement_offsets(statement))
+        finally:
+            sqlcanonclient.CANONICALIZATION_ENGINE = engine
+
+
+class SlowQueryLogWorkersTest(unittest.TestCase):
+    """Tests that worker processes give the same results as the serial path."""
+
+    def setUp(self):
+        class FakeOptions:
+            def __init__(self):
+                self.stand_alone = True
+                self.server_id = 1
+                self.no_skip_unknowns = True
+                self.encoding = 'utf_8'
+                self.encoding_errors = 'replace'
+        sqlcanonclient.OPTIONS = FakeOptions()
+
+        # record statement data instead of saving it
+        self.saved = []
+        def save_statement_data(*args):
+            self.saved.append(
+                args + (sqlcanonclient.DataManager.get_last_db_used(),))
+        self.save_statement_data = (
+            sqlcanonclient.DataManager.__dict__['save_statement_data'])
+        sqlcanonclient.DataManager.save_statement_data = staticmethod(
+            save_statement_data)
+
+        entries = [
+            '/usr/sbin/mysqld, Version: 5.5.29-log ((Ubuntu)). started with:\n'
+            'Tcp port: 3306  Unix socket: /var/run/mysqld/mysqld.sock\n'
+            'Time                 Id Command    Argument\n']
+        for i in xrange(40):
+            entries.append(
+                '# Time: 130307 16:52:{0:02d}\n'
+                '# User@Host: elmer[elmer] @ localhost []\n'
+                '# Query_time: 0.{0:04d}  Lock_time: 0.5678  Rows_sent: {0}  Rows_examined: 2\n'
+                'use db{1};\n'
+                'SET timestamp={0}  ;\n'
+                "select * from table{1} where name in ('n{0}', 'm{0}') and id = {0}  ;\n"
+                .format(i, i % 3))
+        tmpf = tempfile.NamedTemporaryFile(delete=False)
+        tmpf.write(''.join(entries))
+        tmpf.close()
+        self.log = tmpf.name
+
+    def tearDown(self):
+        sqlcanonclient.DataManager.save_statement_data = self.save_statement_data
+        os.remove(self.log)
+
+    def _process(self, processor, read_file=False):
+        self.saved = []
+        sqlcanonclient.DataManager.set_last_db_used(None)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            if read_file:
+                processor.process_log_file(self.log)
+            else:
+                with open(self.log, 'rb') as f:
+                    processor.process_log_contents(f)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        return self.saved, output
+
+    def test_same_results(self):
+        saved, output = self._process(sqlcanonclient.SlowQueryLogProcessor())
+        self.assertEqual(len(saved), 80)
+        self.assertEqual(
+            (saved, output),
+            self._process(sqlcanonclient.SlowQueryLogProcessor(
+                workers=2, chunk_size=3)))
+
+    def test_same_results_in_shards(self):
+        expected = self._process(sqlcanonclient.SlowQueryLogProcessor())
+        for shard_size in (1, 100, 1000, 1 << 20):
+            self.assertEqual(
+                expected,
+                self._process(sqlcanonclient.SlowQueryLogProcessor(
+                    workers=3, shard_size=shard_size), read_file=True))
+
+    def test_find_log_item_start(self):
+        log = (
+            '# Time: 130307 16:52:36\n'
+            '# User@Host: elmer[elmer] @ localhost []\n'
+            'select 1;\n'
+            '# User@Host: elmer[elmer] @ localhost []\n'
+            '# Query_time: 0.1234\n'
+            'select 2;\n')
+        second = log.rindex('# User@Host')
+        self.assertEqual(sqlcanonclient.find_log_item_start(log, 0), 0)
+        for offset in xrange(1, second + 1):
+            self.assertEqual(
+                sqlcanonclient.find_log_item_start(log, offset), second)
+        for offset in xrange(second + 1, len(log) + 1):
+            self.assertEqual(
+                sqlcanonclient.find_log_item_start(log, offset), len(log))
+
+
+class LogDecodingTest(unittest.TestCase):
+    """Tests that only statements of logs read as bytes are decoded."""
+
+    def setUp(self):
+        class FakeOptions:
+            def __init__(self):
+                self.encoding = 'latin_1'
+                self.encoding_errors = 'replace'
+        sqlcanonclient.OPTIONS = FakeOptions()
+
+    def test_slow_query_log(self):
+        source = StringIO.StringIO(
+            '# Time: 130307 16:52:36\n'
+            '# Query_time: 0.1234  Lock_time: 0.5678\n'
+            "select * from t where name = 'caf\xe9'\n"
+            '  and id = 1;\n')
+        log_item_parsers = list(
+            sqlcanonclient.SlowQueryLogProcessor().read_log_items(source))
+        self.assertEqual(len(log_item_parsers), 1)
+        self.assertEqual(
+            log_item_parsers[0].statement,
+            u"select * from t where name = 'caf\xe9'\n  and id = 1;\n")
+        self.assertTrue(isinstance(log_item_parsers[0].statement, unicode))
+        self.assertEqual(
+            log_item_parsers[0].header_data,
+            {'query_time': '0.1234', 'lock_time': '0.5678'})
+
+    def test_general_query_log(self):
+        statements = []
+        class StatementReader(sqlcanonclient.MySqlGenQueryLogReader):
+            def got_log_item(self, dt=None, cid=None, cmd=None, arg=None):
+                log_item_parser = sqlcanonclient.GeneralQueryLogItemParser()
+                statements.append(log_item_parser.parse_statement(arg))
+        source = StringIO.StringIO(
+            'header 1\nheader 2\nheader 3\n'
+            "130309  1:07:39\t 2623 Query\tselect 'caf\xe9'\n")
+        StatementReader().read_lines(source)
+        self.assertEqual(statements, [u"select 'caf\xe9'"])
+
+
+class LogFileTestCase(unittest.TestCase):
+    """Base of tests processing log files written by the test."""
+
+    def setUp(self):
+        class FakeOptions:
+            def __init__(self):
+                self.stand_alone = True
+                self.server_id = 1
+                self.no_skip_unknowns = False
+                self.encoding = 'utf_8'
+                self.encoding_errors = 'replace'
+        sqlcanonclient.OPTIONS = FakeOptions()
+
+        # record statements instead of saving them
+        self.saved = []
+        def save_statement_data(dt, statement, *args):
+            self.saved.append(statement)
+        self.save_statement_data = (
+            sqlcanonclient.DataManager.__dict__['save_statement_data'])
+        sqlcanonclient.DataManager.save_statement_data = staticmethod(
+            save_statement_data)
+
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'mysql.log')
+        self.checkpoint_file = os.path.join(self.dir, 'checkpoints.json')
+
+    def tearDown(self):
+        sqlcanonclient.DataManager.save_statement_data = self.save_statement_data
+        sqlcanonclient.LocalData.close_db()
+        shutil.rmtree(self.dir)
+
+    def _write(self, data, mode='ab', path=None):
+        with open(path or self.log, mode) as f:
+            f.write(data)
+
+    def _checkpointer(self):
+        return sqlcanonclient.LogCheckpointer(
+            self.log, sqlcanonclient.LogCheckpointFile(self.checkpoint_file),
+            interval=0)
+
+    def _saved_checkpoint(self):
+        return sqlcanonclient.LogCheckpointFile(
+            self.checkpoint_file).load_log_checkpoint(os.path.abspath(self.log))
+
+    def _run(self, f, *args):
+        """Returns the statements saved by f(*args)."""
+
+        self.saved = []
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            f(*args)
+        finally:
+            sys.stdout = stdout
+        return self.saved
+
+    def _slow_log_entries(self, first, last):
+        return ''.join(
+            '# Time: 130307 16:52:{0:02d}\n'
+            '# User@Host: elmer[elmer] @ localhost []\n'
+            '# Query_time: 0.{0:04d}  Lock_time: 0.5678  Rows_sent: {0}  Rows_examined: 2\n'
+            'SET timestamp={0};\n'
+            'select * from t where id = {0};\n'.format(i)
+            for i in xrange(first, last + 1))
+
+    def _slow_log_statements(self, ids):
+        return [u'select * from t where id = {0}'.format(i) for i in ids]
+
+    def _general_log_entries(self, first, last):
+        return ''.join(
+            '130309  1:07:{0:02d}\t 2623 Query\tselect * from t\n'
+            '\t\twhere id = {0}\n'.format(i)
+            for i in xrange(first, last + 1))
+
+    def _general_log_statements(self, ids):
+        return [u'select * from t\twhere id = {0}'.format(i) for i in ids]
+
+
+class LogFollowTest(LogFileTestCase):
+    """Tests following of log files across rotations, truncations and restarts."""
+
+    class ScriptedFollower(sqlcanonclient.LogFollower):
+        """Runs the next action instead of waiting, stops when there is none."""
+
+        def __init__(self, path, checkpointer, actions=()):
+            super(LogFollowTest.ScriptedFollower, self).__init__(
+                path, checkpointer)
+            self.actions = list(actions)
+
+        def wait(self, source):
+            self.checkpointer.save()
+            if self.actions:
+                self.actions.pop(0)()
+            else:
+                self.stop()
+
+    def _rotate(self, data_before_flush, data):
+        os.rename(self.log, self.log + '.1')
+        self._write(data_before_flush, path=self.log + '.1')
+        self._write(data, mode='wb')
+
+    def _follow(self, processor_class, actions=()):
+        checkpointer = self._checkpointer()
+        follower = LogFollowTest.ScriptedFollower(
+            self.log, checkpointer, actions)
+        processor = processor_class(checkpointer=checkpointer)
+        if isinstance(processor, sqlcanonclient.SlowQueryLogProcessor):
+            follow = processor.follow_log_file
+        else:
+            follow = processor.follow_lines
+        try:
+            return self._run(follow, follower)
+        finally:
+            follower.close()
+
+    def _assert_checkpoint_at_end(self):
+        checkpoint = self._saved_checkpoint()
+        self.assertEqual(
+            (checkpoint.inode, checkpoint.offset + checkpoint.length),
+            (os.stat(self.log).st_ino, os.path.getsize(self.log)))
+
+    def test_follow_slow_log(self):
+        banner = (
+            '/usr/sbin/mysqld, Version: 5.5.29-log ((Ubuntu)). started with:\n'
+            'Tcp port: 3306  Unix socket: /var/run/mysqld/mysqld.sock\n'
+            'Time                 Id Command    Argument\n')
+        entries = self._slow_log_entries(2, 3)
+        self._write(banner + self._slow_log_entries(0, 1), mode='wb')
+        actions = (
+            # a line being written
+            lambda: self._write(entries[:30]),
+            lambda: self._write(entries[30:]),
+            # nothing written, the last log item read is processed
+            lambda: None,
+            lambda: self.assertEqual(len(self.saved), 4),
+            lambda: self._rotate(
+                self._slow_log_entries(4, 4),
+                banner + self._slow_log_entries(5, 6)),
+            lambda: self._write(self._slow_log_entries(7, 7), mode='wb'),
+        )
+        processor_class = sqlcanonclient.SlowQueryLogProcessor
+        self.assertEqual(
+            self._follow(processor_class, actions),
+            self._slow_log_statements(xrange(8)))
+        self._assert_checkpoint_at_end()
+
+        # resume after a restart
+        self._write(self._slow_log_entries(8, 9))
+        self.assertEqual(
+            self._follow(processor_class), self._slow_log_statements((8, 9)))
+
+        # the log file was replaced in the meantime
+        self._rotate('', self._slow_log_entries(10, 10))
+        self.assertEqual(
+            self._follow(processor_class), self._slow_log_statements((10,)))
+
+    def test_follow_general_log(self):
+        header = 'header 1\nheader 2\nheader 3\n'
+        self._write(header + self._general_log_entries(0, 1), mode='wb')
+        actions = (
+            lambda: self._write(self._general_log_entries(2, 2)),
+            lambda: None,
+            lambda: self.assertEqual(len(self.saved), 3),
+            lambda: self._rotate('', header + self._general_log_entries(3, 3)),
+        )
+        processor_class = sqlcanonclient.MySqlGenQueryLogQueryReader
+        self.assertEqual(
+            self._follow(processor_class, actions),
+            self._general_log_statements(xrange(4)))
+
+        # resume after a restart, past the header
+        self._write(self._general_log_entries(4, 5))
+        self.assertEqual(
+            self._follow(processor_class),
+            self._general_log_statements((4, 5)))
+        self._assert_checkpoint_at_end()
+
+
+class LogCheckpointTest(LogFileTestCase):
+    """Tests that processing of log files resumes from checkpoints."""
+
+    def _process_slow_log(self, **kwargs):
+        processor = sqlcanonclient.SlowQueryLogProcessor(
+            checkpointer=self._checkpointer(), **kwargs)
+        return self._run(processor.process_log_file, self.log)
+
+    def test_slow_query_log(self):
+        self._write(self._slow_log_entries(0, 4), mode='wb')
+        self.assertEqual(
+            self._process_slow_log(), self._slow_log_statements(xrange(5)))
+        self.assertEqual(self._process_slow_log(), [])
+
+        self._write(self._slow_log_entries(5, 6))
+        self.assertEqual(
+            self._process_slow_log(), self._slow_log_statements((5, 6)))
+        last_entry = self._slow_log_entries(6, 6)
+        self.assertEqual(
+            self._saved_checkpoint(),
+            sqlcanonclient.LogCheckpoint(
+                os.stat(self.log).st_ino,
+                os.path.getsize(self.log) - len(last_entry), len(last_entry),
+                mmh3.hash(last_entry)))
+
+        # the log file was rewritten, with the same inode
+        self._write(self._slow_log_entries(10, 16), mode='r+b')
+        self.assertEqual(
+            self._process_slow_log(), self._slow_log_statements(xrange(10, 17)))
+
+    def test_slow_query_log_in_workers(self):
+        self._write(self._slow_log_entries(0, 9), mode='wb')
+        self.assertEqual(
+            self._process_slow_log(workers=2, shard_size=300),
+            self._slow_log_statements(xrange(10)))
+
+        self._write(self._slow_log_entries(10, 12))
+        self.assertEqual(
+            self._process_slow_log(workers=2, shard_size=300),
+            self._slow_log_statements(xrange(10, 13)))
+        self.assertEqual(
+            self._process_slow_log(), [])
+
+    def test_general_query_log(self):
+        self._write(
+            'header 1\nheader 2\nheader 3\n' + self._general_log_entries(0, 2),
+            mode='wb')
+        def read_file():
+            sqlcanonclient.MySqlGenQueryLogQueryReader(
+                self._checkpointer()).read_file(self.log)
+        self.assertEqual(
+            self._run(read_file), self._general_log_statements(xrange(3)))
+
+        self._write(self._general_log_entries(3, 3))
+        self.assertEqual(
+            self._run(read_file), self._general_log_statements((3,)))
+
+    def test_create_log_checkpointer(self):
+        self._write(self._slow_log_entries(0, 0), mode='wb')
+        options = sqlcanonclient.OPTIONS
+        options.stand_alone = False
+        options.file = self.log
+        options.checkpoint_file = self.checkpoint_file
+        options.checkpoint_interval = 0
+        options.no_checkpoints = False
+        options.follow = False
+        options.resume = False
+        options.no_spool = False
+        # a one-shot run processes the whole log file every time
+        self.assertEqual(sqlcanonclient.create_log_checkpointer(), None)
+        for follow, resume in ((True, False), (False, True)):
+            options.follow = follow
+            options.resume = resume
+            self.assertTrue(isinstance(
+                sqlcanonclient.create_log_checkpointer(),
+                sqlcanonclient.LogCheckpointer))
+        # failed requests are not sent again without the spool
+        options.no_spool = True
+        self.assertEqual(sqlcanonclient.create_log_checkpointer(), None)
+        options.stand_alone = True
+        self.assertTrue(isinstance(
+            sqlcanonclient.create_log_checkpointer(),
+            sqlcanonclient.LogCheckpointer))
+        options.no_checkpoints = True
+        self.assertEqual(sqlcanonclient.create_log_checkpointer(), None)
+
+    def test_local_data(self):
+        sqlcanonclient.LocalData.init_db(os.path.join(self.dir, 'data.db'))
+        path = os.path.abspath(self.log)
+        self.assertEqual(
+            sqlcanonclient.LocalData.load_log_checkpoint(path), None)
+        for checkpoint in (
+                sqlcanonclient.LogCheckpoint(1, 2, 3, 4),
+                sqlcanonclient.LogCheckpoint(1, 5, 6, -7)):
+            sqlcanonclient.LocalData.save_log_checkpoint(path, checkpoint)
+            self.assertEqual(
+                sqlcanonclient.LocalData.load_log_checkpoint(path), checkpoint)
+
+
+class LocalDataTest(unittest.TestCase):
+    """Tests the local database of stand-alone mode."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sqlcanonclient.LocalData.close_db()
+        shutil.rmtree(self.dir)
+
+    def test_connection(self):
+        sqlcanonclient.LocalData.init_db(os.path.join(self.dir, 'a.db'))
+        conn = sqlcanonclient.LocalData.get_connection()
+        self.assertTrue(sqlcanonclient.LocalData.get_connection() is conn)
+        self.assertEqual(
+            conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+
+        sqlcanonclient.LocalData.init_db(
+            os.path.join(self.dir, 'b.db'), synchronous='FULL')
+        conn = sqlcanonclient.LocalData.get_connection()
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 2)
+        self.assertEqual(
+            conn.execute('PRAGMA database_list').fetchone()[2],
+            os.path.join(self.dir, 'b.db'))
+
+    def _save_statements(self, ids):
+        for i in ids:
+            statement = u'UPDATE t SET a = {0}'.format(i)
+            sqlcanonclient.LocalData.save_statement_data(
+                None, statement, 'localhost', statement, i, i, {})
+
+    def _ring(self):
+        sqlcanonclient.LocalData.flush()
+        return sqlcanonclient.LocalData.get_connection().execute(
+            'SELECT sequence_id, statement FROM statements '
+            'ORDER BY sequence_id').fetchall()
+
+    def test_statements_ring(self):
+        class FakeOptions:
+            def __init__(self):
+                self.server_id = 1
+        sqlcanonclient.OPTIONS = FakeOptions()
+        db = os.path.join(self.dir, 'a.db')
+
+        sqlcanonclient.LocalData.init_db(db, max_rows=3)
+        self._save_statements(xrange(2))
+        self.assertEqual(self._ring(), [
+            (1, u'UPDATE t SET a = 0'), (2, u'UPDATE t SET a = 1')])
+        self._save_statements(xrange(2, 5))
+        self.assertEqual(self._ring(), [
+            (0, u'UPDATE t SET a = 2'), (1, u'UPDATE t SET a = 3'),
+            (2, u'UPDATE t SET a = 4')])
+
+        # the head survives a restart
+        sqlcanonclient.LocalData.init_db(db, max_rows=3)
+        self._save_statements([5])
+        self.assertEqual(self._ring(), [
+            (0, u'UPDATE t SET a = 5'), (1, u'UPDATE t SET a = 3'),
+            (2, u'UPDATE t SET a = 4')])
+
+        # a smaller ring drops the slots past its end
+        sqlcanonclient.LocalData.init_db(db, max_rows=2)
+        self._save_statements([6])
+        self.assertEqual(self._ring(), [
+            (0, u'UPDATE t SET a = 5'), (1, u'UPDATE t SET a = 6')])
+
+    def test_flusher(self):
+        class FakeOptions:
+            def __init__(self):
+                self.server_id = 1
+        sqlcanonclient.OPTIONS = FakeOptions()
+        db = os.path.join(self.dir, 'a.db')
+
+        # a statement is written once it waited the flush interval, with no
+        # other statement saved
+        sqlcanonclient.LocalData.init_db(db, flush_interval=50)
+        self._save_statements([0])
+        conn = sqlite3.connect(db)
+        try:
+            for _ in xrange(100):
+                rows = conn.execute(
+                    'SELECT statement FROM statements').fetchall()
+                if rows:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(rows, [(u'UPDATE t SET a = 0',)])
+        finally:
+            conn.close()
+        self.assertEqual(sqlcanonclient.LocalData.BATCH, [])
+
+        sqlcanonclient.LocalData.close_db()
+        self.assertEqual(sqlcanonclient.LocalData.FLUSHER, None)
+
+    def test_migrations(self):
+        class FakeOptions:
+            def __init__(self):
+                self.server_id = 1
+        sqlcanonclient.OPTIONS = FakeOptions()
+        db = os.path.join(self.dir, 'a.db')
+
+        # the statements table of earlier versions, with a ring slot
+        # written twice
+        conn = sqlite3.connect(db)
+        with conn:
+            conn.execute(sqlcanonclient.LocalData.MIGRATIONS[0][0])
+            for i, sequence_id in enumerate((1, 2, 1)):
+                conn.execute(
+                    'INSERT INTO statements(statement, sequence_id, '
+                    'updated_at) VALUES (?, ?, ?)',
+                    (u'UPDATE t SET a = {0}'.format(i), sequence_id, i))
+        conn.close()
+
+        sqlcanonclient.LocalData.init_db(db)
+        conn = sqlcanonclient.LocalData.get_connection()
+        self.assertEqual(
+            conn.execute('PRAGMA user_version').fetchone()[0],
+            len(sqlcanonclient.LocalData.MIGRATIONS))
+        indexes = set(row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            "AND sql IS NOT NULL"))
+        self.assertEqual(indexes, set([
+            'statements_sequence_id', 'statements_hostname_hash',
+            'statements_dt', 'explained_statements_hostname_hash',
+            'explain_results_explained_statement_id']))
+        self.assertEqual(sqlcanonclient.LocalData.RING_HEAD, 1)
+        self._save_statements([3])
+        self.assertEqual(self._ring(), [
+            (1, u'UPDATE t SET a = 2'), (2, u'UPDATE t SET a = 3')])
+
+        # nothing to upgrade
+        sqlcanonclient.LocalData.init_db(db)
+        self.assertEqual(self._ring(), [
+            (1, u'UPDATE t SET a = 2'), (2, u'UPDATE t SET a = 3')])
+
+    def test_queries(self):
+        class FakeOptions:
+            def __init__(self):
+                self.server_id = 1
+        sqlcanonclient.OPTIONS = FakeOptions()
+        sqlcanonclient.LocalData.init_db(os.path.join(self.dir, 'a.db'))
+        for i, hash in enumerate((1, 2, 2, 3, 3, 3)):
+            statement = u'UPDATE t SET a = {0}'.format(hash)
+            sqlcanonclient.LocalData.save_statement_data(
+                datetime.datetime(2013, 3, 7, 16, 52, i), statement,
+                'localhost', statement, hash, hash + 10, {})
+        sqlcanonclient.LocalData.flush()
+
+        self.assertTrue(sqlcanonclient.LocalData.has_statements(12))
+        self.assertFalse(sqlcanonclient.LocalData.has_statements(2))
+        self.assertEqual(sqlcanonclient.LocalData.get_top_queries(2), [
+            (u'UPDATE t SET a = 3', 1, 13, 3),
+            (u'UPDATE t SET a = 2', 1, 12, 2)])
+        self.assertEqual(
+            sqlcanonclient.LocalData.get_last_statements(
+                datetime.datetime(2013, 3, 7, 16, 52, 1),
+                datetime.datetime(2013, 3, 7, 16, 52, 3)), [
+            (u'UPDATE t SET a = 2', 1, 12, 2, u'UPDATE t SET a = 2',
+                u'2013-03-07 16:52:02', 2),
+            (u'UPDATE t SET a = 3', 1, 13, 3, u'UPDATE t SET a = 3',
+                u'2013-03-07 16:52:03', 1)])
+
+    def test_seen_statements(self):
+        explained = []
+        class FakeExplainQueue:
+            def submit(self, key, job):
+                explained.append(key)
+                return True
+        explain_queue = sqlcanonclient.EXPLAIN_QUEUE
+        sqlcanonclient.EXPLAIN_QUEUE = FakeExplainQueue()
+        def get_explain_connection_options():
+            return {}
+        class FakeOptions:
+            def __init__(self):
+                self.server_id = 1
+        sqlcanonclient.OPTIONS = FakeOptions()
+        get_explain_connection_options_ = (
+            sqlcanonclient.DataManager.__dict__[
+                'get_explain_connection_options'])
+        sqlcanonclient.DataManager.get_explain_connection_options = (
+            staticmethod(get_explain_connection_options))
+        db = os.path.join(self.dir, 'a.db')
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            # statements replaced in the ring were seen all the same, 1 is
+            # not in DB anymore once it is opened again
+            for bloom_filter_capacity, count in ((0, 3), (100, 4)):
+                sqlcanonclient.LocalData.init_db(
+                    db, max_rows=2,
+                    bloom_filter_capacity=bloom_filter_capacity)
+                for i in (1, 2, 3, 1, 2, 3):
+                    statement = u'SELECT * FROM t WHERE a = {0}'.format(i)
+                    sqlcanonclient.LocalData.save_statement_data(
+                        None, statement, 'localhost', statement, i, i, {})
+                sqlcanonclient.LocalData.close_db()
+                self.assertEqual(len(explained), count)
+        finally:
+            sys.stdout = stdout
+            sqlcanonclient.EXPLAIN_QUEUE = explain_queue
+            sqlcanonclient.DataManager.get_explain_connection_options = (
+                get_explain_connection_options_)
+
+    def test_explain_not_queued(self):
+        explained = []
+        def get_explain_connection_options():
+            explained.append(None)
+            if len(explained) == 1:
+                raise Exception('no EXPLAIN')
+            return {}
+        class FakeOptions:
+            def __init__(self):
+                self.server_id = 1
+        sqlcanonclient.OPTIONS = FakeOptions()
+        explain_queue = sqlcanonclient.EXPLAIN_QUEUE
+        sqlcanonclient.EXPLAIN_QUEUE = sqlcanonclient.ExplainQueue(workers=0)
+        get_explain_connection_options_ = (
+            sqlcanonclient.DataManager.__dict__[
+                'get_explain_connection_options'])
+        sqlcanonclient.DataManager.get_explain_connection_options = (
+            staticmethod(get_explain_connection_options))
+        explain_statement = sqlcanonclient.LocalData.__dict__[
+            'explain_statement']
+        sqlcanonclient.LocalData.explain_statement = staticmethod(
+            lambda *args: None)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            sqlcanonclient.LocalData.init_db(os.path.join(self.dir, 'a.db'))
+            # the statement is first seen again until its EXPLAIN is queued
+            for i in xrange(3):
+                statement = u'SELECT * FROM t WHERE a = 1'
+                sqlcanonclient.LocalData.save_statement_data(
+                    None, statement, 'localhost', statement, 1, 1, {})
+            self.assertEqual(len(explained), 2)
+            self.assertEqual(sqlcanonclient.EXPLAIN_QUEUE.queued, 1)
+        finally:
+            sys.stdout = stdout
+            sqlcanonclient.EXPLAIN_QUEUE = explain_queue
+            sqlcanonclient.LocalData.explain_statement = explain_statement
+            sqlcanonclient.DataManager.get_explain_connection_options = (
+                get_explain_connection_options_)
+
+    def _written(self, db):
+        conn = sqlite3.connect(db)
+        try:
+            return [row[0] for row in conn.execute(
+                'SELECT canonicalized_statement_hash FROM statements '
+                'ORDER BY id')]
+        finally:
+            conn.close()
+
+    def test_batches(self):
+        explained = []
+        class FakeExplainQueue:
+            def submit(self, key, job):
+                explained.append(key)
+                return True
+        explain_queue = sqlcanonclient.EXPLAIN_QUEUE
+        sqlcanonclient.EXPLAIN_QUEUE = FakeExplainQueue()
+        def get_explain_connection_options():
+            return {}
+        class FakeOptions:
+            def __init__(self):
+                self.server_id = 1
+                self.stand_alone = True
+        sqlcanonclient.OPTIONS = FakeOptions()
+        get_explain_connection_options_ = (
+            sqlcanonclient.DataManager.__dict__[
+                'get_explain_connection_options'])
+        sqlcanonclient.DataManager.get_explain_connection_options = (
+            staticmethod(get_explain_connection_options))
+        db = os.path.join(self.dir, 'a.db')
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            sqlcanonclient.LocalData.init_db(
+                db, batch_size=3, flush_interval=60000)
+            self._save_statements(xrange(2))
+            self.assertEqual(self._written(db), [])
+            self._save_statements([2])
+            self.assertEqual(self._written(db), [0, 1, 2])
+
+            # a SELECT is first seen once, whether it was written or not
+            for i in (3, 3, 2, 2):
+                statement = u'SELECT * FROM t WHERE a = {0}'.format(i)
+                sqlcanonclient.LocalData.save_statement_data(
+                    None, statement, 'localhost', statement, i, i + 10, {})
+            self.assertEqual(len(explained), 2)
+            self.assertEqual(self._written(db), [0, 1, 2, 3, 3, 2])
+
+            # statements are written with the checkpoints after them
+            sqlcanonclient.LocalData.save_log_checkpoint(
+                'mysql.log', sqlcanonclient.LogCheckpoint(1, 2, 3, 4))
+            self.assertEqual(self._written(db), [0, 1, 2, 3, 3, 2, 2])
+
+            self._save_statements([4])
+            sqlcanonclient.DataManager.flush_statement_data()
+            self._save_statements([5])
+            sqlcanonclient.LocalData.close_db()
+            self.assertEqual(self._written(db), [0, 1, 2, 3, 3, 2, 2, 4, 5])
+
+            # statements waiting for longer than the flush interval
+            sqlcanonclient.LocalData.init_db(
+                db, batch_size=3, flush_interval=0)
+            self._save_statements([6])
+            self.assertEqual(
+                self._written(db), [0, 1, 2, 3, 3, 2, 2, 4, 5, 6])
+        finally:
+            sys.stdout = stdout
+            sqlcanonclient.EXPLAIN_QUEUE = explain_queue
+            sqlcanonclient.DataManager.get_explain_connection_options = (
+                get_explain_connection_options_)
+
+
+class BloomFilterTest(unittest.TestCase):
+    """Tests the Bloom filter of the statements seen in stand-alone mode."""
+
+    def test_bloom_filter(self):
+        bloom_filter = sqlcanonclient.BloomFilter(1000, 0.01)
+        hashes = [mmh3.hash(str(i)) for i in xrange(2000)]
+        for hash in hashes[:1000]:
+            bloom_filter.add(hash)
+        for hash in hashes[:1000]:
+            self.assertTrue(hash in bloom_filter)
+        false_positives = len(
+            [hash for hash in hashes[1000:] if hash in bloom_filter])
+        self.assertTrue(false_positives < 30, false_positives)
+
+
+class MySqlConnectionPoolTest(unittest.TestCase):
+    """Tests the pool of MySQL connections used for EXPLAIN."""
+
+    def setUp(self):
+        self.connections = []
+        test = self
+        class FakeConnection:
+            def __init__(self, **options):
+                self.db = options.get('db')
+                self.alive = True
+                self.closed = False
+                test.connections.append(self)
+            def autocommit(self, on):
+                pass
+            def ping(self):
+                if not self.alive:
+                    raise sqlcanonclient.MySQLdb.OperationalError(
+                        'MySQL server has gone away')
+            def select_db(self, db):
+                self.db = db
+            def close(self):
+                self.closed = True
+        self.connect = sqlcanonclient.MySQLdb.connect
+        sqlcanonclient.MySQLdb.connect = FakeConnection
+        self.pool = sqlcanonclient.MySqlConnectionPool(
+            idle_timeout=60, check_interval=0)
+
+    def tearDown(self):
+        sqlcanonclient.MySQLdb.connect = self.connect
+
+    def _use(self, **options):
+        with self.pool.connection(options) as conn:
+            self.assertEqual(conn.db, options.get('db'))
+            return conn
+
+    def test_reuse(self):
+        conn = self._use(host='a', user='u', db='db1')
+        self.assertTrue(self._use(host='a', user='u', db='db1') is conn)
+        # another schema of the same server
+        self.assertTrue(self._use(host='a', user='u', db='db2') is conn)
+        # other servers and users, no schema
+        self.assertFalse(self._use(host='b', user='u', db='db2') is conn)
+        self.assertFalse(self._use(host='a', user='v', db='db2') is conn)
+        self.assertFalse(self._use(host='a', user='u') is conn)
+        self.assertEqual(len(self.connections), 4)
+        self.assertEqual(self.pool.connects, 4)
+        self.assertEqual(self.pool.reuses, 2)
+
+        self.pool.close()
+        self.assertTrue(all(c.closed for c in self.connections))
+
+    def test_health_checks(self):
+        conn = self._use(host='a', db='db1')
+        conn.alive = False
+        other = self._use(host='a', db='db1')
+        self.assertFalse(other is conn)
+        self.assertTrue(conn.closed)
+
+        # connections that raised are not reused
+        try:
+            with self.pool.connection(dict(host='a', db='db1')):
+                raise sqlcanonclient.MySQLdb.OperationalError(
+                    'Lost connection to MySQL server during query')
+        except sqlcanonclient.MySQLdb.OperationalError:
+            pass
+        self.assertTrue(other.closed)
+        self.assertEqual(len(self.connections), 2)
+
+        conn = self._use(host='a', db='db1')
+        self.pool.close_idle(0)
+        self.assertTrue(conn.closed)
+        self.assertFalse(self._use(host='a', db='db1') is conn)
+
+
+class ExplainQueueTest(unittest.TestCase):
+    """Tests the EXPLAIN statements run by threads."""
+
+    def setUp(self):
+        # EXPLAIN statements wait until they are killed
+        self.connections = {}
+        test = self
+        class FakeCursor:
+            def __init__(self, conn):
+                self.conn = conn
+            def execute(self, sql):
+                if sql.startswith('KILL QUERY '):
+                    test.connections[int(sql.split()[-1])].killed.set()
+                    return
+                self.conn.killed.wait(5)
+                raise sqlcanonclient.MySQLdb.OperationalError(
+                    'Query execution was interrupted')
+            def close(self):
+                pass
+        class FakeConnection:
+            def __init__(self, **options):
+                self.id = len(test.connections) + 1
+                self.killed = threading.Event()
+                test.connections[self.id] = self
+            def autocommit(self, on):
+                pass
+            def thread_id(self):
+                return self.id
+            def cursor(self):
+                return FakeCursor(self)
+            def ping(self):
+                pass
+            def select_db(self, db):
+                pass
+            def close(self):
+                pass
+        self.connect = sqlcanonclient.MySQLdb.connect
+        sqlcanonclient.MySQLdb.connect = FakeConnection
+        self.explain_queue = sqlcanonclient.EXPLAIN_QUEUE
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        sqlcanonclient.EXPLAIN_QUEUE.close()
+        sqlcanonclient.EXPLAIN_QUEUE = self.explain_queue
+        sqlcanonclient.EXPLAIN_CONNECTIONS.close()
+        sqlcanonclient.MySQLdb.connect = self.connect
+
+    def test_queue(self):
+        queue = sqlcanonclient.ExplainQueue(workers=1, size=1)
+        started = threading.Event()
+        release = threading.Event()
+        run = []
+        def job(key):
+            def run_job():
+                started.set()
+                release.wait(5)
+                run.append(key)
+                if key == 2:
+                    raise Exception('EXPLAIN failed')
+            return run_job
+
+        self.assertTrue(queue.submit(1, job(1)))
+        started.wait(5)
+        self.assertTrue(queue.submit(2, job(2)))
+        # running or queued already
+        self.assertFalse(queue.submit(1, job(1)))
+        self.assertFalse(queue.submit(2, job(2)))
+        # the queue is full, the job waits for a free slot
+        submitted = []
+        submitter = threading.Thread(
+            target=lambda: submitted.append(queue.submit(3, job(3))))
+        submitter.start()
+        submitter.join(0.2)
+        self.assertTrue(submitter.isAlive())
+        release.set()
+        submitter.join(5)
+        self.assertEqual(submitted, [True])
+        queue.join()
+        self.assertTrue(queue.submit(1, job(1)))
+        queue.close()
+
+        self.assertEqual(run, [1, 2, 3, 1])
+        self.assertEqual(
+            (queue.queued, queue.duplicates, queue.waits, queue.failed),
+            (4, 2, 1, 1))
+
+    def test_timeout(self):
+        sqlcanonclient.EXPLAIN_QUEUE = sqlcanonclient.ExplainQueue(
+            workers=0, timeout=0.05)
+        options = dict(host='a', db='db1')
+        with sqlcanonclient.EXPLAIN_CONNECTIONS.connection(options) as conn:
+            self.assertRaises(
+                sqlcanonclient.MySQLdb.OperationalError,
+                sqlcanonclient.DataManager.explain,
+                'SELECT * FROM t', conn, options)
+        self.assertTrue(self.connections[1].killed.is_set())
+        self.assertEqual(sqlcanonclient.EXPLAIN_QUEUE.timeouts, 1)
+
+    def test_local_data(self):
+        class FakeOptions:
+            def __init__(self):
+                self.server_id = 1
+        sqlcanonclient.OPTIONS = FakeOptions()
+        sqlcanonclient.EXPLAIN_QUEUE = sqlcanonclient.ExplainQueue(
+            workers=2, timeout=0.05)
+        sqlcanonclient.EXPLAIN_OPTIONS = {'h': 'a'}
+        sqlcanonclient.DataManager.set_last_db_used('db1')
+        run_explain = sqlcanonclient.DataManager.__dict__['run_explain']
+        def fake_run_explain(statement, cursor):
+            if statement.endswith('2'):
+                return run_explain.__func__(statement, cursor)
+            return [dict(
+                select_id=1, select_type='SIMPLE', table='t', type='ALL',
+                possible_keys=None, key=None, key_len=None, ref=None,
+                rows=10, extra='')]
+        sqlcanonclient.DataManager.run_explain = staticmethod(
+            fake_run_explain)
+        path = tempfile.mkdtemp()
+        try:
+            sqlcanonclient.LocalData.init_db(os.path.join(path, 'a.db'))
+            for i in (1, 2, 1):
+                statement = u'SELECT * FROM t WHERE a = {0}'.format(i)
+                sqlcanonclient.LocalData.save_statement_data(
+                    None, statement, 'localhost', statement, i, i, {})
+            sqlcanonclient.EXPLAIN_QUEUE.join()
+            sqlcanonclient.LocalData.flush()
+
+            conn = sqlcanonclient.LocalData.get_connection()
+            self.assertEqual(sorted(conn.execute(
+                'SELECT e.statement, e.db, r.`table`, r.rows '
+                'FROM explained_statements e LEFT JOIN explain_results r '
+                'ON r.explained_statement_id = e.id').fetchall()), [
+                (u'SELECT * FROM t WHERE a = 1', u'db1', u't', 10),
+                (u'SELECT * FROM t WHERE a = 2', u'db1', None, None)])
+            self.assertEqual(sqlcanonclient.EXPLAIN_QUEUE.queued, 2)
+            self.assertEqual(sqlcanonclient.EXPLAIN_QUEUE.timeouts, 1)
+        finally:
+            sqlcanonclient.DataManager.run_explain = run_explain
+            sqlcanonclient.DataManager.set_last_db_used(None)
+            sqlcanonclient.LocalData.close_db()
+            shutil.rmtree(path)
+
+
+class SpoolTest(unittest.TestCase):
+    """Tests the spool of the requests to the server."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _read_all(self, spool):
+        records = []
+        while True:
+            item = spool.read()
+            if item is None:
+                return records
+            records.append(item[0])
+            spool.commit(item[1])
+
+    def test_segments(self):
+        spool = sqlcanonclient.Spool(self.path, segment_size=100)
+        try:
+            for i in xrange(10):
+                spool.append(dict(i=i, data='x' * 20))
+            self.assertTrue(
+                len([name for name in os.listdir(self.path)
+                    if name.endswith('.segment')]) > 2)
+            self.assertEqual(
+                [record['i'] for record in self._read_all(spool)], range(10))
+            self.assertTrue(spool.is_empty())
+            self.assertTrue(spool.join(0))
+            # the segments read are deleted
+            self.assertEqual(
+                len([name for name in os.listdir(self.path)
+                    if name.endswith('.segment')]), 1)
+        finally:
+            spool.close()
+
+    def test_eviction(self):
+        spool = sqlcanonclient.Spool(
+            self.path, segment_size=100, max_size=300)
+        try:
+            for i in xrange(30):
+                spool.append(dict(i=i, data='x' * 20))
+            records = self._read_all(spool)
+        finally:
+            spool.close()
+        # the oldest records are dropped
+        self.assertEqual(
+            [record['i'] for record in records],
+            range(30 - len(records), 30))
+        self.assertTrue(len(records) < 30)
+        self.assertTrue(spool.evicted > 0)
+
+    def test_resume(self):
+        spool = sqlcanonclient.Spool(self.path, segment_size=100)
+        for i in xrange(5):
+            spool.append(dict(i=i))
+        record, position = spool.read()
+        spool.commit(position)
+        # not committed
+        spool.read()
+        self.assertRaises(
+            sqlcanonclient.SpoolInUseError, sqlcanonclient.Spool, self.path)
+        spool.close()
+        # a record partially written before a crash
+        segments = sorted(
+            name for name in os.listdir(self.path)
+            if name.endswith('.segment'))
+        with open(os.path.join(self.path, segments[-1]), 'ab') as f:
+            f.write('{"i": 5')
+
+        spool = sqlcanonclient.Spool(self.path, segment_size=100)
+        try:
+            spool.append(dict(i=6))
+            self.assertEqual(
+                [record['i'] for record in self._read_all(spool)],
+                [1, 2, 3, 4, 6])
+        finally:
+            spool.close()
+
+    def test_default_spool_dir(self):
+        spool_dir = sqlcanonclient.get_default_spool_dir(
+            'slow.log', 'http://localhost:8000')
+        self.assertEqual(
+            sqlcanonclient.get_default_spool_dir(
+                os.path.abspath('slow.log'), 'http://localhost:8000'),
+            spool_dir)
+        # one spool per log file and server
+        self.assertEqual(
+            len(set([spool_dir,
+                sqlcanonclient.get_default_spool_dir(
+                    'other.log', 'http://localhost:8000'),
+                sqlcanonclient.get_default_spool_dir(
+                    'slow.log', 'http://localhost:8001'),
+                sqlcanonclient.get_default_spool_dir(
+                    None, 'http://localhost:8000')])),
+            4)
+
+
+class ServerDataTest(unittest.TestCase):
+    """Tests the statements sent to the server in batches."""
+
+    def setUp(self):
+        # the server asks for the EXPLAIN of the first statement of every
+        # request
+        self.requests = []
+        self.encodings = []
+        self.keys = []
+        # statuses of the next responses, 200 once empty
+        self.statuses = []
+        # error messages of the next responses, answered with HTTP 200 as
+        # the server does once it rolled a request back
+        self.errors = []
+        test = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                test.encodings.append(self.headers.get('Content-Encoding'))
+                test.keys.append(self.headers.get('Idempotency-Key'))
+                data = json.loads(body)
+                test.requests.append((self.path, data))
+                if isinstance(data, dict):
+                    data = [data]
+                content = json.dumps(dict(explain=[dict(
+                    index=0, statement=data[0]['statement'],
+                    statement_data_id=len(test.requests))]))
+                status = 200
+                if test.statuses:
+                    status = test.statuses.pop(0)
+                elif test.errors:
+                    content = json.dumps(dict(error=test.errors.pop(0)))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            def log_message(self, *args):
+                pass
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever)
+        self.server_thread.start()
+
+        class FakeOptions:
+            def __init__(self):
+                self.server_id = 1
+                # the base URL of ServerData.init() is used
+                self.server_base_url = None
+                self.save_statement_data_path = '/save/'
+                self.save_statement_data_bulk_path = '/save-bulk/'
+                self.save_statement_stats_path = '/save-stats/'
+        sqlcanonclient.OPTIONS = FakeOptions()
+        sqlcanonclient.EXPLAIN_OPTIONS = {'h': 'a'}
+        self.explained = []
+        self.explain_statements = (
+            sqlcanonclient.ServerData.__dict__['explain_statements'])
+        def fake_explain_statements(explain_items, explain_connection_options):
+            self.explained.append(
+                (explain_items, explain_connection_options))
+        sqlcanonclient.ServerData.explain_statements = staticmethod(
+            fake_explain_statements)
+        self.explain_queue = sqlcanonclient.EXPLAIN_QUEUE
+        sqlcanonclient.EXPLAIN_QUEUE = sqlcanonclient.ExplainQueue(workers=0)
+
+    def tearDown(self):
+        sqlcanonclient.ServerData.close()
+        sqlcanonclient.ServerData.explain_statements = self.explain_statements
+        sqlcanonclient.EXPLAIN_QUEUE = self.explain_queue
+        sqlcanonclient.DataManager.set_last_db_used(None)
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def test_batches(self):
+        sqlcanonclient.ServerData.init(
+            'http://127.0.0.1:{0}/sqlcanon/'.format(
+                self.server.server_address[1]),
+            batch_size=2, flush_interval=60000)
+        for i, db in enumerate(('db1', 'db2', 'db3')):
+            sqlcanonclient.DataManager.set_last_db_used(db)
+            statement = u'SELECT * FROM t WHERE a = {0}'.format(i)
+            sqlcanonclient.ServerData.save_statement_data(
+                statement, 'localhost', statement, i, i, {})
+        self.assertEqual(len(self.requests), 1)
+        sqlcanonclient.ServerData.flush()
+
+        self.assertEqual(
+            [(path, [data['canonicalized_statement_hostname_hash']
+                for data in data_list])
+                for path, data_list in self.requests],
+            [('/sqlcanon/save-bulk/', [0, 1]), ('/sqlcanon/save-bulk/', [2])])
+        # the EXPLAIN statements are run in the db used when the statements
+        # were read
+        self.assertEqual(
+            [(explain_items[0]['statement_data_id'],
+                explain_connection_options['db'])
+                for explain_items, explain_connection_options
+                in self.explained],
+            [(1, 'db1'), (2, 'db3')])
+        self.assertEqual(sqlcanonclient.ServerData.CONNECTION.connects, 1)
+        self.assertEqual(sqlcanonclient.ServerData.CONNECTION.requests, 2)
+
+    def test_aggregate(self):
+        sqlcanonclient.ServerData.init(
+            'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+            flush_interval=60000, aggregate=True)
+        sqlcanonclient.DataManager.set_last_db_used('db1')
+        for a, query_time, rows_sent in (
+                (1, '0.5', '1'), (2, '0.25', '2'), (3, '1.5', 'x'),
+                (4, '0.5', '0')):
+            statement = u'SELECT * FROM t WHERE a = {0}'.format(a)
+            sqlcanonclient.ServerData.save_statement_data(
+                statement, 'localhost', u'SELECT * FROM t WHERE a = ?',
+                1, 1, dict(query_time=query_time, rows_sent=rows_sent))
+        sqlcanonclient.ServerData.save_statement_data(
+            u'SELECT 1', 'localhost', u'SELECT ?', 2, 2, {})
+        self.assertEqual(self.requests, [])
+        sqlcanonclient.ServerData.flush()
+
+        self.assertEqual(len(self.requests), 1)
+        path, data_list = self.requests[0]
+        self.assertEqual(path, '/save-stats/')
+        stats = dict(
+            (data['canonicalized_statement_hash'], data)
+            for data in data_list)
+        self.assertEqual(
+            (stats[1]['statement'], stats[1]['count'],
+                stats[1]['query_time_sum'], stats[1]['query_time_min'],
+                stats[1]['query_time_max'], stats[1]['rows_sent_sum'],
+                stats[1]['rows_sent_min'], stats[1]['rows_sent_max'],
+                stats[1]['query_time']),
+            (u'SELECT * FROM t WHERE a = 1', 4, 2.75, 0.25, 1.5, 3, 0, 2,
+                '0.5'))
+        self.assertTrue(stats[1]['dt_start'] <= stats[1]['dt_end'])
+        self.assertEqual(
+            (stats[2]['count'], stats[2].get('query_time_sum')), (1, None))
+        # the EXPLAIN of the sample statement
+        self.assertEqual(len(self.explained), 1)
+        self.assertEqual(
+            self.explained[0][0][0]['statement'], data_list[0]['statement'])
+        self.assertEqual(self.explained[0][1]['db'], 'db1')
+
+    def test_flusher(self):
+        sqlcanonclient.ServerData.init(
+            'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+            flush_interval=50, aggregate=True)
+        sqlcanonclient.ServerData.save_statement_data(
+            u'SELECT 1', 'localhost', u'SELECT ?', 1, 1, {})
+
+        # the stats are sent once they waited the flush interval, with no
+        # other statement saved
+        for _ in xrange(100):
+            if self.requests:
+                break
+            time.sleep(0.02)
+        self.assertEqual(
+            [(path, [data['count'] for data in data_list])
+                for path, data_list in self.requests],
+            [('/save-stats/', [1])])
+        self.assertEqual(sqlcanonclient.ServerData.STATS, {})
+
+        sqlcanonclient.ServerData.close()
+        self.assertEqual(sqlcanonclient.ServerData.FLUSHER, None)
+
+    def test_compression(self):
+        connection = sqlcanonclient.ServerConnection(
+            'http://127.0.0.1:{0}'.format(self.server.server_address[1]))
+        try:
+            small = [dict(statement=u'SELECT 1')]
+            large = [dict(statement=u'SELECT {0}'.format(i))
+                for i in xrange(100)]
+            for data in (small, large):
+                self.assertEqual(connection.post('/a/', data).code, 200)
+        finally:
+            connection.close()
+
+        self.assertEqual(
+            self.requests, [('/a/', small), ('/a/', large)])
+        self.assertEqual(self.encodings, [None, 'gzip'])
+        self.assertEqual(
+            connection.bytes_posted, len(json.dumps(small)) +
+                len(json.dumps(large)))
+        self.assertTrue(
+            connection.bytes_sent < connection.bytes_posted / 2)
+
+    def test_retries(self):
+        connection = sqlcanonclient.ServerConnection(
+            'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+            retries=2, retry_delay=0.01)
+        try:
+            data = [dict(statement=u'SELECT 1')]
+            self.statuses = [503, 502]
+            self.assertEqual(connection.post('/a/', data).code, 200)
+            self.statuses = [503, 503, 503, 200]
+            self.assertEqual(connection.post('/a/', data, 'k').code, 503)
+        finally:
+            connection.close()
+        self.assertEqual((connection.requests, connection.retried), (6, 4))
+        self.assertEqual(self.keys, [None] * 3 + ['k'] * 3)
+
+    def test_error_response(self):
+        connection = sqlcanonclient.ServerConnection(
+            'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+            retries=1, retry_delay=0.01)
+        try:
+            data = [dict(statement=u'SELECT 1')]
+            # rolled back by the server
+            self.errors = ['Deadlock found']
+            response = connection.post('/a/', data, 'k')
+            self.assertEqual(
+                (response.code, response.error, connection.retried),
+                (200, None, 1))
+        finally:
+            connection.close()
+
+        # without the spool, the request is not sent again once its retries
+        # are used, nor are its EXPLAIN statements run
+        sqlcanonclient.ServerData.init(
+            'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+            batch_size=0, retries=0)
+        self.errors = ['Deadlock found']
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            sqlcanonclient.ServerData.save_statement_data(
+                u'SELECT 1', 'localhost', u'SELECT ?', 1, 1, {})
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output, 'ERROR: Deadlock found from /save/\n')
+        self.assertEqual(self.explained, [])
+
+    def test_reconnect(self):
+        sqlcanonclient.ServerData.init(
+            'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+            batch_size=0)
+        connection = sqlcanonclient.ServerData.CONNECTION
+        sqlcanonclient.ServerData.save_statement_data(
+            u'SELECT 1', 'localhost', u'SELECT ?', 1, 1, {})
+        # closed by the server while idle
+        connection._conn.sock.shutdown(socket.SHUT_RDWR)
+        sqlcanonclient.ServerData.save_statement_data(
+            u'SELECT 2', 'localhost', u'SELECT ?', 1, 1, {})
+
+        self.assertEqual(
+            [path for path, data in self.requests], ['/save/', '/save/'])
+        self.assertEqual((connection.connects, connection.requests), (2, 2))
+
+    def test_spool(self):
+        spool_retry_delay = sqlcanonclient.SPOOL_RETRY_DELAY
+        sqlcanonclient.SPOOL_RETRY_DELAY = 0.01
+        spool_dir = tempfile.mkdtemp()
+        try:
+            # the server is unavailable for a while
+            self.statuses = [503] * 5
+            sqlcanonclient.ServerData.init(
+                'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+                batch_size=1, retries=0,
+                spool_dir=os.path.join(spool_dir, 'spool'))
+            for i, db in enumerate(('db1', 'db2', 'db3')):
+                sqlcanonclient.DataManager.set_last_db_used(db)
+                # large enough to be compressed
+                statement = u'SELECT * FROM t WHERE a IN ({0})'.format(
+                    ', '.join([str(i)] * 200))
+                sqlcanonclient.ServerData.save_statement_data(
+                    statement, 'localhost', statement, i, i, {})
+            self.assertTrue(sqlcanonclient.ServerData.drain(10))
+            spool = sqlcanonclient.ServerData.SPOOL
+            sqlcanonclient.ServerData.close()
+        finally:
+            sqlcanonclient.SPOOL_RETRY_DELAY = spool_retry_delay
+            shutil.rmtree(spool_dir)
+
+        self.assertEqual(self.statuses, [])
+        self.assertEqual(
+            [data[0]['canonicalized_statement_hostname_hash']
+                for path, data in self.requests],
+            [0] * 6 + [1, 2])
+        self.assertEqual(self.encodings, ['gzip'] * 8)
+        # a request sent again has the same idempotency key
+        self.assertEqual(
+            [len(set(keys)) for keys in (
+                self.keys[:6], self.keys[6:], self.keys)],
+            [1, 2, 3])
+        self.assertEqual((spool.appended, spool.committed), (3, 3))
+        self.assertEqual(
+            [explain_connection_options['db']
+                for explain_items, explain_connection_options
+                in self.explained],
+            ['db1', 'db2', 'db3'])
+
+    def test_spool_error_response(self):
+        spool_retry_delay = sqlcanonclient.SPOOL_RETRY_DELAY
+        sqlcanonclient.SPOOL_RETRY_DELAY = 0.01
+        spool_dir = tempfile.mkdtemp()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            # rolled back by the server twice
+            self.errors = ['Deadlock found'] * 2
+            sqlcanonclient.ServerData.init(
+                'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+                batch_size=1, retries=0,
+                spool_dir=os.path.join(spool_dir, 'spool'))
+            sqlcanonclient.ServerData.save_statement_data(
+                u'SELECT 1', 'localhost', u'SELECT ?', 1, 1, {})
+            self.assertTrue(sqlcanonclient.ServerData.drain(10))
+            spool = sqlcanonclient.ServerData.SPOOL
+            sqlcanonclient.ServerData.close()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            sqlcanonclient.SPOOL_RETRY_DELAY = spool_retry_delay
+            shutil.rmtree(spool_dir)
+
+        # the request stays in the spool until it is saved
+        self.assertEqual(self.errors, [])
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(len(set(self.keys)), 1)
+        self.assertEqual(
+            output, 'ERROR: Deadlock found from /save-bulk/\n' * 2)
+        self.assertEqual((spool.appended, spool.committed), (1, 1))
+        self.assertEqual(len(self.explained), 1)
+
+    def test_spool_other_server(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(spool_dir, 'spool')
+            spool = sqlcanonclient.Spool(path)
+            spool.append(dict(
+                path='/save-statement-data/', data={}, last_dbs_used=[],
+                key='k', server_base_url='http://localhost:1'))
+            spool.close()
+            sqlcanonclient.ServerData.init(
+                'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+                batch_size=1, retries=0, spool_dir=path)
+            sqlcanonclient.ServerData.save_statement_data(
+                u'SELECT 1', 'localhost', u'SELECT N', 1, 1, {})
+            self.assertTrue(sqlcanonclient.ServerData.drain(10))
+            spool = sqlcanonclient.ServerData.SPOOL
+            sqlcanonclient.ServerData.close()
+        finally:
+            shutil.rmtree(spool_dir)
+
+        # the request spooled for another server is dropped
+        self.assertEqual(
+            [data[0]['canonicalized_statement_hostname_hash']
+                for path, data in self.requests],
+            [1])
+        self.assertEqual((spool.appended, spool.committed), (1, 2))
+
+
 class MySqlGenQueryLogParsingTest(unittest.TestCase):
     """Tests for MySQL general query log parsing."""
 
@@ -106,6 +1698,7 @@ class MySqlGenQueryLogParsingTest(unittest.TestCase):
         with codecs.open(test_log_file, encoding='utf_8', errors='replace') as f:
             #proc.process_log_contents(f)
             proc.read_lines(f)
+        sqlcanonclient.LocalData.flush()
 
         conn = sqlite3.connect(self.db)
         with conn:
@@ -172,6 +1765,7 @@ class MysqlSlowQueryLogParsingTest(unittest.TestCase):
         slow_query_log_processor = sqlcanonclient.SlowQueryLogProcessor()
         with codecs.open(test_log_file, encoding='utf_8', errors='replace') as f:
             slow_query_log_processor.process_log_contents(f)
+        sqlcanonclient.LocalData.flush()
 
         conn = sqlite3.connect(self.db)
         with conn:
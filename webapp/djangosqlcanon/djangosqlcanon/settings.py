@@ -33,6 +33,19 @@ DATABASES = {
     }
 }
 
+# Last statements snapshots are shared by the requests served by a process
+# with the local-memory cache, use memcached to share them between
+# processes.
+CACHES = {
+    #'default': {
+    #    'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+    #    'LOCATION': '127.0.0.1:11211',
+    #}
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
@@ -218,6 +231,27 @@ LOGGING = {
 # the table will hold.
 CAPTURED_STATEMENT_ROW_LIMIT = 10240
 
+# Number of minutes statement buckets are kept for, the longest last
+# statements window that can be shown.
+STATEMENT_BUCKET_RETENTION = 24 * 60
+
+# Number of minutes the idempotency keys of the requests of sqlcanonclient
+# are kept for, a request sent again within that time is not saved again.
+PROCESSED_REQUEST_RETENTION = 7 * 24 * 60
+
+# Minimum number of seconds between two prunings of processed requests by a
+# process.
+PRUNE_INTERVAL = 60
+
+# Number of seconds a last statements snapshot is served from the cache
+# before it is computed again, the refresh interval of the last statements
+# page.
+LAST_STATEMENTS_CACHE_TIMEOUT = 5
+
+# Maximum number of seconds requests wait for another request computing a
+# last statements snapshot, before computing it themselves.
+LAST_STATEMENTS_LOCK_TIMEOUT = 30
+
 # Maximum number of data for sparkline.
 SPARKLINE_DATA_COUNT_LIMIT = 20
 
@@ -226,4 +260,10 @@ try:
 except ImportError:
     pass
 
+# Ring heads are advanced on a second connection to the default database,
+# in transactions of their own, see
+# sqlcanon.logic.core.allocate_sequence_ids().
+DATABASES.setdefault(
+    'ring_heads', dict(DATABASES['default'], TEST_MIRROR='default'))
+
 
@@ -15,6 +15,42 @@ class StatementDataAdmin(admin.ModelAdmin):
         'created_at', 'updated_at')
 
 
+class StatementStatsAdmin(admin.ModelAdmin):
+    list_display = (
+        'id', 'dt_start', 'dt_end', 'statement', 'hostname', 'server_id',
+        'canonicalized_statement', 'canonicalized_statement_hash_hex_str',
+        'canonicalized_statement_hostname_hash_hex_str',
+        'count', 'query_time_sum', 'query_time_min', 'query_time_max',
+        'lock_time_sum', 'lock_time_min', 'lock_time_max',
+        'rows_examined_sum', 'rows_examined_min', 'rows_examined_max',
+        'rows_sent_sum', 'rows_sent_min', 'rows_sent_max', 'schema',
+        'created_at')
+
+
+class StatementSummaryAdmin(admin.ModelAdmin):
+    list_display = (
+        'id', 'canonicalized_statement_hash_hex_str', 'hostname', 'schema',
+        'canonicalized_statement', 'dt_first', 'dt_last',
+        'count', 'query_time_sum', 'query_time_min', 'query_time_max',
+        'lock_time_sum', 'lock_time_min', 'lock_time_max',
+        'rows_read_sum', 'rows_read_min', 'rows_read_max',
+        'rows_examined_sum', 'rows_examined_min', 'rows_examined_max',
+        'rows_sent_sum', 'rows_sent_min', 'rows_sent_max',
+        'updated_at')
+
+
+class StatementBucketAdmin(admin.ModelAdmin):
+    list_display = (
+        'id', 'dt_minute', 'canonicalized_statement_hostname_hash_hex_str',
+        'canonicalized_statement_hash_hex_str', 'canonicalized_statement',
+        'server_id', 'statement', 'dt_last', 'count', 'query_time_sum',
+        'updated_at')
+
+
+class ProcessedRequestAdmin(admin.ModelAdmin):
+    list_display = ('id', 'key', 'response', 'created_at')
+
+
 class ExplainResultInline(admin.TabularInline):
     model = models.ExplainResult
 
@@ -30,4 +66,8 @@ class ExplainedStatementAdmin(admin.ModelAdmin):
 
 
 admin.site.register(models.StatementData, StatementDataAdmin)
+admin.site.register(models.StatementStats, StatementStatsAdmin)
+admin.site.register(models.StatementSummary, StatementSummaryAdmin)
+admin.site.register(models.StatementBucket, StatementBucketAdmin)
+admin.site.register(models.ProcessedRequest, ProcessedRequestAdmin)
 admin.site.register(models.ExplainedStatement, ExplainedStatementAdmin)
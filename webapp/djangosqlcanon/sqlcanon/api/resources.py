@@ -88,7 +88,7 @@ class StatementDataResource(ModelResource):
         try:
             post = json.loads(request.raw_post_data)
             n = int(post['n'])
-            data['objects'] = core.get_last_statements(n)
+            data['objects'] = core.get_cached_last_statements(n)
         except Exception, e:
             log.exception('EXCEPTION')
             data['error_message'] = '%s' % (e,)
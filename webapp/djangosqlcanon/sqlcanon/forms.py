@@ -1,11 +1,14 @@
 from django import forms
+from django.conf import settings
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Submit
 
 
 class LastStatementsForm(forms.Form):
-    minutes = forms.IntegerField()
+    # statement buckets are kept for STATEMENT_BUCKET_RETENTION minutes
+    minutes = forms.IntegerField(
+        min_value=1, max_value=settings.STATEMENT_BUCKET_RETENTION)
 
     def __init__(self, *args, **kwargs):
         self.helper = FormHelper()
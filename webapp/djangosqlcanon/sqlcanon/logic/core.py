@@ -2,10 +2,15 @@
 
 import datetime
 import logging
+import operator
+import time
+import uuid
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Count, Sum, Avg, Max
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Max, Q, Sum
 from django.utils import timezone
 
 from sqlcanon import models
@@ -13,10 +18,61 @@ from sqlcanon import utils
 
 log = logging.getLogger(__name__)
 
+# statement data values summed, and kept the minimum and maximum of, by
+# statement summaries
+STATEMENT_SUMMARY_KEYS = (
+    'query_time', 'lock_time', 'rows_read', 'rows_examined', 'rows_sent')
+
+# columns top queries can be ordered by
+TOP_QUERIES_COLUMNS = (
+    'count', 'total_query_time', 'total_lock_time', 'total_rows_read',
+    'avg_query_time', 'avg_lock_time', 'avg_rows_read')
+
+# database alias of the connection ring heads are advanced on
+RING_HEAD_DB_ALIAS = 'ring_heads'
+
+# ON DUPLICATE KEY UPDATE expressions of update_rows(), {0} being the saved
+# value of a column and VALUES({0}) the added one; NULL values are skipped
+# like None values are by the merge functions
+SQL_ADD = '{0} + VALUES({0})'
+SQL_SUM = 'IF(VALUES({0}) IS NULL, {0}, COALESCE({0}, 0) + VALUES({0}))'
+SQL_LEAST = 'LEAST(COALESCE({0}, VALUES({0})), COALESCE(VALUES({0}), {0}))'
+SQL_GREATEST = (
+    'GREATEST(COALESCE({0}, VALUES({0})), COALESCE(VALUES({0}), {0}))')
+
+# a canonicalized statement replaces the saved one unless it is blank
+STATEMENT_SUMMARY_MERGE_SQL = [
+    ('count', SQL_ADD),
+    ('dt_first', SQL_LEAST),
+    ('dt_last', SQL_GREATEST),
+    ('canonicalized_statement', "COALESCE(NULLIF(VALUES({0}), ''), {0})")] + [
+    (k + suffix, sql)
+    for k in STATEMENT_SUMMARY_KEYS
+    for suffix, sql in (
+        ('_sum', SQL_SUM), ('_min', SQL_LEAST), ('_max', SQL_GREATEST))]
+
+# the sample fields of statement buckets are replaced by those of the last
+# statement; MySQL assigns columns in order, dt_last is assigned last
+STATEMENT_BUCKET_SAMPLE_FIELDS = (
+    'canonicalized_statement_hash', 'canonicalized_statement', 'server_id',
+    'statement', 'dt_last')
+STATEMENT_BUCKET_MERGE_SQL = [
+    ('count', SQL_ADD), ('query_time_sum', SQL_SUM)] + [
+    (k, 'IF({dt_last} IS NULL OR VALUES({dt_last}) >= {dt_last}, '
+        'VALUES({0}), {0})')
+    for k in STATEMENT_BUCKET_SAMPLE_FIELDS]
+
+# when this process last pruned processed requests, by model name
+pruned_at = {}
+
 
 def get_top_queries(n, column, filter_dict):
     """Returns top 'n' queries based on 'column'.
 
+    Queries are read from statement summaries, which cover every statement
+    saved so far, ordered and limited by the database. Raises ValueError if
+    column is not one of TOP_QUERIES_COLUMNS.
+
     Args:
 
         n: Top number of rows to return.
@@ -42,14 +98,14 @@ def get_top_queries(n, column, filter_dict):
         filter_dict: should be a dict with the following keys:
 
             hostname (optional): Filter result by hostname.
-                Use "__none__" to filter results whose hostname is None.
+                Use "__none__" to filter results without hostname.
 
             schema (optional): Filter result by schema.
-                Use "__none__" to filter results whose schema is None.
+                Use "__none__" to filter results without schema.
 
     Returns:
 
-        A StatementData queryset containing the following fields:
+        A list of dictionaries containing the following keys:
 
             hostname, if used in filtering
 
@@ -59,9 +115,7 @@ def get_top_queries(n, column, filter_dict):
 
             canonicalized_statement_hash
 
-        The queryset also contains the following annotations:
-
-            count: Group row count.
+            count: Number of statements.
 
             total_query_time: Sum of query_time.
 
@@ -76,6 +130,10 @@ def get_top_queries(n, column, filter_dict):
             avg_rows_read: Avg of rows_read.
     """
 
+    if column not in TOP_QUERIES_COLUMNS:
+        raise ValueError('Unknown column: %s' % (column,))
+
+    qn = connection.ops.quote_name
     hostname = filter_dict.get('hostname', None)
     schema = filter_dict.get('schema', None)
 
@@ -84,38 +142,69 @@ def get_top_queries(n, column, filter_dict):
         flds.append('hostname')
     if schema:
         flds.append('schema')
-    flds.extend(
-        ['canonicalized_statement', 'canonicalized_statement_hash'])
-    qs = models.StatementData.objects.values(*flds)
+    flds.append('canonicalized_statement_hash')
 
     #
     # apply filters if present
     #
-    if hostname and hostname == '__none__':
-        qs = qs.filter(hostname=None)
-    elif hostname and hostname != '__all__':
-        qs = qs.filter(hostname=hostname)
-    if schema and schema == '__none__':
-        qs = qs.filter(schema=None)
-    elif schema and schema != '__all__':
-        qs = qs.filter(schema=schema)
-
-    qs = qs.annotate(
-        count=Count('id'),
-        total_query_time=Sum('query_time'),
-        total_lock_time=Sum('lock_time'),
-        total_rows_read=Sum('rows_read'),
-        avg_query_time=Avg('query_time'),
-        avg_lock_time=Avg('lock_time'),
-        avg_rows_read=Avg('rows_read')
-    ).order_by('-%s' % (column,))[:n]
-
-    return qs
+    where = []
+    params = []
+    for k, v in (('hostname', hostname), ('schema', schema)):
+        if v and v == '__none__':
+            where.append('%s = %%s' % (qn(k),))
+            params.append('')
+        elif v and v != '__all__':
+            where.append('%s = %%s' % (qn(k),))
+            params.append(v)
+
+    # ordered and limited by the database, averages are ratios of sums
+    # which extra() would add to the GROUP BY clause; aliases are not named
+    # after fields
+    selects = [qn(fld) for fld in flds] + [
+        'MAX(%s) AS sample_statement' % (qn('canonicalized_statement'),),
+        'SUM(%s) AS statement_count' % (qn('count'),)]
+    for k in ('query_time', 'lock_time', 'rows_read'):
+        selects.append('SUM(%s) AS total_%s' % (qn('%s_sum' % (k,)), k))
+    for k in ('query_time', 'lock_time', 'rows_read'):
+        selects.append('SUM(%s) / NULLIF(SUM(%s), 0) AS avg_%s' % (
+            qn('%s_sum' % (k,)), qn('count'), k))
+    sql = 'SELECT %s FROM %s%s GROUP BY %s ORDER BY %s DESC LIMIT %%s' % (
+        ', '.join(selects),
+        qn(models.StatementSummary._meta.db_table),
+        ' WHERE %s' % (' AND '.join(where),) if where else '',
+        ', '.join(qn(fld) for fld in flds),
+        'statement_count' if column == 'count' else column)
+    params.append(max(n, 0))
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    names = flds + [
+        'canonicalized_statement', 'count',
+        'total_query_time', 'total_lock_time', 'total_rows_read',
+        'avg_query_time', 'avg_lock_time', 'avg_rows_read']
+    rows = []
+    for values in cursor.fetchall():
+        row = dict(zip(names, values))
+        # sums of integer columns are read as decimals
+        for k in ('count', 'total_rows_read'):
+            if row[k] is not None:
+                row[k] = int(row[k])
+        for k in ('avg_query_time', 'avg_lock_time', 'avg_rows_read'):
+            if row[k] is not None:
+                row[k] = float(row[k])
+        rows.append(row)
+    return rows
 
 
 def get_last_statements(last_minutes):
     """Returns statements found in last 'last_minutes' minutes.
 
+    Statements are read from the statement buckets of the current minute
+    and the 'last_minutes' - 1 minutes before it, one entry per
+    canonicalized statement-hostname hash, with the last statement as a
+    sample. Counts and query times are summed by the database, statements
+    are read from the last bucket of every hash only.
+
     Args:
 
         last_minutes: period length starting from current time going
@@ -123,57 +212,132 @@ def get_last_statements(last_minutes):
 
     Returns:
 
-        A list of dictionaries in the following format:
+        A list of dictionaries in the following format, ordered by dt__max:
 
         [
             {
-                "statement_data": obj,      # StatementData instance
+                "statement_data": {
+                    "canonicalized_statement": "",
+                    "server_id": 0,
+                    "canonicalized_statement_hostname_hash": 0,
+                    "canonicalized_statement_hash": 0,
+                    "statement": "",
+                    "dt__max": dt,          # date and time of the sample
+                    "dt__count": 0,
+                    "query_time_sum": 0.0   # None if none was recorded
+                },
                 "count": 0                  # number of instances
             },
             ...
         ]
     """
 
-    dt = timezone.now()
-    dt_start = dt - datetime.timedelta(minutes=last_minutes)
-    statement_data_qs = (
-        models.StatementData.objects
-        .filter(dt__gte=dt_start, dt__lte=dt)
-        .values(
+    dt_start = get_minute(timezone.now()) - datetime.timedelta(
+        minutes=last_minutes - 1)
+    buckets = models.StatementBucket.objects.filter(dt_minute__gte=dt_start)
+
+    # counts and times are summed by the database, annotations may not be
+    # named after fields
+    statements = {}
+    hashes_by_minute = {}
+    for row in (
+            buckets
+            .values('canonicalized_statement_hostname_hash')
+            .annotate(
+                statement_count=Sum('count'),
+                total_query_time=Sum('query_time_sum'),
+                dt_last_max=Max('dt_last'),
+                dt_minute_max=Max('dt_minute'))
+            .order_by()):
+        canonicalized_statement_hostname_hash = (
+            row['canonicalized_statement_hostname_hash'])
+        statements[canonicalized_statement_hostname_hash] = dict(
+            dt__max=row['dt_last_max'],
+            dt__count=row['statement_count'],
+            query_time_sum=row['total_query_time'])
+        hashes_by_minute.setdefault(row['dt_minute_max'], []).append(
+            canonicalized_statement_hostname_hash)
+    if not statements:
+        return []
+
+    # the samples are read from the last bucket of every hash only
+    samples = buckets.filter(reduce(operator.or_, [
+        Q(dt_minute=dt_minute,
+            canonicalized_statement_hostname_hash__in=hashes)
+        for dt_minute, hashes in hashes_by_minute.iteritems()]))
+    for sample in samples.values(
             'canonicalized_statement',
             'server_id',
             'canonicalized_statement_hostname_hash',
             'canonicalized_statement_hash',
-            'statement')
-        .annotate(Max('dt'), Count('dt')).order_by('dt__max'))
-
-    # calculate counts
-    counts = {}
-    for statement_data in statement_data_qs:
-        canonicalized_statement_hostname_hash = (
-            statement_data['canonicalized_statement_hostname_hash'])
-        if canonicalized_statement_hostname_hash in counts:
-            counts[canonicalized_statement_hostname_hash] += (
-                statement_data['dt__count'])
-        else:
-            counts[canonicalized_statement_hostname_hash] = (
-                statement_data['dt__count'])
+            'statement'):
+        statements[sample['canonicalized_statement_hostname_hash']].update(
+            sample)
 
     objects = []
-    for statement_data in statement_data_qs:
-        canonicalized_statement_hostname_hash = (
-            statement_data['canonicalized_statement_hostname_hash'])
-        count = counts.get(canonicalized_statement_hostname_hash, 1)
-
+    for statement_data in sorted(
+            statements.itervalues(), key=lambda v: v['dt__max']):
         objects.append(
             dict(
                 statement_data=statement_data,
-                count=count
+                count=statement_data['dt__count']
             )
         )
     return objects
 
 
+def get_cached_last_statements(last_minutes):
+    """Returns get_last_statements(last_minutes), computed at most once
+    every LAST_STATEMENTS_CACHE_TIMEOUT seconds.
+
+    Snapshots are shared through the cache. A single request computes an
+    expired snapshot, the others get the expired one meanwhile, or wait
+    for the new one if there is none. last_minutes is clamped to 1 to
+    STATEMENT_BUCKET_RETENTION, the windows buckets are kept for, which
+    also bounds the number of snapshots cached.
+    """
+
+    last_minutes = min(
+        max(last_minutes, 1), settings.STATEMENT_BUCKET_RETENTION)
+    key = 'sqlcanon.last_statements.%d' % (last_minutes,)
+    lock_key = '%s.lock' % (key,)
+    # expired snapshots are kept while a new one is computed
+    snapshot = cache.get(key)
+    if snapshot is not None and snapshot['expires_at'] > time.time():
+        return snapshot['objects']
+
+    wait_until = time.time() + settings.LAST_STATEMENTS_LOCK_TIMEOUT
+    # the lock may expire while it is held, then be taken by another
+    # request, which the token tells apart
+    token = uuid.uuid4().hex
+    while True:
+        if cache.add(lock_key, token, settings.LAST_STATEMENTS_LOCK_TIMEOUT):
+            try:
+                objects = get_last_statements(last_minutes)
+                cache.set(
+                    key,
+                    dict(
+                        expires_at=(
+                            time.time() +
+                            settings.LAST_STATEMENTS_CACHE_TIMEOUT),
+                        objects=objects),
+                    settings.LAST_STATEMENTS_CACHE_TIMEOUT +
+                    settings.LAST_STATEMENTS_LOCK_TIMEOUT)
+            finally:
+                if cache.get(lock_key) == token:
+                    cache.delete(lock_key)
+            return objects
+        if snapshot is not None:
+            return snapshot['objects']
+        if time.time() >= wait_until:
+            # the request holding the lock is stuck
+            return get_last_statements(last_minutes)
+        time.sleep(0.1)
+        snapshot = cache.get(key)
+        if snapshot is not None:
+            return snapshot['objects']
+
+
 def save_explained_statement(**kwargs):
     """Saves explain results."""
 
@@ -208,36 +372,547 @@ def save_explained_statement(**kwargs):
     return explained_statement
 
 
+def allocate_sequence_ids(count=1):
+    """Returns the sequence_ids of the next count statement data rows to be
+    used, in order.
+
+    The ring head of the statements table is locked while it is advanced,
+    concurrent requests get distinct rows. The advance is committed at once
+    so that the lock is held briefly, on the RING_HEAD_DB_ALIAS connection:
+    what the request saved so far is left to the transaction of the
+    request, to be committed or rolled back with the rest of it.
+    """
+
+    name = models.StatementData._meta.db_table
+    heads = models.RingHead.objects.using(RING_HEAD_DB_ALIAS)
+    with transaction.commit_on_success(using=RING_HEAD_DB_ALIAS):
+        try:
+            head = heads.select_for_update().get(name=name)
+        except ObjectDoesNotExist:
+            # databases created without the migrations
+            heads.get_or_create(name=name)
+            head = heads.select_for_update().get(name=name)
+        heads.filter(pk=head.pk).update(position=F('position') + count)
+    return [(head.position + i) % settings.CAPTURED_STATEMENT_ROW_LIMIT
+        for i in xrange(count)]
+
+
+def save_statement_data_row(sequence_id, **kwargs):
+    """Saves statement data in the row of sequence_id.
+
+    The row is updated in a single query, or inserted while the table holds
+    less than CAPTURED_STATEMENT_ROW_LIMIT rows. Fields missing from kwargs
+    are reset, the row no longer holds the statement it held before.
+    """
+
+    field_value_map = {}
+    for field in models.StatementData._meta.fields:
+        if field.name not in ('id', 'sequence_id', 'created_at'):
+            field_value_map[field.name] = kwargs.get(
+                field.name, field.get_default())
+    # update() does not set auto_now fields
+    field_value_map['updated_at'] = timezone.now()
+
+    updated = models.StatementData.objects.filter(
+        sequence_id=sequence_id).update(**field_value_map)
+    if not updated:
+        field_value_map.update(sequence_id=sequence_id)
+        models.StatementData.objects.create(**field_value_map)
+
+
+def get_statement_data_id(sequence_id):
+    """Returns the id of the statement data row of sequence_id."""
+
+    return models.StatementData.objects.values_list(
+        'id', flat=True).get(sequence_id=sequence_id)
+
+
 def save_statement_data(**kwargs):
     """Saves statement data.
 
     Statement data are stored in round-robin fashion.
+
+    Returns:
+
+        The sequence_id of the row used.
     """
 
-    qs = models.StatementData.objects.order_by(
-        '-updated_at', '-sequence_id')[:1]
-    statement_data = None
-    if qs:
-        statement_data = qs[0]
-    if statement_data:
-        sequence_id = ((statement_data.sequence_id + 1) %
-            settings.CAPTURED_STATEMENT_ROW_LIMIT)
-    else:
-        sequence_id = 1
+    sequence_id = allocate_sequence_ids()[0]
+    save_statement_data_row(sequence_id, **kwargs)
+    update_statement_summaries([get_statement_summary_values(kwargs)])
+    update_statement_buckets([get_statement_bucket_values(kwargs)])
+    return sequence_id
 
-    #
-    # update if row exist, otherwise, create it
-    #
-    field_value_map = dict([(k, v) for k, v in kwargs.iteritems() if v])
+
+def save_statement_data_list(statement_data_list, summarize=True):
+    """Saves a list of statement data, in the order of the list.
+
+    Statement data are stored in round-robin fashion, in the rows following
+    the last one used.
+
+    Args:
+
+        statement_data_list: A list of dictionaries of save_statement_data()
+            keyword arguments.
+
+        summarize: Whether to add the statement data to statement
+            summaries and statement buckets.
+
+    Returns:
+
+        A list of dictionaries in the following format, for the SELECT
+        statements seen for the first time:
+
+        [
+            {
+                "index": 0,             # position in statement_data_list
+                "statement": "",
+                "statement_data_id": 0,
+                "schema": ""            # if the statement data has one
+            },
+            ...
+        ]
+    """
+
+    # hashes of the SELECT statements, and those already saved
+    hashes = set()
+    for kwargs in statement_data_list:
+        canonicalized_statement = kwargs.get('canonicalized_statement')
+        if canonicalized_statement and canonicalized_statement.startswith(
+                'SELECT '):
+            hashes.add(kwargs.get('canonicalized_statement_hostname_hash'))
+    seen = set()
+    if hashes:
+        seen.update(
+            models.StatementData.objects
+            .filter(canonicalized_statement_hostname_hash__in=hashes)
+            .values_list('canonicalized_statement_hostname_hash', flat=True)
+            .distinct())
+
+    explain = []
+    if not statement_data_list:
+        return explain
+    sequence_ids = allocate_sequence_ids(len(statement_data_list))
+    for index, kwargs in enumerate(statement_data_list):
+        save_statement_data_row(sequence_ids[index], **kwargs)
+
+        canonicalized_statement_hostname_hash = kwargs.get(
+            'canonicalized_statement_hostname_hash')
+        if (canonicalized_statement_hostname_hash in hashes and
+                canonicalized_statement_hostname_hash not in seen):
+            # first time we saw this statement
+            seen.add(canonicalized_statement_hostname_hash)
+            explain_data = dict(
+                index=index,
+                statement=kwargs['statement'],
+                statement_data_id=get_statement_data_id(sequence_ids[index]))
+            if kwargs.get('schema'):
+                explain_data['schema'] = kwargs['schema']
+            explain.append(explain_data)
+
+    if summarize:
+        update_statement_summaries([
+            get_statement_summary_values(kwargs)
+            for kwargs in statement_data_list])
+        update_statement_buckets([
+            get_statement_bucket_values(kwargs)
+            for kwargs in statement_data_list])
+
+    return explain
+
+
+def save_statement_stats_list(statement_stats_list):
+    """Saves a list of statement stats, and their sample statements.
+
+    The sample statements are saved as statement data, the statement stats
+    of a statement seen for the first time ask for its EXPLAIN.
+
+    Args:
+
+        statement_stats_list: A list of (statement data, statement stats)
+            tuples, save_statement_data() keyword arguments of the sample
+            statement and StatementStats field values.
+
+    Returns:
+
+        The save_statement_data_list() list of the sample statements.
+    """
+
+    models.StatementStats.objects.bulk_create([
+        models.StatementStats(**statement_stats)
+        for __, statement_stats in statement_stats_list])
+    # statement summaries and buckets count the statements of the stats,
+    # not the samples
+    explain = save_statement_data_list(
+        [statement_data for statement_data, __ in statement_stats_list],
+        summarize=False)
+    update_statement_summaries([
+        get_statement_stats_summary_values(statement_stats)
+        for __, statement_stats in statement_stats_list])
+    update_statement_buckets([
+        get_statement_stats_bucket_values(statement_data, statement_stats)
+        for statement_data, statement_stats in statement_stats_list])
+    return explain
+
+
+def get_statement_summary_values(statement_data):
+    """Returns the update_statement_summaries() values of a statement,
+    statement_data being save_statement_data() keyword arguments."""
+
+    values = dict(
+        canonicalized_statement_hash=statement_data.get(
+            'canonicalized_statement_hash'),
+        hostname=statement_data.get('hostname'),
+        schema=statement_data.get('schema'),
+        canonicalized_statement=statement_data.get(
+            'canonicalized_statement', ''),
+        dt_first=statement_data.get('dt'),
+        dt_last=statement_data.get('dt'),
+        count=1)
+    for k in STATEMENT_SUMMARY_KEYS:
+        value = statement_data.get(k)
+        values['%s_sum' % (k,)] = value
+        values['%s_min' % (k,)] = value
+        values['%s_max' % (k,)] = value
+    return values
+
+
+def get_statement_stats_summary_values(statement_stats):
+    """Returns the update_statement_summaries() values of the statements of
+    statement stats, StatementStats field values."""
+
+    values = dict(
+        canonicalized_statement_hash=statement_stats.get(
+            'canonicalized_statement_hash'),
+        hostname=statement_stats.get('hostname'),
+        schema=statement_stats.get('schema'),
+        canonicalized_statement=statement_stats.get(
+            'canonicalized_statement', ''),
+        dt_first=statement_stats.get('dt_start'),
+        dt_last=statement_stats.get('dt_end'),
+        count=statement_stats.get('count', 0))
+    for k in STATEMENT_SUMMARY_KEYS:
+        for suffix in ('_sum', '_min', '_max'):
+            values[k + suffix] = statement_stats.get(k + suffix)
+    return values
+
+
+def merge_statement_summary_values(values, other_values):
+    """Adds other_values to values, both update_statement_summaries()
+    values of the same statement summary."""
+
+    def least(a, b):
+        if a is None or b is None:
+            return b if a is None else a
+        return min(a, b)
+
+    def greatest(a, b):
+        if a is None or b is None:
+            return b if a is None else a
+        return max(a, b)
+
+    values['count'] += other_values['count']
+    values['dt_first'] = least(values['dt_first'], other_values['dt_first'])
+    values['dt_last'] = greatest(values['dt_last'], other_values['dt_last'])
+    if other_values['canonicalized_statement']:
+        values['canonicalized_statement'] = (
+            other_values['canonicalized_statement'])
+    for k in STATEMENT_SUMMARY_KEYS:
+        k_sum = '%s_sum' % (k,)
+        if other_values[k_sum] is not None:
+            values[k_sum] = (values[k_sum] or 0) + other_values[k_sum]
+        k_min = '%s_min' % (k,)
+        values[k_min] = least(values[k_min], other_values[k_min])
+        k_max = '%s_max' % (k,)
+        values[k_max] = greatest(values[k_max], other_values[k_max])
+
+
+def update_rows(model, key_fields, values_by_key, merge_values,
+        merge_sql=None):
+    """Adds values to rows of model, identified by the values of key_fields.
+
+    On MySQL, rows are inserted, or merged into the existing ones, by a
+    single INSERT ... ON DUPLICATE KEY UPDATE in key order, without the gap
+    locks of a locking read of missing rows; concurrent requests adding to
+    the same rows wait for each other instead of deadlocking. Otherwise, or
+    without merge_sql, rows are locked and updated one at a time in key
+    order, missing ones are created.
+
+    Args:
+
+        model: A model whose key_fields are unique together.
+
+        key_fields: A list of field names.
+
+        values_by_key: A dictionary of field values of the rows, by tuples
+            of their key_fields values.
+
+        merge_values: A function adding field values to saved field values,
+            both dictionaries, in place.
+
+        merge_sql: A list of (field name, SQL expression) tuples doing what
+            merge_values does, in the order the fields are assigned.
+            Expressions are formatted with the quoted column of the field
+            as {0}, and those of the fields of model by name.
+    """
+
+    if not values_by_key:
+        return
+
+    keys = sorted(values_by_key)
+    if merge_sql is not None and connection.vendor == 'mysql':
+        insert_rows(model, [values_by_key[key] for key in keys], merge_sql)
+        return
+
+    for key in keys:
+        values = values_by_key[key]
+        filters = dict(zip(key_fields, key))
+        try:
+            row = model.objects.select_for_update().get(**filters)
+        except ObjectDoesNotExist:
+            sid = transaction.savepoint()
+            try:
+                model.objects.create(**values)
+                transaction.savepoint_commit(sid)
+                continue
+            except IntegrityError:
+                # created by a concurrent request
+                transaction.savepoint_rollback(sid)
+                row = model.objects.select_for_update().get(**filters)
+        saved_values = dict((k, getattr(row, k)) for k in values)
+        merge_values(saved_values, values)
+        # update() does not set auto_now fields
+        for field in model._meta.fields:
+            if getattr(field, 'auto_now', False):
+                saved_values[field.name] = timezone.now()
+        model.objects.filter(pk=row.pk).update(**saved_values)
+
+
+def insert_rows(model, values_list, merge_sql):
+    """Inserts rows of model, or merges them into the rows of the same
+    unique key with the update_rows() merge_sql expressions, in a single
+    MySQL query."""
+
+    qn = connection.ops.quote_name
+    now = timezone.now()
+    fields = [
+        field for field in model._meta.local_fields
+        if not field.primary_key]
+    params = []
+    for values in values_list:
+        for field in fields:
+            if field.name in values:
+                value = values[field.name]
+            elif getattr(field, 'auto_now', False) or getattr(
+                    field, 'auto_now_add', False):
+                value = now
+            else:
+                value = field.get_default()
+            params.append(field.get_db_prep_save(value, connection))
+
+    columns = dict(
+        (field.name, qn(field.column)) for field in model._meta.fields)
+    assignments = [
+        '%s = %s' % (columns[name], sql.format(columns[name], **columns))
+        for name, sql in merge_sql]
+    # update() does not set auto_now fields
+    for field in fields:
+        if getattr(field, 'auto_now', False):
+            assignments.append('%s = VALUES(%s)' % (
+                columns[field.name], columns[field.name]))
+    row_sql = '(%s)' % (', '.join(['%s'] * len(fields)),)
+    sql = 'INSERT INTO %s (%s) VALUES %s ON DUPLICATE KEY UPDATE %s' % (
+        qn(model._meta.db_table),
+        ', '.join(qn(field.column) for field in fields),
+        ', '.join([row_sql] * len(values_list)),
+        ', '.join(assignments))
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+
+
+def update_statement_summaries(values_list):
+    """Adds statements to statement summaries.
+
+    The values of the same summary are added together first, then the
+    summaries are updated with update_rows(), in a single query on MySQL.
+
+    Args:
+
+        values_list: A list of dictionaries of StatementSummary field
+            values, as returned by get_statement_summary_values() and
+            get_statement_stats_summary_values(). Values without
+            canonicalized_statement_hash are skipped.
+    """
+
+    summary_values = {}
+    for values in values_list:
+        if values['canonicalized_statement_hash'] is None:
+            continue
+        key = (
+            values['canonicalized_statement_hash'],
+            (values['hostname'] or '')[:255],
+            (values['schema'] or '')[:64])
+        if key in summary_values:
+            merge_statement_summary_values(summary_values[key], values)
+        else:
+            summary_values[key] = dict(
+                values, hostname=key[1], schema=key[2])
+    update_rows(
+        models.StatementSummary,
+        ('canonicalized_statement_hash', 'hostname', 'schema'),
+        summary_values, merge_statement_summary_values,
+        STATEMENT_SUMMARY_MERGE_SQL)
+
+
+def get_minute(dt):
+    """Returns the start of the minute of dt."""
+
+    return dt.replace(second=0, microsecond=0)
+
+
+def get_statement_bucket_values(statement_data):
+    """Returns the update_statement_buckets() values of a statement,
+    statement_data being save_statement_data() keyword arguments."""
+
+    dt = statement_data.get('dt')
+    return dict(
+        dt_minute=get_minute(dt) if dt else None,
+        canonicalized_statement_hostname_hash=statement_data.get(
+            'canonicalized_statement_hostname_hash'),
+        canonicalized_statement_hash=statement_data.get(
+            'canonicalized_statement_hash'),
+        canonicalized_statement=statement_data.get(
+            'canonicalized_statement', ''),
+        server_id=statement_data.get('server_id'),
+        statement=statement_data.get('statement', ''),
+        dt_last=dt,
+        count=1,
+        query_time_sum=statement_data.get('query_time'))
+
+
+def get_statement_stats_bucket_values(statement_data, statement_stats):
+    """Returns the update_statement_buckets() values of the statements of
+    statement stats, StatementStats field values, statement_data being the
+    save_statement_data() keyword arguments of their sample statement.
+
+    The statements are counted in the minute the sample statement was
+    saved, like the statements saved one by one.
+    """
+
+    values = get_statement_bucket_values(statement_data)
+    values.update(
+        count=statement_stats.get('count', 0),
+        query_time_sum=statement_stats.get('query_time_sum'))
+    return values
+
+
+def merge_statement_bucket_values(values, other_values):
+    """Adds other_values to values, both update_statement_buckets() values
+    of the same statement bucket."""
+
+    values['count'] += other_values['count']
+    if other_values['query_time_sum'] is not None:
+        values['query_time_sum'] = (
+            (values['query_time_sum'] or 0) + other_values['query_time_sum'])
+    if (values['dt_last'] is None or (other_values['dt_last'] is not None and
+            other_values['dt_last'] >= values['dt_last'])):
+        # the last statement is the sample
+        for k in STATEMENT_BUCKET_SAMPLE_FIELDS:
+            values[k] = other_values[k]
+
+
+def update_statement_buckets(values_list):
+    """Adds statements to statement buckets.
+
+    Statement buckets are pruned by the prune_statement_buckets command,
+    outside of the transaction of the request saving statements.
+
+    Args:
+
+        values_list: A list of dictionaries of StatementBucket field values,
+            as returned by get_statement_bucket_values() and
+            get_statement_stats_bucket_values(). Values without dt_minute
+            or canonicalized_statement_hostname_hash are skipped.
+    """
+
+    bucket_values = {}
+    for values in values_list:
+        key = (
+            values['dt_minute'],
+            values['canonicalized_statement_hostname_hash'])
+        if None in key:
+            continue
+        if key in bucket_values:
+            merge_statement_bucket_values(bucket_values[key], values)
+        else:
+            bucket_values[key] = dict(values)
+    update_rows(
+        models.StatementBucket,
+        ('dt_minute', 'canonicalized_statement_hostname_hash'),
+        bucket_values, merge_statement_bucket_values,
+        STATEMENT_BUCKET_MERGE_SQL)
+
+
+def prune_if_due(model, prune):
+    """Calls prune(), pruning the rows of model, unless this process did in
+    the last PRUNE_INTERVAL seconds."""
+
+    name = model.__name__
+    dt = timezone.now()
+    if (name not in pruned_at or dt - pruned_at[name] >= datetime.timedelta(
+            seconds=settings.PRUNE_INTERVAL)):
+        pruned_at[name] = dt
+        prune()
+
+
+def prune_statement_buckets():
+    """Deletes the statement buckets older than STATEMENT_BUCKET_RETENTION
+    minutes."""
+
+    dt_start = get_minute(timezone.now()) - datetime.timedelta(
+        minutes=settings.STATEMENT_BUCKET_RETENTION - 1)
+    models.StatementBucket.objects.filter(dt_minute__lt=dt_start).delete()
+
+
+def claim_request(key):
+    """Records that the request of idempotency key key is being processed,
+    returns False if it was processed already.
+
+    The row is created in the transaction of the request, a concurrent
+    request of the same key waits for it to be committed or rolled back on
+    the unique key of the row. Processed requests older than
+    PROCESSED_REQUEST_RETENTION minutes are pruned if they are due.
+    """
+
+    prune_if_due(models.ProcessedRequest, prune_processed_requests)
+    sid = transaction.savepoint()
     try:
-        statement_data = models.StatementData.objects.get(
-            sequence_id=sequence_id)
-        for k, v in field_value_map.iteritems():
-            setattr(statement_data, k, v)
-        statement_data.save()
-    except ObjectDoesNotExist:
-        field_value_map.update(sequence_id=sequence_id)
-        statement_data = models.StatementData.objects.create(
-            **field_value_map)
+        models.ProcessedRequest.objects.create(key=key)
+        transaction.savepoint_commit(sid)
+        return True
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return False
+
+
+def get_request_response(key):
+    """Returns the response content of the processed request of key."""
+
+    return models.ProcessedRequest.objects.values_list(
+        'response', flat=True).get(key=key)
+
+
+def save_request_response(key, response):
+    """Saves the response content of the request of key, claimed with
+    claim_request()."""
+
+    models.ProcessedRequest.objects.filter(key=key).update(response=response)
+
+
+def prune_processed_requests():
+    """Deletes the processed requests older than
+    PROCESSED_REQUEST_RETENTION minutes."""
 
-    return statement_data
+    dt_start = timezone.now() - datetime.timedelta(
+        minutes=settings.PROCESSED_REQUEST_RETENTION)
+    models.ProcessedRequest.objects.filter(created_at__lt=dt_start).delete()
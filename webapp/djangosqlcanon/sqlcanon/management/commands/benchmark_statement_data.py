@@ -0,0 +1,174 @@
+"""Benchmarks the StatementData queries of the webapp."""
+
+import datetime
+import importlib
+import random
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from south.db import db
+
+from sqlcanon import models
+from sqlcanon.logic import core
+
+
+# distinct canonicalized statements, hostnames and schemas of the rows
+SHAPES = 500
+HOSTNAMES = 10
+SCHEMAS = 20
+
+# rows inserted per query
+INSERT_BATCH_SIZE = 1000
+
+# seconds after which a query is not repeated anymore
+QUERY_TIME_LIMIT = 2.0
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs the StatementData queries of the webapp in a test database, '
+        'holding CAPTURED_STATEMENT_ROW_LIMIT times every --scales rows.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--scales', default='1,100',
+            help='Comma separated multiples of CAPTURED_STATEMENT_ROW_LIMIT '
+                'to benchmark.'),
+        make_option(
+            '--repeat', type='int', default=100,
+            help='Number of times every query is run.'),
+        make_option(
+            '--without-indexes', action='store_true', default=False,
+            help='Benchmark the statements table without the indexes of '
+                'migration 0003.'),
+    )
+
+    def handle(self, *args, **options):
+        scales = [int(scale) for scale in options['scales'].split(',')]
+
+        # the test database is created by running the migrations
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        connection.use_debug_cursor = False
+        try:
+            if options['without_indexes']:
+                # the schema operations of the migration, the rest of the
+                # schema is left as it is
+                migration = importlib.import_module(
+                    'sqlcanon.migrations.0003_auto__add_index_statementdata')
+                db.start_transaction()
+                migration.Migration().backwards(None)
+                db.commit_transaction()
+            for scale in scales:
+                self.benchmark(
+                    settings.CAPTURED_STATEMENT_ROW_LIMIT * scale, scale,
+                    options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def insert(self, statement_data_list):
+        models.StatementData.objects.bulk_create(statement_data_list)
+        core.update_statement_summaries([
+            core.get_statement_summary_values(vars(statement_data))
+            for statement_data in statement_data_list])
+        core.update_statement_buckets([
+            core.get_statement_bucket_values(vars(statement_data))
+            for statement_data in statement_data_list])
+
+    def benchmark(self, rows, scale, repeat):
+        rand = random.Random(rows)
+        cursor = connection.cursor()
+        for model in (
+                models.StatementData, models.StatementSummary,
+                models.StatementBucket):
+            cursor.execute('DELETE FROM %s' % (model._meta.db_table,))
+
+        start = time.time()
+        now = timezone.now()
+        statement_data_list = []
+        for i in xrange(rows):
+            shape = rand.randrange(SHAPES)
+            hostname = rand.randrange(HOSTNAMES)
+            statement_data_list.append(models.StatementData(
+                dt=now - datetime.timedelta(
+                    seconds=rand.randrange(24 * 60 * 60)),
+                statement=u'SELECT * FROM t%d WHERE a = %d' % (shape, i),
+                server_id=1,
+                hostname=u'host%d' % (hostname,),
+                schema=u'schema%d' % (rand.randrange(SCHEMAS),),
+                canonicalized_statement=(
+                    u'SELECT * FROM t%d WHERE a = ?' % (shape,)),
+                canonicalized_statement_hash=shape,
+                canonicalized_statement_hostname_hash=(
+                    shape * HOSTNAMES + hostname),
+                query_time=rand.random(),
+                lock_time=rand.random() / 100,
+                rows_read=rand.randrange(1000),
+                sequence_id=i))
+            if len(statement_data_list) == INSERT_BATCH_SIZE:
+                self.insert(statement_data_list)
+                statement_data_list = []
+        if statement_data_list:
+            self.insert(statement_data_list)
+        self.stdout.write(
+            '%d rows (%d x CAPTURED_STATEMENT_ROW_LIMIT), inserted in '
+            '%.1f s' % (rows, scale, time.time() - start))
+
+        queries = [
+            # save_statement_data: first seen SELECT statement
+            ('count by hash', lambda: (
+                models.StatementData.objects
+                .filter(canonicalized_statement_hostname_hash=rand.randrange(
+                    SHAPES * HOSTNAMES))
+                .count())),
+            # save_statement_data: next round-robin row, before RingHead
+            ('last row used', lambda: list(
+                models.StatementData.objects
+                .order_by('-updated_at', '-sequence_id')[:1])),
+            ('get by sequence id', lambda: (
+                models.StatementData.objects
+                .get(sequence_id=rand.randrange(rows)))),
+            # last statements dashboard
+            ('last statements, 5 minutes', lambda: (
+                core.get_last_statements(5))),
+            ('last statements, 60 minutes', lambda: (
+                core.get_last_statements(60))),
+            ('last statements, 24 hours', lambda: (
+                core.get_last_statements(24 * 60))),
+            ('cached last statements, 60 minutes', lambda: (
+                core.get_cached_last_statements(60))),
+            # top queries dashboard
+            ('top queries', lambda: list(
+                core.get_top_queries(10, 'count', {}))),
+            ('top queries by hostname', lambda: list(
+                core.get_top_queries(10, 'total_query_time', dict(
+                    hostname=u'host%d' % (rand.randrange(HOSTNAMES),))))),
+            ('hostname choices', lambda: list(
+                models.StatementSummary.objects
+                .values('hostname').distinct())),
+            ('allocate sequence id', core.allocate_sequence_ids),
+            ('save statement data', lambda: core.save_statement_data(
+                statement=u'SELECT 1',
+                canonicalized_statement=u'SELECT ?',
+                canonicalized_statement_hash=SHAPES,
+                canonicalized_statement_hostname_hash=SHAPES * HOSTNAMES,
+                dt=timezone.now())),
+            ('prune statement buckets', core.prune_statement_buckets),
+        ]
+        for name, query in queries:
+            start = time.time()
+            count = 0
+            while count < repeat:
+                query()
+                count += 1
+                if time.time() - start >= QUERY_TIME_LIMIT:
+                    break
+            self.stdout.write(
+                '  %-30s %10.3f ms (%d runs)' % (
+                    name, (time.time() - start) * 1000 / count, count))
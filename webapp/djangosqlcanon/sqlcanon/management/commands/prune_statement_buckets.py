@@ -0,0 +1,23 @@
+"""Deletes the statement buckets older than STATEMENT_BUCKET_RETENTION
+minutes."""
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from sqlcanon.logic import core
+
+
+class Command(NoArgsCommand):
+    help = (
+        'Deletes the statement buckets older than '
+        'STATEMENT_BUCKET_RETENTION minutes, to be run from cron; they '
+        'are not pruned while statements are saved.')
+
+    def handle_noargs(self, **options):
+        with transaction.commit_on_success():
+            core.prune_statement_buckets()
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write(
+                'Pruned statement buckets older than %d minutes.' % (
+                    settings.STATEMENT_BUCKET_RETENTION,))
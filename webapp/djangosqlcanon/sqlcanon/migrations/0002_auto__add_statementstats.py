@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'StatementStats'
+        db.create_table(u'statement_stats', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('dt_start', self.gf('django.db.models.fields.DateTimeField')(null=True, db_index=True, blank=True)),
+            ('dt_end', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+            ('statement', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('server_id', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('hostname', self.gf('django.db.models.fields.CharField')(max_length=256, null=True, blank=True)),
+            ('schema', self.gf('django.db.models.fields.CharField')(max_length=256, null=True, blank=True)),
+            ('canonicalized_statement', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('canonicalized_statement_hash', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('canonicalized_statement_hostname_hash', self.gf('django.db.models.fields.IntegerField')(null=True, db_index=True, blank=True)),
+            ('count', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('query_time_sum', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('query_time_min', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('query_time_max', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('lock_time_sum', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('lock_time_min', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('lock_time_max', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('rows_examined_sum', self.gf('django.db.models.fields.BigIntegerField')(null=True, blank=True)),
+            ('rows_examined_min', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('rows_examined_max', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('rows_sent_sum', self.gf('django.db.models.fields.BigIntegerField')(null=True, blank=True)),
+            ('rows_sent_min', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('rows_sent_max', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('created_at', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, null=True, blank=True)),
+        ))
+        db.send_create_signal(u'sqlcanon', ['StatementStats'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'StatementStats'
+        db.delete_table(u'statement_stats')
+
+
+    models = {
+        u'sqlcanon.explainedstatement': {
+            'Meta': {'object_name': 'ExplainedStatement', 'db_table': "u'explained_statements'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'db': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'dt': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.explainresult': {
+            'Meta': {'object_name': 'ExplainResult', 'db_table': "u'explain_results'"},
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'explained_statement': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'explain_results'", 'null': 'True', 'db_column': "u'explained_statement_id'", 'to': u"orm['sqlcanon.ExplainedStatement']"}),
+            'extra': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'key_len': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'possible_keys': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'ref': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'rows': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'select_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'select_type': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'table': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'type': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.statementdata': {
+            'Meta': {'object_name': 'StatementData', 'db_table': "u'statements'"},
+            'bytes_sent': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'dt': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lock_time': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_affected': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_read': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'sequence_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'tmp_disk_tables': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'tmp_table_sizes': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'tmp_tables': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.statementstats': {
+            'Meta': {'object_name': 'StatementStats', 'db_table': "u'statement_stats'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'dt_end': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'dt_start': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lock_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['sqlcanon']
\ No newline at end of file
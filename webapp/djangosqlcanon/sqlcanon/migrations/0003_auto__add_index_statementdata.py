@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Removing duplicate sequence ids, keeping the row used last
+        if not db.dry_run:
+            duplicates = (
+                orm.StatementData.objects.exclude(sequence_id=None)
+                .values('sequence_id')
+                .annotate(rows=models.Count('id'))
+                .filter(rows__gt=1))
+            for duplicate in duplicates:
+                ids = list(
+                    orm.StatementData.objects
+                    .filter(sequence_id=duplicate['sequence_id'])
+                    .order_by('-updated_at', '-id')
+                    .values_list('id', flat=True))
+                orm.StatementData.objects.filter(id__in=ids[1:]).delete()
+
+        # Adding unique constraint on 'StatementData', fields ['sequence_id']
+        db.create_unique(u'statements', ['sequence_id'])
+
+        # Adding index on 'StatementData', fields ['canonicalized_statement_hostname_hash']
+        db.create_index(u'statements', ['canonicalized_statement_hostname_hash'])
+
+        # Adding index on 'StatementData', fields ['updated_at', 'sequence_id']
+        db.create_index(u'statements', ['updated_at', 'sequence_id'])
+
+        # Adding index on 'StatementData', fields ['dt', 'canonicalized_statement_hostname_hash']
+        db.create_index(u'statements', ['dt', 'canonicalized_statement_hostname_hash'])
+
+        # Adding index on 'StatementData', fields ['hostname', 'schema']
+        if db.backend_name == 'mysql':
+            # utf8 VARCHAR(256) columns exceed the 767 bytes InnoDB allows
+            # per index column
+            db.execute('CREATE INDEX `%s` ON `statements` (`hostname`(191), `schema`(191))' % (
+                db.create_index_name(u'statements', ['hostname', 'schema']),))
+        else:
+            db.create_index(u'statements', ['hostname', 'schema'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'StatementData', fields ['hostname', 'schema']
+        db.delete_index(u'statements', ['hostname', 'schema'])
+
+        # Removing index on 'StatementData', fields ['dt', 'canonicalized_statement_hostname_hash']
+        db.delete_index(u'statements', ['dt', 'canonicalized_statement_hostname_hash'])
+
+        # Removing index on 'StatementData', fields ['updated_at', 'sequence_id']
+        db.delete_index(u'statements', ['updated_at', 'sequence_id'])
+
+        # Removing index on 'StatementData', fields ['canonicalized_statement_hostname_hash']
+        db.delete_index(u'statements', ['canonicalized_statement_hostname_hash'])
+
+        # Removing unique constraint on 'StatementData', fields ['sequence_id']
+        db.delete_unique(u'statements', ['sequence_id'])
+
+
+    models = {
+        u'sqlcanon.explainedstatement': {
+            'Meta': {'object_name': 'ExplainedStatement', 'db_table': "u'explained_statements'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'db': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'dt': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.explainresult': {
+            'Meta': {'object_name': 'ExplainResult', 'db_table': "u'explain_results'"},
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'explained_statement': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'explain_results'", 'null': 'True', 'db_column': "u'explained_statement_id'", 'to': u"orm['sqlcanon.ExplainedStatement']"}),
+            'extra': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'key_len': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'possible_keys': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'ref': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'rows': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'select_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'select_type': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'table': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'type': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.statementdata': {
+            'Meta': {'object_name': 'StatementData', 'db_table': "u'statements'", 'index_together': "[['updated_at', 'sequence_id'], ['dt', 'canonicalized_statement_hostname_hash'], ['hostname', 'schema']]"},
+            'bytes_sent': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'dt': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lock_time': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_affected': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_read': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'sequence_id': ('django.db.models.fields.IntegerField', [], {'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'tmp_disk_tables': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'tmp_table_sizes': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'tmp_tables': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.statementstats': {
+            'Meta': {'object_name': 'StatementStats', 'db_table': "u'statement_stats'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'dt_end': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'dt_start': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lock_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['sqlcanon']
\ No newline at end of file
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'StatementSummary'
+        db.create_table(u'statement_summaries', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('canonicalized_statement_hash', self.gf('django.db.models.fields.IntegerField')()),
+            ('hostname', self.gf('django.db.models.fields.CharField')(default='', max_length=255, blank=True)),
+            ('schema', self.gf('django.db.models.fields.CharField')(default='', max_length=64, blank=True)),
+            ('canonicalized_statement', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('dt_first', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+            ('dt_last', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+            ('count', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('query_time_sum', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('query_time_min', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('query_time_max', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('lock_time_sum', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('lock_time_min', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('lock_time_max', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('rows_read_sum', self.gf('django.db.models.fields.BigIntegerField')(null=True, blank=True)),
+            ('rows_read_min', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('rows_read_max', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('rows_examined_sum', self.gf('django.db.models.fields.BigIntegerField')(null=True, blank=True)),
+            ('rows_examined_min', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('rows_examined_max', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('rows_sent_sum', self.gf('django.db.models.fields.BigIntegerField')(null=True, blank=True)),
+            ('rows_sent_min', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('rows_sent_max', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('updated_at', self.gf('django.db.models.fields.DateTimeField')(auto_now=True, auto_now_add=True, null=True, blank=True)),
+        ))
+        db.send_create_signal(u'sqlcanon', ['StatementSummary'])
+
+        # Adding unique constraint on 'StatementSummary', fields ['canonicalized_statement_hash', 'hostname', 'schema']
+        db.create_unique(u'statement_summaries', ['canonicalized_statement_hash', 'hostname', 'schema'])
+
+        # Summarizing the statements saved so far
+        if not db.dry_run:
+            self.summarize_statements(orm)
+
+    def summarize_statements(self, orm):
+        keys = ('query_time', 'lock_time', 'rows_read', 'rows_examined', 'rows_sent')
+        aggregates = dict(
+            sample_statement=models.Max('canonicalized_statement'),
+            statement_count=models.Count('id'),
+            first_dt=models.Min('dt'),
+            last_dt=models.Max('dt'))
+        for k in keys:
+            aggregates['%s_sum' % (k,)] = models.Sum(k)
+            aggregates['%s_min' % (k,)] = models.Min(k)
+            aggregates['%s_max' % (k,)] = models.Max(k)
+        rows = (
+            orm.StatementData.objects
+            .exclude(canonicalized_statement_hash=None)
+            .values('canonicalized_statement_hash', 'hostname', 'schema')
+            .annotate(**aggregates))
+
+        def least(a, b):
+            if a is None or b is None:
+                return b if a is None else a
+            return min(a, b)
+
+        def greatest(a, b):
+            if a is None or b is None:
+                return b if a is None else a
+            return max(a, b)
+
+        # blank and NULL hostnames and schemas are summarized together
+        summaries = {}
+        for row in rows:
+            key = (
+                row['canonicalized_statement_hash'],
+                (row['hostname'] or '')[:255],
+                (row['schema'] or '')[:64])
+            summary = summaries.get(key)
+            if summary is None:
+                summary = summaries[key] = orm.StatementSummary(
+                    canonicalized_statement_hash=key[0],
+                    hostname=key[1],
+                    schema=key[2],
+                    canonicalized_statement=row['sample_statement'])
+            summary.count += row['statement_count']
+            summary.dt_first = least(summary.dt_first, row['first_dt'])
+            summary.dt_last = greatest(summary.dt_last, row['last_dt'])
+            for k in keys:
+                k_sum, k_min, k_max = ('%s_sum' % (k,), '%s_min' % (k,), '%s_max' % (k,))
+                if row[k_sum] is not None:
+                    setattr(summary, k_sum, (getattr(summary, k_sum) or 0) + row[k_sum])
+                setattr(summary, k_min, least(getattr(summary, k_min), row[k_min]))
+                setattr(summary, k_max, greatest(getattr(summary, k_max), row[k_max]))
+        orm.StatementSummary.objects.bulk_create(summaries.values())
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'StatementSummary', fields ['canonicalized_statement_hash', 'hostname', 'schema']
+        db.delete_unique(u'statement_summaries', ['canonicalized_statement_hash', 'hostname', 'schema'])
+
+        # Deleting model 'StatementSummary'
+        db.delete_table(u'statement_summaries')
+
+
+    models = {
+        u'sqlcanon.explainedstatement': {
+            'Meta': {'object_name': 'ExplainedStatement', 'db_table': "u'explained_statements'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'db': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'dt': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.explainresult': {
+            'Meta': {'object_name': 'ExplainResult', 'db_table': "u'explain_results'"},
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'explained_statement': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'explain_results'", 'null': 'True', 'db_column': "u'explained_statement_id'", 'to': u"orm['sqlcanon.ExplainedStatement']"}),
+            'extra': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'key_len': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'possible_keys': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'ref': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'rows': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'select_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'select_type': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'table': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'type': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.ringhead': {
+            'Meta': {'object_name': 'RingHead', 'db_table': "u'ring_heads'"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'position': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        },
+        u'sqlcanon.statementdata': {
+            'Meta': {'object_name': 'StatementData', 'db_table': "u'statements'", 'index_together': "[['updated_at', 'sequence_id'], ['dt', 'canonicalized_statement_hostname_hash'], ['hostname', 'schema']]"},
+            'bytes_sent': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'dt': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lock_time': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_affected': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_read': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'sequence_id': ('django.db.models.fields.IntegerField', [], {'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'tmp_disk_tables': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'tmp_table_sizes': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'tmp_tables': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.statementstats': {
+            'Meta': {'object_name': 'StatementStats', 'db_table': "u'statement_stats'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'dt_end': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'dt_start': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lock_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'})
+        },
+        u'sqlcanon.statementsummary': {
+            'Meta': {'unique_together': "[['canonicalized_statement_hash', 'hostname', 'schema']]", 'object_name': 'StatementSummary', 'db_table': "u'statement_summaries'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {}),
+            'count': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'dt_first': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'dt_last': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lock_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_read_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_read_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_read_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['sqlcanon']
\ No newline at end of file
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'StatementBucket'
+        db.create_table(u'statement_buckets', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('dt_minute', self.gf('django.db.models.fields.DateTimeField')()),
+            ('canonicalized_statement_hostname_hash', self.gf('django.db.models.fields.IntegerField')()),
+            ('canonicalized_statement_hash', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('canonicalized_statement', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('server_id', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('statement', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('dt_last', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+            ('count', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('query_time_sum', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('updated_at', self.gf('django.db.models.fields.DateTimeField')(auto_now=True, auto_now_add=True, null=True, blank=True)),
+        ))
+        db.send_create_signal(u'sqlcanon', ['StatementBucket'])
+
+        # Adding unique constraint on 'StatementBucket', fields ['dt_minute', 'canonicalized_statement_hostname_hash']
+        db.create_unique(u'statement_buckets', ['dt_minute', 'canonicalized_statement_hostname_hash'])
+
+        # Bucketing the statements saved so far
+        if not db.dry_run:
+            self.bucket_statements(orm)
+
+    def bucket_statements(self, orm):
+        rows = (
+            orm.StatementData.objects
+            .exclude(dt=None)
+            .exclude(canonicalized_statement_hostname_hash=None)
+            .order_by('dt')
+            .values(
+                'dt', 'canonicalized_statement_hostname_hash',
+                'canonicalized_statement_hash', 'canonicalized_statement',
+                'server_id', 'statement', 'query_time'))
+
+        # rows are read in order, the last one of a bucket is its sample
+        buckets = {}
+        for row in rows:
+            key = (
+                row['dt'].replace(second=0, microsecond=0),
+                row['canonicalized_statement_hostname_hash'])
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = orm.StatementBucket(
+                    dt_minute=key[0],
+                    canonicalized_statement_hostname_hash=key[1])
+            bucket.canonicalized_statement_hash = row['canonicalized_statement_hash']
+            bucket.canonicalized_statement = row['canonicalized_statement']
+            bucket.server_id = row['server_id']
+            bucket.statement = row['statement']
+            bucket.dt_last = row['dt']
+            bucket.count += 1
+            if row['query_time'] is not None:
+                bucket.query_time_sum = (bucket.query_time_sum or 0) + row['query_time']
+        orm.StatementBucket.objects.bulk_create(buckets.values())
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'StatementBucket', fields ['dt_minute', 'canonicalized_statement_hostname_hash']
+        db.delete_unique(u'statement_buckets', ['dt_minute', 'canonicalized_statement_hostname_hash'])
+
+        # Deleting model 'StatementBucket'
+        db.delete_table(u'statement_buckets')
+
+
+    models = {
+        u'sqlcanon.explainedstatement': {
+            'Meta': {'object_name': 'ExplainedStatement', 'db_table': "u'explained_statements'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'db': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'dt': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.explainresult': {
+            'Meta': {'object_name': 'ExplainResult', 'db_table': "u'explain_results'"},
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'explained_statement': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'explain_results'", 'null': 'True', 'db_column': "u'explained_statement_id'", 'to': u"orm['sqlcanon.ExplainedStatement']"}),
+            'extra': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'key_len': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'possible_keys': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'ref': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'rows': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'select_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'select_type': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'table': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'type': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.ringhead': {
+            'Meta': {'object_name': 'RingHead', 'db_table': "u'ring_heads'"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'position': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        },
+        u'sqlcanon.statementbucket': {
+            'Meta': {'unique_together': "[['dt_minute', 'canonicalized_statement_hostname_hash']]", 'object_name': 'StatementBucket', 'db_table': "u'statement_buckets'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {}),
+            'count': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'dt_last': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'dt_minute': ('django.db.models.fields.DateTimeField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'query_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.statementdata': {
+            'Meta': {'object_name': 'StatementData', 'db_table': "u'statements'", 'index_together': "[['updated_at', 'sequence_id'], ['dt', 'canonicalized_statement_hostname_hash'], ['hostname', 'schema']]"},
+            'bytes_sent': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'dt': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lock_time': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_affected': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_read': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'sequence_id': ('django.db.models.fields.IntegerField', [], {'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'tmp_disk_tables': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'tmp_table_sizes': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'tmp_tables': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        },
+        u'sqlcanon.statementstats': {
+            'Meta': {'object_name': 'StatementStats', 'db_table': "u'statement_stats'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'canonicalized_statement_hostname_hash': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'dt_end': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'dt_start': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lock_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'server_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'statement': ('django.db.models.fields.TextField', [], {'blank': 'True'})
+        },
+        u'sqlcanon.statementsummary': {
+            'Meta': {'unique_together': "[['canonicalized_statement_hash', 'hostname', 'schema']]", 'object_name': 'StatementSummary', 'db_table': "u'statement_summaries'"},
+            'canonicalized_statement': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'canonicalized_statement_hash': ('django.db.models.fields.IntegerField', [], {}),
+            'count': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'dt_first': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'dt_last': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hostname': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lock_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'lock_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_max': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_min': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'query_time_sum': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_examined_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_read_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_read_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_read_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rows_sent_sum': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['sqlcanon']
\ No newline at end of file
@@ -59,7 +59,7 @@ class StatementData(models.Model):
     canonicalized_statement_hash = models.IntegerField(
         null=True, blank=True)
     canonicalized_statement_hostname_hash = models.IntegerField(
-        null=True, blank=True)
+        null=True, blank=True, db_index=True)
 
     query_time = models.FloatField(null=True, blank=True)
     lock_time = models.FloatField(null=True, blank=True)
@@ -72,7 +72,7 @@ class StatementData(models.Model):
     tmp_disk_tables = models.IntegerField(null=True, blank=True)
     tmp_table_sizes = models.IntegerField(null=True, blank=True)
 
-    sequence_id = models.IntegerField(null=True, blank=True)
+    sequence_id = models.IntegerField(null=True, blank=True, unique=True)
 
     created_at = models.DateTimeField(
         null=True, blank=True, auto_now_add=True)
@@ -81,6 +81,14 @@ class StatementData(models.Model):
 
     class Meta:
         db_table = u'statements'
+        index_together = [
+            # the last row used, before RingHead
+            ['updated_at', 'sequence_id'],
+            # last statements
+            ['dt', 'canonicalized_statement_hostname_hash'],
+            # top queries filters and choices
+            ['hostname', 'schema'],
+        ]
 
     def __unicode__(self):
         return u'<StatementData %s>' % (
@@ -98,6 +106,281 @@ class StatementData(models.Model):
             self.canonicalized_statement_hostname_hash)
 
 
+class RingHead(models.Model):
+    """Position of the next row to be used in round-robin storage.
+
+    Attributes:
+
+        name: Name of the round-robin storage, the name of its table.
+
+        position: Number of rows used so far, the next row to be used is
+            the one whose sequence_id is position modulo the number of
+            rows of the storage.
+    """
+
+    name = models.CharField(max_length=64, unique=True)
+    position = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = u'ring_heads'
+
+    def __unicode__(self):
+        return u'<RingHead %s>' % (
+            utils.generate_model_instance_unicode_string(self),)
+
+
+class StatementStats(models.Model):
+    """Statistics of the statements of a shape read by sqlcanonclient during
+    an interval, sent instead of the statements in aggregation mode.
+
+    Attributes:
+
+        dt_start: Date and time the first statement was read.
+
+        dt_end: Date and time the last statement was read.
+
+        statement: The first statement, used as a sample.
+
+        server_id: Server ID.
+
+        hostname: Hostname.
+
+        schema: Schema name.
+
+        canonicalized_statement: Canonical form of the statements.
+
+        canonicalized_statement_hash: Hash of the canonical form of
+            the statements.
+
+        canonicalized_statement_hostname_hash: Hash of
+            canonicalized statement-hostname.
+
+        count: Number of statements.
+
+        query_time_sum, query_time_min, query_time_max: Sum, minimum and
+            maximum of the recorded query times, None if none was
+            recorded. Likewise for lock_time, rows_examined and rows_sent.
+
+        created_at: Date and time this object was created.
+    """
+
+    dt_start = models.DateTimeField(null=True, blank=True, db_index=True)
+    dt_end = models.DateTimeField(null=True, blank=True)
+    statement = models.TextField(blank=True)
+    server_id = models.IntegerField(null=True, blank=True)
+    hostname = models.CharField(max_length=256, blank=True, null=True)
+    schema = models.CharField(max_length=256, blank=True, null=True)
+    canonicalized_statement = models.TextField(blank=True)
+    canonicalized_statement_hash = models.IntegerField(
+        null=True, blank=True)
+    canonicalized_statement_hostname_hash = models.IntegerField(
+        null=True, blank=True, db_index=True)
+
+    count = models.IntegerField(default=0)
+    query_time_sum = models.FloatField(null=True, blank=True)
+    query_time_min = models.FloatField(null=True, blank=True)
+    query_time_max = models.FloatField(null=True, blank=True)
+    lock_time_sum = models.FloatField(null=True, blank=True)
+    lock_time_min = models.FloatField(null=True, blank=True)
+    lock_time_max = models.FloatField(null=True, blank=True)
+    rows_examined_sum = models.BigIntegerField(null=True, blank=True)
+    rows_examined_min = models.IntegerField(null=True, blank=True)
+    rows_examined_max = models.IntegerField(null=True, blank=True)
+    rows_sent_sum = models.BigIntegerField(null=True, blank=True)
+    rows_sent_min = models.IntegerField(null=True, blank=True)
+    rows_sent_max = models.IntegerField(null=True, blank=True)
+
+    created_at = models.DateTimeField(
+        null=True, blank=True, auto_now_add=True)
+
+    class Meta:
+        db_table = u'statement_stats'
+
+    def __unicode__(self):
+        return u'<StatementStats %s>' % (
+            utils.generate_model_instance_unicode_string(self),)
+
+    def canonicalized_statement_hash_hex_str(self):
+        """Returns canonicalized statement hash as hex string."""
+
+        return utils.int_to_hex_str(self.canonicalized_statement_hash)
+
+    def canonicalized_statement_hostname_hash_hex_str(self):
+        """Returns canonicalized statement-hostname hash as hex string."""
+
+        return utils.int_to_hex_str(
+            self.canonicalized_statement_hostname_hash)
+
+
+class StatementSummary(models.Model):
+    """Totals of the statements of a shape, hostname and schema saved so far,
+    updated as statement data and statement stats are saved.
+
+    Attributes:
+
+        canonicalized_statement_hash: Hash of the canonical form of
+            the statements.
+
+        hostname: Hostname, blank if the statements had none.
+
+        schema: Schema name, blank if the statements had none.
+
+        canonicalized_statement: Canonical form of the statements.
+
+        dt_first: Date and time of the first statement.
+
+        dt_last: Date and time of the last statement.
+
+        count: Number of statements.
+
+        query_time_sum, query_time_min, query_time_max: Sum, minimum and
+            maximum of the recorded query times, None if none was
+            recorded. Likewise for lock_time, rows_read, rows_examined and
+            rows_sent.
+
+        updated_at: Date and time this object was last updated.
+    """
+
+    canonicalized_statement_hash = models.IntegerField()
+    # short enough for a unique key on MySQL with utf8
+    hostname = models.CharField(max_length=255, blank=True, default='')
+    schema = models.CharField(max_length=64, blank=True, default='')
+    canonicalized_statement = models.TextField(blank=True)
+    dt_first = models.DateTimeField(null=True, blank=True)
+    dt_last = models.DateTimeField(null=True, blank=True)
+
+    count = models.BigIntegerField(default=0)
+    query_time_sum = models.FloatField(null=True, blank=True)
+    query_time_min = models.FloatField(null=True, blank=True)
+    query_time_max = models.FloatField(null=True, blank=True)
+    lock_time_sum = models.FloatField(null=True, blank=True)
+    lock_time_min = models.FloatField(null=True, blank=True)
+    lock_time_max = models.FloatField(null=True, blank=True)
+    rows_read_sum = models.BigIntegerField(null=True, blank=True)
+    rows_read_min = models.IntegerField(null=True, blank=True)
+    rows_read_max = models.IntegerField(null=True, blank=True)
+    rows_examined_sum = models.BigIntegerField(null=True, blank=True)
+    rows_examined_min = models.IntegerField(null=True, blank=True)
+    rows_examined_max = models.IntegerField(null=True, blank=True)
+    rows_sent_sum = models.BigIntegerField(null=True, blank=True)
+    rows_sent_min = models.IntegerField(null=True, blank=True)
+    rows_sent_max = models.IntegerField(null=True, blank=True)
+
+    updated_at = models.DateTimeField(
+        null=True, blank=True, auto_now_add=True, auto_now=True)
+
+    class Meta:
+        db_table = u'statement_summaries'
+        unique_together = [
+            ['canonicalized_statement_hash', 'hostname', 'schema'],
+        ]
+
+    def __unicode__(self):
+        return u'<StatementSummary %s>' % (
+            utils.generate_model_instance_unicode_string(self),)
+
+    def canonicalized_statement_hash_hex_str(self):
+        """Returns canonicalized statement hash as hex string."""
+
+        return utils.int_to_hex_str(self.canonicalized_statement_hash)
+
+
+class StatementBucket(models.Model):
+    """Totals of the statements of a shape and hostname saved during a
+    minute, updated as statement data and statement stats are saved.
+
+    Attributes:
+
+        dt_minute: Start of the minute, statements are counted in the
+            minute of their dt, the statements of statement stats in the
+            minute of the dt of their sample statement.
+
+        canonicalized_statement_hostname_hash: Hash of
+            canonicalized statement-hostname.
+
+        canonicalized_statement_hash: Hash of the canonical form of
+            the statements.
+
+        canonicalized_statement: Canonical form of the statements.
+
+        server_id: Server ID.
+
+        statement: The last statement, used as a sample.
+
+        dt_last: Date and time of the last statement.
+
+        count: Number of statements.
+
+        query_time_sum: Sum of the recorded query times, None if none was
+            recorded.
+
+        updated_at: Date and time this object was last updated.
+    """
+
+    dt_minute = models.DateTimeField()
+    canonicalized_statement_hostname_hash = models.IntegerField()
+    canonicalized_statement_hash = models.IntegerField(
+        null=True, blank=True)
+    canonicalized_statement = models.TextField(blank=True)
+    server_id = models.IntegerField(null=True, blank=True)
+    statement = models.TextField(blank=True)
+    dt_last = models.DateTimeField(null=True, blank=True)
+
+    count = models.BigIntegerField(default=0)
+    query_time_sum = models.FloatField(null=True, blank=True)
+
+    updated_at = models.DateTimeField(
+        null=True, blank=True, auto_now_add=True, auto_now=True)
+
+    class Meta:
+        db_table = u'statement_buckets'
+        unique_together = [
+            ['dt_minute', 'canonicalized_statement_hostname_hash'],
+        ]
+
+    def __unicode__(self):
+        return u'<StatementBucket %s>' % (
+            utils.generate_model_instance_unicode_string(self),)
+
+    def canonicalized_statement_hash_hex_str(self):
+        """Returns canonicalized statement hash as hex string."""
+
+        return utils.int_to_hex_str(self.canonicalized_statement_hash)
+
+    def canonicalized_statement_hostname_hash_hex_str(self):
+        """Returns canonicalized statement-hostname hash as hex string."""
+
+        return utils.int_to_hex_str(
+            self.canonicalized_statement_hostname_hash)
+
+
+class ProcessedRequest(models.Model):
+    """A request of sqlcanonclient processed already, identified by its
+    Idempotency-Key header.
+
+    Attributes:
+
+        key: Idempotency key of the request.
+
+        response: Content of the response to the request.
+
+        created_at: Date and time this object was created.
+    """
+
+    key = models.CharField(max_length=64, unique=True)
+    response = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(
+        null=True, blank=True, auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = u'processed_requests'
+
+    def __unicode__(self):
+        return u'<ProcessedRequest %s>' % (
+            utils.generate_model_instance_unicode_string(self),)
+
+
 class ExplainedStatement(models.Model):
     """Info about statement where EXPLAIN operation has been performed.
 
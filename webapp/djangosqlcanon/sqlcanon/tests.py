@@ -1 +1,469 @@
-from django.test import TestCase
+"""Sqlcanon tests.
+
+The tests use the MySQL test database. Saving statement data advances ring
+heads on a second connection, tests are TransactionTestCases so that what
+they save is committed as it is in production.
+"""
+
+import datetime
+import json
+import threading
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connections, transaction
+from django.db.models import Sum
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from sqlcanon import models
+from sqlcanon.logic import core
+
+
+def get_statement_data(i, **kwargs):
+    """Returns the statement data sqlcanonclient posts for statement i."""
+
+    data = dict(
+        statement='SELECT * FROM t WHERE id = %d' % (i,),
+        hostname='localhost',
+        canonicalized_statement='SELECT * FROM t WHERE id = %s',
+        canonicalized_statement_hash=1,
+        canonicalized_statement_hostname_hash=2,
+        query_time=0.5,
+        lock_time=0.1,
+        rows_read=10,
+        server_id=1,
+        schema='db')
+    data.update(kwargs)
+    return data
+
+
+class CoreTestCase(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        core.pruned_at.clear()
+        # flushed after every test, migration 0004 adds it
+        models.RingHead.objects.get_or_create(name='statements')
+
+    def save(self, data_list):
+        dt = timezone.now()
+        statement_data_list = []
+        for data in data_list:
+            data = dict(data)
+            data['dt'] = dt
+            statement_data_list.append(data)
+        return core.save_statement_data_list(statement_data_list)
+
+
+class RingHeadTest(CoreTestCase):
+    """Tests the allocation of statement data rows."""
+
+    def test_allocate_sequence_ids(self):
+        position = models.RingHead.objects.get(name='statements').position
+        self.assertEqual(
+            core.allocate_sequence_ids(3),
+            [position, position + 1, position + 2])
+        self.assertEqual(
+            core.allocate_sequence_ids(), [position + 3])
+        self.assertEqual(
+            models.RingHead.objects.get(name='statements').position,
+            position + 4)
+
+    @override_settings(CAPTURED_STATEMENT_ROW_LIMIT=3)
+    def test_round_robin(self):
+        models.RingHead.objects.filter(name='statements').update(position=0)
+        self.save([get_statement_data(i) for i in xrange(5)])
+        self.assertEqual(
+            list(
+                models.StatementData.objects.order_by('sequence_id')
+                .values_list('sequence_id', 'statement')),
+            [(0, 'SELECT * FROM t WHERE id = 3'),
+                (1, 'SELECT * FROM t WHERE id = 4'),
+                (2, 'SELECT * FROM t WHERE id = 2')])
+
+    def test_missing_ring_head(self):
+        # databases created without the migrations
+        models.RingHead.objects.all().delete()
+        self.assertEqual(core.allocate_sequence_ids(2), [0, 1])
+
+
+class StatementSummaryTest(CoreTestCase):
+    """Tests statement summaries and top queries."""
+
+    def test_summaries(self):
+        explain = self.save([
+            get_statement_data(1),
+            get_statement_data(2, query_time=1.5, rows_read=20),
+            get_statement_data(
+                3, canonicalized_statement='INSERT INTO t VALUES (%s)',
+                canonicalized_statement_hash=3,
+                canonicalized_statement_hostname_hash=4)])
+        # the first statement of a SELECT shape is EXPLAINed
+        self.assertEqual([e['index'] for e in explain], [0])
+
+        summary = models.StatementSummary.objects.get(
+            canonicalized_statement_hash=1)
+        self.assertEqual(summary.count, 2)
+        self.assertEqual(summary.query_time_sum, 2.0)
+        self.assertEqual(summary.query_time_min, 0.5)
+        self.assertEqual(summary.query_time_max, 1.5)
+        self.assertEqual(summary.rows_read_sum, 30)
+
+        rows = core.get_top_queries(1, 'count', {})
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['canonicalized_statement_hash'], 1)
+        self.assertEqual(rows[0]['count'], 2)
+        self.assertEqual(rows[0]['avg_query_time'], 1.0)
+        self.assertEqual(rows[0]['avg_rows_read'], 15.0)
+
+        rows = core.get_top_queries(
+            10, 'total_query_time', dict(hostname='localhost', schema='db'))
+        self.assertEqual(
+            [(row['hostname'], row['schema'], row['total_query_time'])
+                for row in rows],
+            [('localhost', 'db', 2.0), ('localhost', 'db', 0.5)])
+
+    def test_merge_requests(self):
+        # added to by the database
+        self.save([get_statement_data(1, query_time=None)])
+        self.save([get_statement_data(2, query_time=1.5, rows_read=20)])
+        summary = models.StatementSummary.objects.get()
+        self.assertEqual(
+            (summary.count, summary.query_time_sum, summary.query_time_min,
+                summary.query_time_max, summary.rows_read_sum,
+                summary.rows_read_min, summary.rows_read_max),
+            (2, 1.5, 1.5, 1.5, 30, 10, 20))
+        self.assertTrue(summary.dt_first <= summary.dt_last)
+
+    def test_unknown_column(self):
+        self.assertRaises(
+            ValueError, core.get_top_queries, 10, 'statement', {})
+
+
+class StatementBucketTest(CoreTestCase):
+    """Tests statement buckets and last statements."""
+
+    def test_last_statements(self):
+        self.save([
+            get_statement_data(1),
+            get_statement_data(2, query_time=1.5),
+            get_statement_data(
+                3, canonicalized_statement_hostname_hash=4)])
+        # a bucket of an earlier window
+        models.StatementBucket.objects.create(
+            dt_minute=core.get_minute(timezone.now()) -
+                datetime.timedelta(minutes=10),
+            canonicalized_statement_hostname_hash=2,
+            canonicalized_statement_hash=1,
+            statement='SELECT * FROM t WHERE id = 0',
+            dt_last=timezone.now() - datetime.timedelta(minutes=10),
+            count=5,
+            query_time_sum=5.0)
+
+        objects = core.get_last_statements(2)
+        counts = dict(
+            (obj['statement_data']['canonicalized_statement_hostname_hash'],
+                obj['count'])
+            for obj in objects)
+        self.assertEqual(counts, {2: 2, 4: 1})
+        statement_data = [
+            obj['statement_data'] for obj in objects
+            if obj['statement_data'][
+                'canonicalized_statement_hostname_hash'] == 2][0]
+        self.assertEqual(statement_data['query_time_sum'], 2.0)
+        # the last statement is the sample
+        self.assertEqual(
+            statement_data['statement'], 'SELECT * FROM t WHERE id = 2')
+
+        counts = dict(
+            (obj['statement_data']['canonicalized_statement_hostname_hash'],
+                obj['count'])
+            for obj in core.get_last_statements(11))
+        self.assertEqual(counts, {2: 7, 4: 1})
+
+    def test_merge_requests(self):
+        # added to by the database
+        self.save([get_statement_data(1, query_time=None)])
+        self.save([get_statement_data(2, query_time=1.5)])
+        bucket = models.StatementBucket.objects.get()
+        self.assertEqual(
+            (bucket.count, bucket.query_time_sum, bucket.statement),
+            (2, 1.5, 'SELECT * FROM t WHERE id = 2'))
+
+    def test_concurrent_requests(self):
+        # requests adding to the same buckets in opposite orders, on
+        # connections of their own
+        errors = []
+
+        def save_requests(hashes):
+            try:
+                for _ in xrange(5):
+                    with transaction.commit_on_success():
+                        self.save([
+                            get_statement_data(
+                                i, canonicalized_statement_hostname_hash=h)
+                            for i, h in enumerate(hashes)])
+            except Exception, e:
+                errors.append(e)
+            finally:
+                for conn in connections.all():
+                    conn.close()
+
+        hashes = range(1, 11)
+        threads = [
+            threading.Thread(target=save_requests, args=(hashes,)),
+            threading.Thread(target=save_requests, args=(hashes[::-1],))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            dict(
+                models.StatementBucket.objects
+                .values_list('canonicalized_statement_hostname_hash')
+                .annotate(Sum('count'))),
+            dict((h, 10) for h in hashes))
+        self.assertEqual(models.StatementSummary.objects.get().count, 100)
+
+    @override_settings(STATEMENT_BUCKET_RETENTION=60)
+    def test_prune(self):
+        dt_minute = core.get_minute(timezone.now())
+        for minutes in (0, 59, 60, 120):
+            models.StatementBucket.objects.create(
+                dt_minute=dt_minute - datetime.timedelta(minutes=minutes),
+                canonicalized_statement_hostname_hash=2)
+        core.prune_statement_buckets()
+        self.assertEqual(models.StatementBucket.objects.count(), 2)
+
+    def test_cached_last_statements(self):
+        self.save([get_statement_data(1)])
+        objects = core.get_cached_last_statements(5)
+        self.save([get_statement_data(2)])
+        # the snapshot is served until it expires
+        self.assertEqual(core.get_cached_last_statements(5), objects)
+        self.assertEqual(objects[0]['count'], 1)
+
+        cache.set(
+            'sqlcanon.last_statements.5',
+            dict(expires_at=0, objects=objects))
+        self.assertEqual(core.get_cached_last_statements(5)[0]['count'], 2)
+
+    def test_cached_last_statements_lock(self):
+        lock_key = 'sqlcanon.last_statements.1.lock'
+        get_last_statements = core.get_last_statements
+
+        def take_lock(last_minutes):
+            # the lock expired and was taken by another request
+            cache.set(lock_key, 'other')
+            return get_last_statements(last_minutes)
+
+        core.get_last_statements = take_lock
+        try:
+            # windows are clamped
+            core.get_cached_last_statements(0)
+        finally:
+            core.get_last_statements = get_last_statements
+        self.assertEqual(cache.get(lock_key), 'other')
+
+
+class SaveViewsTest(CoreTestCase):
+    """Tests the views sqlcanonclient posts to."""
+
+    def post(self, name, data, status=200, **extra):
+        response = self.client.post(
+            reverse(name), json.dumps(data),
+            content_type='application/json', **extra)
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.content)
+
+    def test_save_statement_data(self):
+        response = self.post(
+            'sqlcanon_save_statement_data', get_statement_data(1))
+        self.assertEqual(len(response['explain']), 1)
+        response = self.post(
+            'sqlcanon_save_statement_data', get_statement_data(2))
+        self.assertEqual(response['explain'], [])
+        self.assertEqual(models.StatementData.objects.count(), 2)
+
+    def test_save_statement_data_bulk(self):
+        response = self.post(
+            'sqlcanon_save_statement_data_bulk',
+            [get_statement_data(i) for i in xrange(3)])
+        self.assertEqual([e['index'] for e in response['explain']], [0])
+        self.assertEqual(models.StatementData.objects.count(), 3)
+        self.assertEqual(
+            models.StatementSummary.objects.get().count, 3)
+
+    def test_save_statement_stats(self):
+        # aggregation mode
+        stats = get_statement_data(
+            1, count=10, dt_start=0, dt_end=60,
+            query_time_sum=5.0, query_time_min=0.1, query_time_max=1.0)
+        response = self.post('sqlcanon_save_statement_stats', [stats])
+        self.assertEqual([e['index'] for e in response['explain']], [0])
+        statement_stats = models.StatementStats.objects.get()
+        self.assertEqual(statement_stats.count, 10)
+        self.assertEqual(statement_stats.query_time_sum, 5.0)
+        # the sample is saved as statement data, summaries and buckets
+        # count the statements of the stats
+        self.assertEqual(models.StatementData.objects.count(), 1)
+        self.assertEqual(models.StatementSummary.objects.get().count, 10)
+        self.assertEqual(models.StatementBucket.objects.get().count, 10)
+
+    def test_save_explained_statement(self):
+        self.post('sqlcanon_save_statement_data', get_statement_data(1))
+        statement_data = models.StatementData.objects.get()
+        self.post(
+            'sqlcanon_save_explained_statement',
+            dict(
+                statement_data_id=statement_data.id,
+                explain_rows=[dict(select_id=1, table='t', rows=1)],
+                db='db'))
+        explained_statement = models.ExplainedStatement.objects.get()
+        self.assertEqual(
+            explained_statement.statement, statement_data.statement)
+        self.assertEqual(explained_statement.explain_results.count(), 1)
+
+    def test_rollback(self):
+        self.post('sqlcanon_save_statement_data', get_statement_data(1))
+        statement_data = models.StatementData.objects.get()
+        # the explained statement is saved before the invalid row fails
+        response = self.post(
+            'sqlcanon_save_explained_statement',
+            dict(
+                statement_data_id=statement_data.id,
+                explain_rows=[dict(select_id=1), dict(unknown=1)]))
+        self.assertTrue(response['error'])
+        self.assertEqual(models.ExplainedStatement.objects.count(), 0)
+        self.assertEqual(models.ExplainResult.objects.count(), 0)
+
+    def test_rollback_batch(self):
+        # batches are sent again by sqlcanonclient, once answered with 503
+        for name in (
+                'sqlcanon_save_statement_data_bulk',
+                'sqlcanon_save_statement_stats'):
+            response = self.post(
+                name, [get_statement_data(1), dict(statement='SELECT 2')],
+                status=503, HTTP_IDEMPOTENCY_KEY=name)
+            self.assertTrue(response['error'])
+        self.assertEqual(models.StatementData.objects.count(), 0)
+        self.assertEqual(models.ProcessedRequest.objects.count(), 0)
+
+    def test_idempotency(self):
+        data_list = [get_statement_data(i) for i in xrange(3)]
+        response = self.post(
+            'sqlcanon_save_statement_data_bulk', data_list,
+            HTTP_IDEMPOTENCY_KEY='k')
+        # sent again
+        self.assertEqual(
+            self.post(
+                'sqlcanon_save_statement_data_bulk', data_list,
+                HTTP_IDEMPOTENCY_KEY='k'),
+            response)
+        self.assertEqual(models.StatementData.objects.count(), 3)
+        self.assertEqual(models.StatementSummary.objects.get().count, 3)
+
+        self.post(
+            'sqlcanon_save_statement_data_bulk', data_list,
+            HTTP_IDEMPOTENCY_KEY='l')
+        self.assertEqual(models.StatementData.objects.count(), 6)
+
+    def test_idempotency_rollback(self):
+        data = dict(
+            statement_data_id=0, explain_rows=[dict(select_id=1)])
+        response = self.post(
+            'sqlcanon_save_explained_statement', data,
+            HTTP_IDEMPOTENCY_KEY='k')
+        self.assertTrue(response['error'])
+        # failed requests are processed again
+        self.assertEqual(models.ProcessedRequest.objects.count(), 0)
+
+    @override_settings(PROCESSED_REQUEST_RETENTION=60)
+    def test_prune_processed_requests(self):
+        models.ProcessedRequest.objects.create(key='k')
+        models.ProcessedRequest.objects.filter(key='k').update(
+            created_at=timezone.now() - datetime.timedelta(minutes=61))
+        self.assertTrue(core.claim_request('l'))
+        self.assertEqual(
+            list(models.ProcessedRequest.objects.values_list(
+                'key', flat=True)),
+            ['l'])
+
+
+class MigrationTest(TransactionTestCase):
+    """Tests the data migrations of the statements saved by earlier
+    versions."""
+
+    def tearDown(self):
+        call_command('migrate', 'sqlcanon', verbosity=0)
+
+    def migrate(self, migration):
+        """
+        Saves statements the way 0002 did, with a sequence id saved twice,
+        then migrates to migration.
+        """
+
+        call_command('migrate', 'sqlcanon', '0002', verbosity=0)
+        dt = timezone.now()
+        rows = [
+            (0, 'SELECT 1', 1, 0.5, dt - datetime.timedelta(minutes=3)),
+            (0, 'SELECT 2', 1, 1.5, dt - datetime.timedelta(minutes=2)),
+            (1, 'SELECT 3', 2, 1.0, dt - datetime.timedelta(minutes=1)),
+            (2, 'SELECT 4', 1, None, dt - datetime.timedelta(minutes=4))]
+        for sequence_id, statement, statement_hash, query_time, updated_at in (
+                rows):
+            statement_data = models.StatementData.objects.create(
+                sequence_id=sequence_id,
+                statement=statement,
+                hostname='localhost',
+                schema='db',
+                canonicalized_statement='SELECT N',
+                canonicalized_statement_hash=statement_hash,
+                canonicalized_statement_hostname_hash=statement_hash,
+                query_time=query_time,
+                dt=updated_at)
+            models.StatementData.objects.filter(
+                pk=statement_data.pk).update(updated_at=updated_at)
+        call_command('migrate', 'sqlcanon', migration, verbosity=0)
+
+    def test_0003_sequence_ids(self):
+        # the row of a sequence id updated last is kept
+        self.migrate('0003')
+        self.assertEqual(
+            list(
+                models.StatementData.objects.order_by('sequence_id')
+                .values_list('statement', flat=True)),
+            ['SELECT 2', 'SELECT 3', 'SELECT 4'])
+
+    def test_0004_ring_head(self):
+        # the ring head starts after the row updated last
+        self.migrate('0004')
+        self.assertEqual(
+            models.RingHead.objects.get(name='statements').position, 2)
+
+    def test_0005_statement_summaries(self):
+        # the statements saved so far are summarized
+        self.migrate('0005')
+        self.assertEqual(
+            dict(
+                models.StatementSummary.objects.values_list(
+                    'canonicalized_statement_hash', 'count')),
+            {1: 2, 2: 1})
+        summary = models.StatementSummary.objects.get(
+            canonicalized_statement_hash=1)
+        self.assertEqual(summary.query_time_sum, 1.5)
+        self.assertEqual((summary.hostname, summary.schema), ('localhost', 'db'))
+
+    def test_0006_statement_buckets(self):
+        # the statements saved so far are bucketed
+        self.migrate('0006')
+        self.assertEqual(
+            sorted(
+                models.StatementBucket.objects.values_list(
+                    'canonicalized_statement_hostname_hash', 'count')),
+            [(1, 1), (1, 1), (2, 1)])
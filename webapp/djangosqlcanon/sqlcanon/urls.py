@@ -6,6 +6,16 @@ urlpatterns = patterns('sqlcanon.views',
         'save_statement_data',
         name='sqlcanon_save_statement_data'),
 
+    url(
+        r'^save-statement-data-bulk/',
+        'save_statement_data_bulk',
+        name='sqlcanon_save_statement_data_bulk'),
+
+    url(
+        r'^save-statement-stats/',
+        'save_statement_stats',
+        name='sqlcanon_save_statement_stats'),
+
     url(
         r'^save-explained-statement/',
         'save_explained_statement',
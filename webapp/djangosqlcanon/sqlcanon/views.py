@@ -4,14 +4,17 @@ from __future__ import unicode_literals
 
 import datetime
 import decimal
+import functools
 import json
 import logging
 import pprint
 import urllib
+import zlib
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.db.models import Avg, Count, Max, Sum
+from django.db import transaction
+from django.db.models import Avg, Count, Sum
 from django.http import HttpResponse
 from django.shortcuts import redirect, render_to_response
 from django.template import RequestContext
@@ -28,6 +31,74 @@ from sqlcanon.logic import core
 log = logging.getLogger(__name__)
 
 
+def load_post_data(request):
+    """Returns the data posted by sqlcanonclient, None if it is not JSON.
+
+    sqlcanonclient posts a JSON body, gzip compressed if its
+    Content-Encoding is gzip. Earlier versions post a form whose data field
+    is JSON.
+    """
+
+    try:
+        if request.META.get('CONTENT_TYPE', '').startswith(
+                'application/json'):
+            post_data = request.body
+            if request.META.get('HTTP_CONTENT_ENCODING') == 'gzip':
+                post_data = zlib.decompress(post_data, 16 + zlib.MAX_WBITS)
+        else:
+            post_data = request.POST['data']
+    except (KeyError, zlib.error), e:
+        log.error('Could not read posted data: %s' % (e,))
+        return None
+    try:
+        return json.loads(post_data)
+    except:
+        log.error(
+            ('Could not successfully convert the following data '
+            'to JSON object: %s') % (post_data,))
+        return None
+
+
+def rollback():
+    """Rolls back what a view saved before failing.
+
+    Views saving data answer errors with an error message, which
+    TransactionMiddleware would commit along with the part of the request
+    saved so far. The views saving batches answer them with HTTP 503 so that
+    sqlcanonclient sends the batch again, the others with HTTP 200.
+    """
+
+    if transaction.is_managed():
+        transaction.rollback()
+
+
+def idempotent(view):
+    """Decorates a view saving data posted by sqlcanonclient so that a
+    request sent again with the same Idempotency-Key header is not saved
+    again, and gets the response of the first request.
+
+    sqlcanonclient sends a request again when it could not tell whether the
+    server processed it, and when it replays spooled requests.
+    """
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if request.method != 'POST' or not key:
+            return view(request, *args, **kwargs)
+        if not core.claim_request(key):
+            log.info('Request %s was processed already.' % (key,))
+            return HttpResponse(
+                core.get_request_response(key) or json.dumps({}),
+                mimetype='application/json')
+        response = view(request, *args, **kwargs)
+        # a no-op if the view rolled back, the request is processed again
+        # when it is sent again, as it is once answered with HTTP 503
+        core.save_request_response(key, response.content)
+        return response
+    return wrapper
+
+
 def explain_results(
         request, id, template='sqlcanon/explain_results.html'):
     """Shows explain results page."""
@@ -49,13 +120,16 @@ def explained_statements(
 
 
 @csrf_exempt
+@idempotent
 def save_explained_statement(request):
     """Saves explain data."""
 
-    def post_vars(post):
-        data = json.loads(post['data'])
+    def post_vars(data):
         statement_data_id = int(data['statement_data_id'])
-        explain_rows = json.loads(data['explain_rows'])
+        explain_rows = data['explain_rows']
+        if isinstance(explain_rows, basestring):
+            # JSON in JSON, from earlier sqlcanonclient versions
+            explain_rows = json.loads(explain_rows)
         db = data.get('db')
         server_id = data.get('server_id')
         if server_id:
@@ -69,97 +143,127 @@ def save_explained_statement(request):
     rv = {}
     try:
         if request.method == 'POST':
-            log.debug(
-                'request.POST:\n%s' % (pprint.pformat(request.POST),))
-            post_vars_packed = post_vars(request.POST)
+            data = load_post_data(request)
+            log.debug('data:\n%s' % (pprint.pformat(data),))
+            post_vars_packed = post_vars(data)
             explained_statement = core.save_explained_statement(
                 **post_vars_packed)
         ret = json.dumps(rv)
     except Exception, e:
         log.exception('%s' % (e,))
+        rollback()
         ret = json.dumps(dict(error='%s' % (e,)))
     return HttpResponse(ret, mimetype='application/json')
 
 
-@csrf_exempt
-def save_statement_data(request):
-    """Saves statement data."""
+def get_statement_data_vars(data):
+    """Returns core.save_statement_data() keyword arguments of data, a
+    statement data dict posted by sqlcanonclient."""
 
-    def get_post_vars(post):
-        post_data = post['data']
-        try:
-            data = json.loads(post_data)
-        except:
-            log.error(
-                ('Could not successfully convert the following data '
-                'to JSON object: %s') % (post_data,))
-            return None
+    v = {}
+    v['statement'] = data['statement']
+    v['hostname'] = data['hostname']
+    v['canonicalized_statement'] = data['canonicalized_statement']
+
+    if 'canonicalized_statement_hash' in data and data[
+            'canonicalized_statement_hash']:
+        v['canonicalized_statement_hash'] = int(
+            data['canonicalized_statement_hash'])
+
+    if 'canonicalized_statement_hostname_hash' in data and data[
+            'canonicalized_statement_hostname_hash']:
+        v['canonicalized_statement_hostname_hash'] = int(
+            data['canonicalized_statement_hostname_hash'])
+
+    if 'query_time' in data and data['query_time']:
+        v['query_time'] = float(data['query_time'])
 
-        v = {}
-        v['statement'] = data['statement']
-        v['hostname'] = data['hostname']
-        v['canonicalized_statement'] = data['canonicalized_statement']
+    if 'lock_time' in data and data['lock_time']:
+        v['lock_time'] = float(data['lock_time'])
 
-        if 'canonicalized_statement_hash' in data and data[
-                'canonicalized_statement_hash']:
-            v['canonicalized_statement_hash'] = int(
-                data['canonicalized_statement_hash'])
+    if 'rows_sent' in data and data['rows_sent']:
+        v['rows_sent'] = int(data['rows_sent'])
 
-        if 'canonicalized_statement_hostname_hash' in data and data[
-                'canonicalized_statement_hostname_hash']:
-            v['canonicalized_statement_hostname_hash'] = int(
-                data['canonicalized_statement_hostname_hash'])
+    if 'rows_examined' in data and data['rows_examined']:
+        v['rows_examined'] = int(data['rows_examined'])
 
-        if 'query_time' in data and data['query_time']:
-            v['query_time'] = float(data['query_time'])
+    if 'rows_affected' in data and data['rows_affected']:
+        v['rows_affected'] = int(data['rows_affected'])
 
-        if 'lock_time' in data and data['lock_time']:
-            v['lock_time'] = float(data['lock_time'])
+    if 'rows_read' in data and data['rows_read']:
+        v['rows_read'] = int(data['rows_read'])
 
-        if 'rows_sent' in data and data['rows_sent']:
-            v['rows_sent'] = int(data['rows_sent'])
+    if 'bytes_sent' in data and data['bytes_sent']:
+        v['bytes_sent'] = int(data['bytes_sent'])
 
-        if 'rows_examined' in data and data['rows_examined']:
-            v['rows_examined'] = int(data['rows_examined'])
+    if 'tmp_tables' in data and data['tmp_tables']:
+        v['tmp_tables'] = int(data['tmp_tables'])
 
-        if 'rows_affected' in data and data['rows_affected']:
-            v['rows_affected'] = int(data['rows_affected'])
+    if 'tmp_disk_tables' in data and data['tmp_disk_tables']:
+        v['tmp_disk_tables'] = int(data['tmp_disk_tables'])
 
-        if 'rows_read' in data and data['rows_read']:
-            v['rows_read'] = int(data['rows_read'])
+    if 'tmp_table_sizes' in data and data['tmp_table_sizes']:
+        v['tmp_table_sizes'] = int(data['tmp_table_sizes'])
 
-        if 'bytes_sent' in data and data['bytes_sent']:
-            v['bytes_sent'] = int(data['bytes_sent'])
+    if 'server_id' in data:
+        v['server_id'] = int(data['server_id'])
 
-        if 'tmp_tables' in data and data['tmp_tables']:
-            v['tmp_tables'] = int(data['tmp_tables'])
+    if 'schema' in data and data['schema'] and data[
+            'schema'].strip():
+        v['schema'] = data['schema'].strip()
 
-        if 'tmp_disk_tables' in data and data['tmp_disk_tables']:
-            v['tmp_disk_tables'] = int(data['tmp_disk_tables'])
+    if 'hostname' in data and data['hostname'] and data[
+            'hostname'].strip():
+        v['hostname'] = data['hostname'].strip()
 
-        if 'tmp_table_sizes' in data and data['tmp_table_sizes']:
-            v['tmp_table_sizes'] = int(data['tmp_table_sizes'])
+    return v
 
-        if 'server_id' in data:
-            v['server_id'] = int(data['server_id'])
 
-        if 'schema' in data and data['schema'] and data[
-                'schema'].strip():
-            v['schema'] = data['schema'].strip()
+def get_statement_stats_vars(data, statement_data_vars):
+    """Returns models.StatementStats field values of data, statement stats
+    posted by sqlcanonclient, whose sample statement has
+    statement_data_vars."""
 
-        if 'hostname' in data and data['hostname'] and data[
-                'hostname'].strip():
-            v['hostname'] = data['hostname'].strip()
+    flds = [
+        'statement', 'server_id', 'hostname', 'schema',
+        'canonicalized_statement', 'canonicalized_statement_hash',
+        'canonicalized_statement_hostname_hash']
+    v = dict(
+        [(k, statement_data_vars[k]) for k in flds
+            if k in statement_data_vars])
+    v['count'] = int(data['count'])
+    v['dt_start'] = datetime.datetime.fromtimestamp(
+        float(data['dt_start']), timezone.utc)
+    v['dt_end'] = datetime.datetime.fromtimestamp(
+        float(data['dt_end']), timezone.utc)
 
-        return v
+    for k, to_value in (
+            ('query_time', float), ('lock_time', float),
+            ('rows_examined', int), ('rows_sent', int)):
+        for suffix in ('_sum', '_min', '_max'):
+            if data.get(k + suffix) is not None:
+                v[k + suffix] = to_value(data[k + suffix])
+
+    return v
+
+
+@csrf_exempt
+@idempotent
+def save_statement_data(request):
+    """Saves statement data."""
+
+    def get_post_vars(request):
+        data = load_post_data(request)
+        if data is None:
+            return None
+        log.debug('data:\n%s' % (pprint.pformat(data),))
+        return get_statement_data_vars(data)
 
     # store here the statements that needs to be EXPLAINed
     explain = []
     try:
         if request.method == 'POST':
-            log.debug(
-                'request.POST:\n%s' % (pprint.pformat(request.POST),))
-            post_vars = get_post_vars(request.POST)
+            post_vars = get_post_vars(request)
             if post_vars:
                 post_vars['dt'] = timezone.now()
 
@@ -189,13 +293,13 @@ def save_statement_data(request):
                         'is_select_statement=%s\nfirst_seen=%s' % (
                             is_select_statement, first_seen))
 
-                statement_data = core.save_statement_data(
-                    **post_vars)
+                sequence_id = core.save_statement_data(**post_vars)
 
                 if first_seen:
                     explain_data = dict(
                         statement=statement,
-                        statement_data_id=statement_data.id)
+                        statement_data_id=core.get_statement_data_id(
+                            sequence_id))
                     if 'schema' in post_vars and post_vars[
                             'schema'] and post_vars[
                             'schema'].strip():
@@ -205,46 +309,91 @@ def save_statement_data(request):
         ret = json.dumps(dict(explain=explain))
     except Exception, e:
         log.exception('%s' % (e,))
+        rollback()
         ret = json.dumps(dict(error='%s' % (e,)))
     return HttpResponse(ret, mimetype='application/json')
 
 
+@csrf_exempt
+@idempotent
+def save_statement_data_bulk(request):
+    """Saves a JSON array of statement data.
+
+    Responds with the statements to EXPLAIN, their index is the position of
+    their statement data in the array. TransactionMiddleware saves the whole
+    array in a single transaction, nothing is saved if an error is
+    responded, with HTTP 503 so that sqlcanonclient sends the array again.
+    """
+
+    explain = []
+    try:
+        if request.method == 'POST':
+            data_list = load_post_data(request) or []
+
+            dt = timezone.now()
+            statement_data_list = []
+            for data in data_list:
+                post_vars = get_statement_data_vars(data)
+                post_vars['dt'] = dt
+                statement_data_list.append(post_vars)
+            explain = core.save_statement_data_list(statement_data_list)
+
+        ret = json.dumps(dict(explain=explain))
+    except Exception, e:
+        log.exception('%s' % (e,))
+        rollback()
+        return HttpResponse(
+            json.dumps(dict(error='%s' % (e,))), status=503,
+            mimetype='application/json')
+    return HttpResponse(ret, mimetype='application/json')
+
+
+@csrf_exempt
+@idempotent
+def save_statement_stats(request):
+    """Saves a JSON array of statement stats.
+
+    Responds like save_statement_data_bulk(), for the sample statements of
+    the statement stats.
+    """
+
+    explain = []
+    try:
+        if request.method == 'POST':
+            data_list = load_post_data(request) or []
+
+            dt = timezone.now()
+            statement_stats_list = []
+            for data in data_list:
+                post_vars = get_statement_data_vars(data)
+                post_vars['dt'] = dt
+                statement_stats_list.append(
+                    (post_vars, get_statement_stats_vars(data, post_vars)))
+            explain = core.save_statement_stats_list(statement_stats_list)
+
+        ret = json.dumps(dict(explain=explain))
+    except Exception, e:
+        log.exception('%s' % (e,))
+        rollback()
+        return HttpResponse(
+            json.dumps(dict(error='%s' % (e,))), status=503,
+            mimetype='application/json')
+    return HttpResponse(ret, mimetype='application/json')
+
+
 def last_statements(
         request, window_length,
         template='sqlcanon/last_statements.html'):
 
     try:
         window_length = int(window_length)
-        dt = timezone.now()
-        dt_start = dt - datetime.timedelta(minutes=window_length)
-        statement_data_qs = (
-            models.StatementData.objects
-            .filter(dt__gte=dt_start, dt__lte=dt)
-            .values(
-                'canonicalized_statement',
-                'server_id',
-                'canonicalized_statement_hostname_hash',
-                'canonicalized_statement_hash',
-                'statement')
-            .annotate(Max('dt'), Count('dt')).order_by('dt__max'))
-
-        # calculate counts
-        counts = {}
-        for statement_data in statement_data_qs:
-            canonicalized_statement_hostname_hash = statement_data[
-                'canonicalized_statement_hostname_hash']
-            if canonicalized_statement_hostname_hash in counts:
-                counts[canonicalized_statement_hostname_hash] += (
-                    statement_data['dt__count'])
-            else:
-                counts[canonicalized_statement_hostname_hash] = (
-                    statement_data['dt__count'])
 
         statements = []
-        for statement_data in statement_data_qs:
+        for obj in core.get_cached_last_statements(window_length):
+            statement_data = obj['statement_data']
             canonicalized_statement_hostname_hash = statement_data[
                 'canonicalized_statement_hostname_hash']
-            count = counts.get(canonicalized_statement_hostname_hash, 1)
+            count = obj['count']
             sparkline_data_session_key = 'sparkline_data.%s' % (
                 utils.int_to_hex_str(
                     canonicalized_statement_hostname_hash),)
@@ -303,7 +452,7 @@ def home(request, template='site/home.html'):
         ]
 
         hostname_choices = [('__all__', '<All hostnames>')]
-        qs = models.StatementData.objects.values('hostname').distinct()
+        qs = models.StatementSummary.objects.values('hostname').distinct()
         for r in qs:
             k = r['hostname']
             v = r['hostname']
@@ -312,7 +461,7 @@ def home(request, template='site/home.html'):
                 v = '<No hostname>'
             hostname_choices.append((k, v))
         schema_choices = [('__all__', '<All schemas>')]
-        qs = models.StatementData.objects.values('schema').distinct()
+        qs = models.StatementSummary.objects.values('schema').distinct()
         for r in qs:
             k = r['schema']
             v = r['schema']